@@ -73,6 +73,8 @@ setup(
     entry_points={
         'console_scripts' : [
             'refugue=refugue.cli:cli',
+            'refugue-status=refugue.cli:status',
+            'refugue-peers=refugue.cli:peers',
         ]
     },
 
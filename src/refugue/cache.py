@@ -0,0 +1,327 @@
+"""Simple on-disk caches for things that are expensive to discover,
+e.g. anything which needs a round trip to a remote peer."""
+
+import os
+import os.path as osp
+import json
+import time
+import errno
+import shutil
+import pickle
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import quote
+from typing import (
+    Optional,
+    Any,
+)
+
+__all__ = [
+    'atomic_write',
+    'make_tmp_dir',
+    'replace_dir',
+    'cache_dir',
+    'read_cache',
+    'write_cache',
+    'invalidate_cache',
+    'read_file_cache',
+    'write_file_cache',
+]
+
+
+DEFAULT_CACHE_DIR = "$HOME/.cache/refugue"
+"""Location of the cache when XDG_CACHE_HOME is not set."""
+
+CACHE_DIR_ENV_VAR = "REFUGUE_CACHE_DIR"
+"""Environment variable which overrides the location of the cache."""
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Open a file for writing which is only put in place at the path
+    once it is completely written.
+
+    The file is written to a uniquely named temporary file next to the
+    path, so concurrent writers (processes or threads) never share one
+    and readers never see a partial file. If writing fails the
+    temporary file is removed and nothing is changed.
+
+    Parameters
+    ----------
+
+    path : path-like
+
+    mode : str
+        'w' or 'wb'.
+
+    """
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, mode) as wf:
+            yield wf
+
+        os.replace(tmp_path, path)
+
+    except BaseException:
+
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+        raise
+
+def make_tmp_dir(path, suffix='.tmp') -> Path:
+    """Make a uniquely named directory next to a path, e.g. to build a
+    directory in before putting it in place with replace_dir."""
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    return Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{path.name}.", suffix=suffix))
+
+def replace_dir(tmp_path, path):
+    """Atomically put a directory in place of the one at the path (if
+    there is one), which is then removed.
+
+    Readers which still have files of the old directory open keep
+    working.
+
+    """
+
+    path = Path(path)
+
+    while True:
+
+        old_path = make_tmp_dir(path, suffix='.old')
+
+        try:
+            try:
+                os.replace(path, old_path)
+            except FileNotFoundError:
+                pass
+
+            os.replace(tmp_path, path)
+            return
+
+        except OSError as err:
+
+            # another writer put theirs in place in between, move it
+            # out of the way as well
+            if err.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+
+        finally:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+def cache_dir() -> Path:
+    """Get the root directory of the refugue cache."""
+
+    if CACHE_DIR_ENV_VAR in os.environ:
+        path = os.environ[CACHE_DIR_ENV_VAR]
+
+    elif 'XDG_CACHE_HOME' in os.environ:
+        path = osp.join(os.environ['XDG_CACHE_HOME'], 'refugue')
+
+    else:
+        path = DEFAULT_CACHE_DIR
+
+    return Path(osp.expanduser(osp.expandvars(path)))
+
+def cache_path(namespace: str,
+               key: str,
+               suffix: str = '.json',
+) -> Path:
+    """Get the path of the file for a key in a cache namespace."""
+
+    # keys are free-form so make them safe for file names
+    return cache_dir() / namespace / (quote(key, safe='') + suffix)
+
+def read_cache(namespace: str,
+               key: str,
+               ttl: Optional[float] = None,
+) -> Optional[Any]:
+    """Read a cached value.
+
+    Parameters
+    ----------
+
+    namespace : str
+
+    key : str
+
+    ttl : float or None
+        Number of seconds the value is valid for after being
+        written. If None it never expires.
+
+    Returns
+    -------
+
+    value : object or None
+        None if there is no valid value cached.
+
+    """
+
+    path = cache_path(namespace, key)
+
+    try:
+        with open(path, 'r') as rf:
+            record = json.load(rf)
+
+    # treat unreadable or corrupted records as missing
+    except (OSError, ValueError):
+        return None
+
+    if ttl is not None and (time.time() - record['timestamp']) > ttl:
+        return None
+
+    return record['value']
+
+def write_cache(namespace: str,
+                key: str,
+                value: Any,
+):
+    """Write a JSON serializable value to the cache."""
+
+    path = cache_path(namespace, key)
+
+    record = {
+        'timestamp' : time.time(),
+        'value' : value,
+    }
+
+    with atomic_write(path) as wf:
+        json.dump(record, wf)
+
+def invalidate_cache(namespace: Optional[str] = None,
+                     key: Optional[str] = None,
+):
+    """Remove cached values.
+
+    Parameters
+    ----------
+
+    namespace : str or None
+        If None the whole cache is removed.
+
+    key : str or None
+        If None the whole namespace is removed.
+
+    """
+
+    if namespace is None:
+        path = cache_dir()
+
+    elif key is None:
+        path = cache_dir() / namespace
+
+    else:
+        path = cache_path(namespace, key)
+
+    if path.is_dir():
+        shutil.rmtree(path)
+
+    elif path.exists():
+        path.unlink()
+
+def file_digest(file_path) -> str:
+    """Get the hash of the contents of a file."""
+
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as rf:
+        for chunk in iter(lambda: rf.read(1 << 16), b''):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+def read_file_cache(namespace: str,
+                    file_path,
+) -> Optional[Any]:
+    """Read a value derived from a file which was cached with
+    write_file_cache.
+
+    The value is only returned if the file is the same as when it was
+    cached. The modification time and size are checked first and only
+    if these differ is the content hash compared.
+
+    Parameters
+    ----------
+
+    namespace : str
+
+    file_path : path-like
+
+    Returns
+    -------
+
+    value : object or None
+        None if there is no valid value cached.
+
+    """
+
+    file_path = Path(file_path).resolve()
+    path = cache_path(namespace, str(file_path), suffix='.pickle')
+
+    try:
+        stat = file_path.stat()
+
+        with open(path, 'rb') as rf:
+            record = pickle.load(rf)
+
+    # treat unreadable or corrupted records as missing
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+
+    if (record['mtime_ns'] == stat.st_mtime_ns and
+        record['size'] == stat.st_size):
+
+        return record['value']
+
+    # the file was touched but might not have changed
+    if record['digest'] == file_digest(file_path):
+
+        # update the signature so the hash isn't needed next time
+        _write_file_record(path, {**record,
+                                  'mtime_ns' : stat.st_mtime_ns,
+                                  'size' : stat.st_size})
+
+        return record['value']
+
+    return None
+
+def write_file_cache(namespace: str,
+                     file_path,
+                     value: Any,
+):
+    """Cache a picklable value derived from a file, see read_file_cache."""
+
+    file_path = Path(file_path).resolve()
+    path = cache_path(namespace, str(file_path), suffix='.pickle')
+
+    stat = file_path.stat()
+
+    record = {
+        'mtime_ns' : stat.st_mtime_ns,
+        'size' : stat.st_size,
+        'digest' : file_digest(file_path),
+        'value' : value,
+    }
+
+    _write_file_record(path, record)
+
+def _write_file_record(path, record):
+
+    try:
+        with atomic_write(path, 'wb') as wf:
+            pickle.dump(record, wf, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # values that can't be pickled just aren't cached
+    except (pickle.PicklingError, TypeError, AttributeError):
+        pass
@@ -1,11 +1,12 @@
+import sys
+import json
+import time
 import runpy
+import functools
 import os.path as osp
 from pathlib import Path
-import runpy
 
 import click
-from invoke import Context
-import toml
 
 from refugue.network import (
     Network,
@@ -14,13 +15,33 @@ from refugue.network import (
     ImpossibleConnection,
     SSHConnection,
 )
-from .image import Image
+from .image import (
+    Image,
+    plan_sync_pairs,
+    run_sync_pairs,
+)
+from .cache import (
+    invalidate_cache,
+    read_file_cache,
+    write_file_cache,
+)
 from .sync import (
+    SHARD_METHODS,
     SyncPolicy,
     TransportPolicy,
     SyncSpec,
 )
-from .protocols.rsync import RsyncProtocol
+from .output import (
+    OUTPUT_MODES,
+    format_bytes,
+)
+from .profiling import (
+    SUMMARY_PROFILE,
+    span,
+    start_tracing,
+    stop_tracing,
+)
+from .util import confirm
 
 
 DEFAULT_NETWORK_PATH = "$HOME/.config/refugue/network.config.py"
@@ -48,6 +69,14 @@ NETWORK_CONFIG_KEYS = (
     "PEERS",
     "PEER_MOUNT_PREFIX_TYPES",
     "CONNECTIONS",
+    "SSH_CONTROL",
+    "PEER_ENV_TTL",
+    "PEER_CAPABILITIES_TTL",
+    "PEER_PROBE_TIMEOUT",
+    "REACHABILITY_TTL",
+    "ROUTE_TTL",
+    "RSYNC_PROFILES",
+    "PEER_LINKS",
 )
 
 IMAGE_CONFIG_KEYS = (
@@ -78,6 +107,10 @@ DEFAULT_TRANSPORT_OPTIONS = (
     ('compression', 'auto'),
     ('encryption', None),
     ('create', True),
+    ('parallel', 1),
+    ('shard', 'size'),
+    ('incremental', False),
+    ('output', 'full'),
 )
 
 
@@ -110,83 +143,306 @@ COMPRESSION_METHODS = (
     # 'zlib',
 )
 
+SYNC_PROTOCOLS = (
+    'rsync',
+
+    # the native protocol if both replicas are local, otherwise rsync
+    'auto',
+
+    # in-process copying between local replicas, experimental
+    'native',
+)
+
 ENVRYPTION_METHODS = (
     None,
     # TODO
 )
 
 
-def read_network_config(config_path):
-    """Read a python code config file for a network spec and strip out
-    only the recognized variables
+def resolve_pair_options(image_config_d, src, target):
+    """Get the sync and transport options for a pair of replicas from
+    the image config.
+
+    The defaults are updated with the 'DEFAULT_PAIR_OPTIONS' and then
+    the first of the pair's entries in 'PAIR_OPTIONS' for a one-way
+    sync from src to target or a two-way sync in either order.
+
+    Parameters
+    ----------
+
+    image_config_d : dict
+
+    src : str
+        Name of the source replica as given.
+
+    target : str
+        Name of the target replica as given.
+
+    Returns
+    -------
+
+    sync_options : dict
+
+    transport_options : dict
 
     """
 
-    config_all = runpy.run_path(str(config_path))
+    sync_options = dict(DEFAULT_SYNC_OPTIONS)
+    transport_options = dict(DEFAULT_TRANSPORT_OPTIONS)
 
-    config = {key : value for key, value in config_all.items()
-              if key in NETWORK_CONFIG_KEYS}
+    # use the default from the config file
+    if 'DEFAULT_PAIR_OPTIONS' in image_config_d:
+        sync_options.update(image_config_d['DEFAULT_PAIR_OPTIONS'].get('sync', {}))
+        transport_options.update(image_config_d['DEFAULT_PAIR_OPTIONS'].get('transport', {}))
 
-    return config
+    # then update with the options in the specific pairing
+
+    # choose which pairing keys to try given the src and target
+    pairing_keys = [
+        (src, target, '-->'),
+        (src, target, '<-->'),
+        (target, src, '<-->'),
+    ]
+
+    pair_options = image_config_d.get('PAIR_OPTIONS', {})
+
+    for key in pairing_keys:
+        if key in pair_options:
+            sync_options.update(pair_options[key].get('sync', {}))
+            transport_options.update(pair_options[key].get('transport', {}))
+            break
+
+    return sync_options, transport_options
+
+def compile_sync_spec(image_config_d, src, target, sync, cli_transport_spec):
+    """Make the SyncSpec for a pair from the image config and the
+    command line options.
+
+    Parameters
+    ----------
+
+    image_config_d : dict
+
+    src : str
+
+    target : str
+
+    sync : str or None
+        The '--sync' option, overrides the sync options from the image
+        config if given.
+
+    cli_transport_spec : dict
+        Transport options given on the command line, these override
+        the ones from the image config.
+
+    Returns
+    -------
+
+    sync_spec : SyncSpec
+
+    """
+
+    sync_options, transport_spec = resolve_pair_options(image_config_d, src, target)
+
+    ## sync options
+
+    # if command line sync was given use that
+    if sync is not None:
+
+        # the possible names
+        sync_names = [opt for _, opt in SYNC_OPTIONS]
+        sync_abbrevs = [abbrev for abbrev, _ in SYNC_OPTIONS]
+
+        # initialize
+        sync_spec = {opt : False for opt in sync_names}
+
+        # parse
+        sync_opts = {}
+        if sync.strip() != '':
+            sync_opts = sync.strip().split(',')
+
+        # turn them on that are given in the string
+        for opt in sync_opts:
+
+            # get the full name if necessary
+            if opt in sync_abbrevs:
+                opt = sync_names[sync_abbrevs.index(opt)]
+
+            sync_spec[opt] = True
+
+    # otherwise we want to load from the image config the pairs if
+    # given, and if not using the safe deafult
+    else:
+        sync_spec = sync_options
+
+    ## Transport
+
+    transport_spec.update(cli_transport_spec)
+
+    # create them
+    sync_pol = SyncPolicy(**sync_spec)
+
+    transport_pol = TransportPolicy(**transport_spec)
+
+    return SyncSpec(
+        sync_pol = sync_pol,
+        transport_pol = transport_pol,
+    )
+
+def resolve_sync_protocol(protocol, image, sync_pair):
+    """Choose the sync protocol class for a pair.
 
-def read_image_config(config_path):
+    Protocols pull in their own dependencies so only the one being used
+    is imported.
+
+    """
+
+    if protocol == 'auto':
+
+        from .protocols.native import NativeProtocol
+
+        # incremental and batch syncs are only implemented with rsync
+        transport_pol = sync_pair.sync_spec.transport_pol
+        if (not transport_pol.incremental and
+            not transport_pol.batch and
+            NativeProtocol.supports_pair(image, sync_pair.src, sync_pair.target)):
+            protocol = 'native'
+        else:
+            protocol = 'rsync'
+
+    if protocol == 'native':
+        from .protocols.native import NativeProtocol
+        return NativeProtocol
+
+    elif protocol == 'rsync':
+        from .protocols.rsync import RsyncProtocol
+        return RsyncProtocol
+
+    else:
+        raise ValueError(f"Unknown sync protocol: {protocol}")
+
+def read_network_config(config_path, use_cache=True):
+    """Read a python code config file for a network spec and strip out
+    only the recognized variables
+
+    """
+
+    return _read_config(config_path, NETWORK_CONFIG_KEYS,
+                        'network_configs', use_cache)
+
+def read_image_config(config_path, use_cache=True):
     """Read a python code config file for an image spec and strip out only
     the recognized variables
 
     """
 
-    config_all = runpy.run_path(str(config_path))
+    return _read_config(config_path, IMAGE_CONFIG_KEYS,
+                        'image_configs', use_cache)
+
+def _read_config(config_path, config_keys, cache_namespace, use_cache):
+    """Read a python code config file keeping only the config_keys.
+
+    Executing the config file can be expensive (e.g. when it is
+    generated programmatically) so unless use_cache is False the result
+    is cached and reused for as long as the file doesn't change. Note
+    that changes to anything else the config file reads (i.e. imported
+    modules or environment variables) are not detected.
+
+    """
+
+    if use_cache:
+
+        config = read_file_cache(cache_namespace, config_path)
+
+        if config is not None:
+            return config
+
+    with span('config.evaluate', path=config_path):
+        config_all = runpy.run_path(str(config_path))
 
     config = {key : value for key, value in config_all.items()
-              if key in IMAGE_CONFIG_KEYS}
+              if key in config_keys}
+
+    if use_cache:
+        write_file_cache(cache_namespace, config_path, config)
 
     return config
 
-from invoke.vendor.six.moves import input
+def load_configs(network, image, use_cache=True):
+    """Read the network and image config files, using the default
+    locations for those which aren't given."""
+
+    if network is None:
+        network = DEFAULT_NETWORK_PATH
+
+    if image is None:
+        image = Path(IMAGE_CONFIG_DIR) / DEFAULT_IMAGE_CONF_NAME
+
+    # expand shell variables to the config files
+    network_path = Path(osp.expanduser(osp.expandvars(network)))
+    image_path = Path(osp.expanduser(osp.expandvars(image)))
+
+    with span('config.load'):
+
+        network_config_d = read_network_config(network_path,
+                                               use_cache=use_cache)
+        image_config_d = read_image_config(image_path,
+                                           use_cache=use_cache)
+
+    return network_config_d, image_config_d
+
+def start_profiling(profile, cprofile):
+    """Start tracing the stages of the invocation and/or profiling it
+    with cProfile, reporting them when the click context closes.
+
+    Parameters
+    ----------
+
+    profile : str or None
+        SUMMARY_PROFILE to print a table of the time taken by each
+        stage to standard error, otherwise the path to write a Chrome
+        trace-event file to.
+
+    cprofile : str or None
+        Path to dump cProfile stats to.
 
-def confirm(question, assume_yes=True):
-    """
-    Ask user a yes/no question and return their response as a boolean.
-    ``question`` should be a simple, grammatically complete question such as
-    "Do you wish to continue?", and will have a string similar to ``" [Y/n] "``
-    appended automatically. This function will *not* append a question mark for
-    you.
-    By default, when the user presses Enter without typing anything, "yes" is
-    assumed. This can be changed by specifying ``assume_yes=False``.
-    .. note::
-        If the user does not supplies input that is (case-insensitively) equal
-        to "y", "yes", "n" or "no", they will be re-prompted until they do.
-    :param str question: The question part of the prompt.
-    :param bool assume_yes:
-        Whether to assume the affirmative answer by default. Default value:
-        ``True``.
-    :returns: A `bool`.
     """
-    # Set up suffix
-    if assume_yes:
-        suffix = "Y/n"
-    else:
-        suffix = "y/N"
-    # Loop till we get something we like
-    # TODO: maybe don't do this? It can be annoying. Turn into 'q'-for-quit?
-    while True:
-        # TODO: ensure that this is Ctrl-C friendly, ISTR issues with
-        # raw_input/input on some Python versions blocking KeyboardInterrupt.
-        response = input("{0} [{1}] ".format(question, suffix))
-        response = response.lower().strip()  # Normalize
-        # Default
-        if not response:
-            return assume_yes
-        # Yes
-        if response in ["y", "yes"]:
-            return True
-        # No
-        if response in ["n", "no"]:
-            return False
-        # Didn't get empty, yes or no, so complain and loop
-        err = "I didn't understand you. Please specify '(y)es' or '(n)o'."
-        print(err, file=sys.stderr)
 
+    start_ns = time.perf_counter_ns()
+
+    tracer = start_tracing() if profile is not None else None
+
+    profiler = None
+    if cprofile is not None:
+
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def _finish():
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile)
+            print(f"Wrote cProfile stats to: {cprofile}", file=sys.stderr)
+
+        if tracer is not None:
+
+            stop_tracing()
+
+            # the whole invocation as the outermost span
+            tracer.record('cli.total', start_ns, time.perf_counter_ns())
+
+            if profile == SUMMARY_PROFILE:
+                print(tracer.summary(), file=sys.stderr)
+
+            else:
+                tracer.write_chrome_trace(profile)
+                print(f"Wrote trace to: {profile}", file=sys.stderr)
+
+    # called however the command exits
+    click.get_current_context().call_on_close(_finish)
 
 @click.command()
 @click.option("--network",
@@ -197,6 +453,10 @@ def confirm(question, assume_yes=True):
               type=click.Path(exists=True),
               default=None,
               help="Image specification file to use.")
+@click.option("--no-config-cache",
+              is_flag=True,
+              default=False,
+              help="Always evaluate the network and image config files instead of using cached results.")
 @click.option("--subtree",
               default=None,
               help="Subtree to restrict sync of image to. Relative path to root of replica.")
@@ -223,187 +483,301 @@ def confirm(question, assume_yes=True):
 @click.option("--encryption",
               default=None,
               help="Choose an encryption method: None")
+@click.option("--parallel",
+              type=int,
+              default=None,
+              help="Number of concurrent transfer processes to split the sync between. Default=1")
+@click.option("--shard",
+              type=click.Choice(SHARD_METHODS),
+              default=None,
+              help="How to split the replica between parallel transfers: top-level directories grouped by count "
+              "(top) or by size (size). Default='size'")
+@click.option("--incremental",
+              is_flag=True,
+              default=None,
+              help="Only sync the paths which changed in the source since the last sync "
+              "instead of scanning both replicas (rsync only). Can't be used with --parallel.")
+@click.option("--output",
+              type=click.Choice(OUTPUT_MODES),
+              default=None,
+              help="How to report the changes made: only the totals (quiet), per directory (summary), "
+              "every line of output (full) or as JSON lines (jsonl). Default='full'")
+@click.option("--batch",
+              is_flag=True,
+              default=None,
+              help="Compute the update for identical local targets once and apply it to "
+              "each of them with rsync batch files (rsync only).")
+@click.option("--protocol",
+              type=click.Choice(SYNC_PROTOCOLS),
+              default='rsync',
+              help="Protocol to transfer files with, 'auto' copies natively between local replicas "
+              "and uses rsync otherwise. The native protocol is experimental. Default='rsync'")
+@click.option("--refresh-env",
+              is_flag=True,
+              default=False,
+              help="Invalidate the cached environments, capabilities, reachability, routes, and links between peers and fetch them again")
 @click.option("--yes",
               '-y',
               is_flag=True,
               default=False,
               help="Don't ask for confirmation")
+@click.option("--profile",
+              default=None,
+              help="Time each stage of the invocation and write a Chrome trace-event file "
+              f"to this path, or print a table of them with '{SUMMARY_PROFILE}'.")
+@click.option("--cprofile",
+              type=click.Path(dir_okay=False, writable=True),
+              default=None,
+              help="Profile the Python side of the invocation with cProfile and dump the stats to this path.")
+@click.option("--jobs",
+              '-j',
+              type=int,
+              default=None,
+              help="Number of targets to sync to at once when given more than one. Default=4")
+@click.option("--relay",
+              is_flag=True,
+              default=False,
+              help="Sync targets from other targets closer to them instead of all from the source, "
+              "so slow links are crossed once.")
 @click.argument("src")
-@click.argument("target")
+@click.argument("targets", nargs=-1, required=True)
 def cli(
         # file-based specifications
-        network, image, subtree,
+        network, image, no_config_cache, subtree,
         # sync spec overrides from image
         sync,
         # transport options
-        dry, create, backup, compression, encryption,
+        dry, create, backup, compression, encryption, parallel, shard, incremental,
+        output, batch, protocol,
         # other CLI options
-        yes,
-        # the alpha and beta pair
-        src, target):
+        refresh_env, yes, profile, cprofile, jobs, relay,
+        # the source and the targets to sync it to
+        src, targets):
+    """Sync the SRC replica to each of the TARGETS replicas.
 
-    ### Load the config files
+    Many targets are synced to concurrently, sharing the connection to
+    and scans of the source.
 
-    if network is None:
-        network = DEFAULT_NETWORK_PATH
+    """
 
-    if image is None:
-        image = Path(IMAGE_CONFIG_DIR) / DEFAULT_IMAGE_CONF_NAME
+    # relayed targets would be planned against targets which weren't
+    # updated
+    if relay and dry:
+        raise click.BadParameter("--relay can't be used with --dry")
 
-    # expand shell variables to the config files
-    network_path = Path(osp.expanduser(osp.expandvars(network)))
-    image_path = Path(osp.expanduser(osp.expandvars(image)))
+    # an incremental sync is a single transfer of the changed paths
+    if incremental and parallel is not None and parallel > 1:
+        raise click.BadParameter("--incremental can't be used with --parallel")
 
-    network_config_d = read_network_config(network_path)
-    image_config_d = read_image_config(image_path)
+    if profile is not None or cprofile is not None:
+        start_profiling(profile, cprofile)
+
+    ### Load the config files
+
+    network_config_d, image_config_d = load_configs(network, image,
+                                                    use_cache=not no_config_cache)
 
     ### Network
 
+    # what is cached about peers is refetched when used next
+    if refresh_env:
+        invalidate_cache('peer_env')
+        invalidate_cache('peer_capabilities')
+        invalidate_cache('reachability')
+        invalidate_cache('routes')
+        invalidate_cache('peer_links')
+
     # build the network from the configuration file
-    network = Network.from_config(network_config_d)
+    with span('network.from_config'):
+        network = Network.from_config(network_config_d)
 
     ### Image & Replicas
 
     # then embed it into the Image along with the image spec with all
     # the replicas
-    image = Image.from_config(image_config_d, network)
+    with span('image.from_config'):
+        image = Image.from_config(image_config_d, network)
 
-    ### Generate the SyncSpec from transport and sync policies
+    ### Generate the SyncSpecs from transport and sync policies
 
-    ## sync options
+    # set compression to auto if not given
+    if compression is None:
+        compression = 'auto'
 
-    # if command line sync was given use that
-    if sync is not None:
+    # finally override with command line options
+    cli_transport_spec = {
+        'dry' : dry,
+        'create' : create,
+        'backup' : backup,
+        'compression' : compression,
+        'encryption' : encryption,
+    }
 
-        # the possible names
-        sync_names = [opt for _, opt in SYNC_OPTIONS]
-        sync_abbrevs = [abbrev for abbrev, _ in SYNC_OPTIONS]
+    # these are only overridden if given
+    if parallel is not None:
+        cli_transport_spec['parallel'] = parallel
 
-        # initialize
-        sync_spec = {opt : False for opt in sync_names}
+    if shard is not None:
+        cli_transport_spec['shard'] = shard
 
-        # parse
-        sync_opts = {}
-        if sync.strip() != '':
-            sync_opts = sync.strip().split(',')
+    if incremental is not None:
+        cli_transport_spec['incremental'] = incremental
 
-        # turn them on that are given in the string
-        for opt in sync_opts:
+    if output is not None:
+        cli_transport_spec['output'] = output
 
-            # get the full name if necessary
-            if opt in sync_abbrevs:
-                opt = sync_names[sync_abbrevs.index(opt)]
+    if batch is not None:
+        cli_transport_spec['batch'] = batch
 
-            sync_spec[opt] = True
+    # each pair can have its own options in the image config
+    sync_specs = [compile_sync_spec(image_config_d, src, target, sync, cli_transport_spec)
+                  for target in targets]
 
-    # otherwise we want to load from the image config the pairs if
-    # given, and if not using the safe deafult
-    else:
+    ## Sync Protocol
 
-        # start with the default
-        sync_spec = dict(DEFAULT_SYNC_OPTIONS)
+    # invoke is only needed once we execute anything
+    from invoke import Context
 
-        # use the default from the config file
-        if 'DEFAULT_PAIR_OPTIONS' in image_config_d:
-            sync_spec.update(image_config_d['DEFAULT_PAIR_OPTIONS']['sync'])
+    # The local execution context
+    local_cx = Context()
 
-        # then update with the options in the specific pairing
+    # remote connections are pooled in the network so make sure they
+    # get closed however we leave
+    try:
+        results = _run_sync(image, local_cx, sync_specs, protocol, subtree,
+                            src, targets, create, yes, jobs, relay)
+    finally:
+        image.network.close()
 
-        # choose which pairing keys to try given the src and target
-        pairing_keys = [
-            (src, target, '-->'),
-            (src, target, '<-->'),
-            (target, src, '<-->'),
-        ]
+    # failed transfers exit with the code of the (first) failed
+    # transfer
+    failed = [result for result in (results or []) if not result.ok]
+    if len(failed) > 0:
+        sys.exit(failed[0].exit_code)
 
-        for key in pairing_keys:
-            if key in image_config_d['PAIR_OPTIONS']:
-                pair_spec = image_config_d['PAIR_OPTIONS'][key]
-                sync_spec.update(image_config_d['PAIR_OPTIONS'][key]['sync'])
-                break
+def _format_results_table(sync_pairs, results) -> str:
+    """A table of the results of syncing to many targets."""
 
-    ## Transport
+    width = max(len('target'), max(len(sync_pair.label) for sync_pair in sync_pairs))
 
-    # set compression to auto if not given
-    if compression is None:
-        compression = 'auto'
+    lines = [
+        f"{'target':<{width}}  {'status':<10} {'files':>8} {'transferred':>12} "
+        f"{'deleted':>8} {'seconds':>8}",
+    ]
 
-    transport_spec = dict(DEFAULT_TRANSPORT_OPTIONS)
+    for sync_pair, result in zip(sync_pairs, results):
 
-    # use the default from the config file
-    if 'DEFAULT_PAIR_OPTIONS' in image_config_d:
-        transport_spec.update(image_config_d['DEFAULT_PAIR_OPTIONS']['transport'])
+        status = 'ok' if result.ok else f"failed ({result.exit_code})"
 
-    # then update with the options in the specific pairing
+        lines.append(
+            f"{sync_pair.label:<{width}}  {status:<10} {result.transferred_files:>8} "
+            f"{format_bytes(result.transferred_size):>12} {result.deleted_files:>8} "
+            f"{result.elapsed:>8.2f}"
+        )
 
-    # choose which pairing keys to try given the src and target
-    pairing_keys = [
-        (src, target, '-->'),
-        (src, target, '<-->'),
-        (target, src, '<-->'),
-    ]
+    return '\n'.join(lines)
 
-    for key in pairing_keys:
-        if key in image_config_d['PAIR_OPTIONS']:
-            pair_spec = image_config_d['PAIR_OPTIONS'][key]
-            transport_spec.update(image_config_d['PAIR_OPTIONS'][key]['transport'])
-            break
+def _run_sync(image, local_cx, sync_specs, protocol, subtree, src, targets, create, yes, jobs,
+              relay=False):
+    """Plan, confirm, and execute the syncs from the source to each of
+    the targets.
 
-    # finally override with command line options
-    cli_transport_spec = {
-        'dry' : dry,
-        'create' : create,
-        'backup' : backup,
-        'compression' : compression,
-        'encryption' : encryption,
-    }
+    Returns
+    -------
 
-    transport_spec.update(cli_transport_spec)
+    results : list of SyncResult or None
+        One for each target, None if it was cancelled.
 
-    # create them
-    sync_pol = SyncPolicy(**sync_spec)
+    """
 
-    transport_pol = TransportPolicy(**transport_spec)
+    # keep standard output for the records when outputting JSON lines
+    jsonl = any(sync_spec.transport_pol.output == 'jsonl' for sync_spec in sync_specs)
+    if jsonl:
+        say = functools.partial(print, file=sys.stderr)
+    else:
+        say = print
 
-    sync_spec = SyncSpec(
-        sync_pol = sync_pol,
-        transport_pol = transport_pol,
-    )
+    # identify the replicas in the network, discover current network
+    # topology, validate connection viability, and reify
+    with span('image.pair'):
+        sync_pairs = image.fan_out(
+            local_cx,
+            sync_specs,
+            subtree,
+            src,
+            targets,
+        )
 
-    ## Sync Protocol
+    for sync_pair, target in zip(sync_pairs, targets):
+        for replica_spec, replica in ((src, sync_pair.src), (target, sync_pair.target)):
+            if replica is None:
+                raise click.BadParameter(f"Unknown replica: {replica_spec}")
 
-    # The local execution context
-    local_cx = Context()
+    # also when given by different aliases
+    labels = [sync_pair.label for sync_pair in sync_pairs]
+    if len(set(labels)) < len(labels):
+        raise click.BadParameter("A target replica was given more than once")
 
-    # identify the replicas in the network, discover current network
-    # topology, validate connection viability, and reify
-    sync_pair = image.pair(
-        local_cx,
-        sync_spec,
-        subtree,
-        src,
-        target,
-    )
+    src_replica = sync_pairs[0].src
 
-    ### Execution
+    # fail before planning (which may need to connect) instead of
+    # waiting on a connection to time out
+    reachability = image.network.probe_reachability(
+        [src_replica.peer] + [sync_pair.target.peer for sync_pair in sync_pairs])
 
-    # STUB: choose protocol, its always rsync now
-    sync_protocol = RsyncProtocol
+    unreachable = [peer_reach for peer_reach in reachability.values()
+                   if not peer_reach.reachable]
 
-    # get the context and function to execute
-    sync_func, confirm_message = sync_pair.sync(
-        local_cx,
-        sync_protocol,
-    )
+    if len(unreachable) > 0:
+        raise click.ClickException(
+            "Unreachable peers: " +
+            ', '.join(f"{peer_reach.peer} ({peer_reach.reason})"
+                      for peer_reach in unreachable))
+
+    # the targets which are synced from another target
+    parents = None
+    if relay and len(sync_pairs) > 1:
+
+        sync_pairs, parents = image.relay(
+            local_cx,
+            sync_specs,
+            subtree,
+            src,
+            targets,
+            rtts={name : peer_reach.rtt for name, peer_reach in reachability.items()},
+        )
+
+    ### Planning
+
+    sync_protocols = [resolve_sync_protocol(protocol, image, sync_pair)
+                      for sync_pair in sync_pairs]
 
-    # get the connections and contexts
-    src_conn = image.network.resolve_peer_connection(sync_pair.src.peer)
-    target_conn = image.network.resolve_peer_connection(sync_pair.src.peer)
+    # get the functions to execute, batching the targets which can be
+    planned = [(sync_pair, sync_func, confirm_message)
+               for sync_pair, (sync_func, confirm_message)
+               in zip(sync_pairs,
+                      plan_sync_pairs(local_cx, sync_pairs, sync_protocols))]
+
+    create_commands = []
+    for sync_pair in sync_pairs:
+
+        # the create command if asked for
+        if create:
 
-    src_cx = image.network.resolve_peer_context(local_cx, sync_pair.src.peer)
-    target_cx = image.network.resolve_peer_context(local_cx, sync_pair.target.peer)
+            # get the path to create on that context
+            with span('cli.resolve_create_path'):
+                target_replica_path = image.resolve_replica_path(
+                    local_cx,
+                    sync_pair.target,
+                )
 
+            if subtree is not None:
+                target_replica_path = Path(target_replica_path) / subtree
 
+            create_commands.append(f"mkdir -p {target_replica_path}")
+
+    # get the connection of the source
+    src_conn = image.network.resolve_peer_connection(src_replica.peer)
 
     if issubclass(type(src_conn), LocalConnection):
         src_conn = "localhost"
@@ -415,63 +789,292 @@ def cli(
 
         raise RefugueNetworkError("")
 
-    # the create command if asked for
-    if create:
+    fan_out = len(planned) > 1
 
-        # get the path to create on that context
-        target_replica_path = image.resolve_replica_path(
-            local_cx,
-            sync_pair.target,
-        )
+    for (sync_pair, _, confirm_message), create_command in zip(
+            planned, create_commands or [None] * len(planned)):
 
-        if subtree is not None:
-            target_replica_path = Path(target_replica_path) / subtree
+        target_note = f" (to {sync_pair.label})" if fan_out else ""
 
-        # the command
-        create_command = f"mkdir -p {target_replica_path}"
+        if sync_pair.src is not src_replica:
+            target_note = (f" (to {sync_pair.label} relayed from "
+                           f"{sync_pair.src.peer.name}/{sync_pair.src.refinement})")
 
+        if create_command is not None:
 
-        # Preparation commands to run
-        print("\nTarget Peer preparation commands:")
-        print("--------------------------------------------------------------------------------")
-        print(create_command)
-        print("--------------------------------------------------------------------------------")
+            # Preparation commands to run
+            say(f"\nTarget Peer preparation commands{target_note}:")
+            say("--------------------------------------------------------------------------------")
+            say(create_command)
+            say("--------------------------------------------------------------------------------")
 
-    # confirm this is okay to run
-    print("\nThe generated command:")
-    print("--------------------------------------------------------------------------------")
-    print(confirm_message)
-    print("--------------------------------------------------------------------------------")
+        # confirm this is okay to run
+        say(f"\nThe generated command{target_note}:")
+        say("--------------------------------------------------------------------------------")
+        say(confirm_message)
+        say("--------------------------------------------------------------------------------")
 
     # get confirmation if not already
     if not yes:
 
-        yes = confirm(
-            f"Run this command on the host: '{sync_pair.src.peer.name}' via '{src_conn}'?",
-            assume_yes=False,
-        )
+        if fan_out:
+            question = (f"Run these {len(planned)} syncs from the host: "
+                        f"'{src_replica.peer.name}' via '{src_conn}'?")
+        else:
+            question = (f"Run this command on the host: "
+                        f"'{src_replica.peer.name}' via '{src_conn}'?")
 
-    if yes:
+        # waiting on the user is timed too so it can be told apart
+        with span('cli.confirm'):
+            yes = confirm(
+                question,
+                assume_yes=False,
+            )
 
-        # Create if necessary
-        if create:
-            print(f"Running preparation command on target host:")
-            print("--------------------------------------------------------------------------------")
-            target_cx.run(create_command)
-            print("--------------------------------------------------------------------------------")
+    if not yes:
+        say("Command Cancelled")
+
+        return None
+
+    # Create if necessary
+    if create:
+        say(f"Running preparation command on target host:")
+        say("--------------------------------------------------------------------------------")
+        with span('cli.prepare'):
+            for (sync_pair, _, _), create_command in zip(planned, create_commands):
+                target_cx = image.network.resolve_peer_context(local_cx, sync_pair.target.peer)
+                target_cx.run(create_command)
+        say("--------------------------------------------------------------------------------")
+
+    say(f"Running command on source host: '{src_replica.peer.name}' "
+          f"via connection: '{src_conn}'")
+    say("Command Output:")
+    say("--------------------------------------------------------------------------------")
 
-        print(f"Running command on source host: '{sync_pair.src.peer.name}' "
-              "via connection: '{src_conn}'")
-        print("Command Output:")
-        print("--------------------------------------------------------------------------------")
+    #### SYNC
+    with span('sync.execute'):
 
-        #### SYNC
-        sync_func(local_cx, src_cx, target_cx)
-        print("--------------------------------------------------------------------------------")
-        print("Refugue says: Synchronization Finished")
+        if fan_out:
+            results = run_sync_pairs(
+                local_cx,
+                [(sync_pair, sync_func) for sync_pair, sync_func, _ in planned],
+                jobs=jobs,
+                parents=parents,
+            )
+
+        else:
+            sync_pair, sync_func, _ = planned[0]
+            results = [sync_pair.execute(local_cx, sync_func)]
+
+    say("--------------------------------------------------------------------------------")
+
+    for sync_pair, result in zip(sync_pairs, results):
+
+        if jsonl:
+            record = {'type' : 'result', **result.to_dict()}
+            if fan_out:
+                record['target'] = sync_pair.label
+            print(json.dumps(record))
+
+        elif fan_out:
+            say(f"[{sync_pair.label}] {result.summary()}")
+
+        else:
+            say(result.summary())
+
+    if fan_out:
+        say(_format_results_table(sync_pairs, results))
+
+    n_failed = sum(1 for result in results if not result.ok)
+
+    if n_failed == 0:
+        say("Refugue says: Synchronization Finished")
+
+    elif not fan_out:
+        say(f"Refugue says: Synchronization Failed (exit code {results[0].exit_code})")
 
     else:
-        print("Command Cancelled")
+        say(f"Refugue says: Synchronization Failed for {n_failed} of {len(results)} targets")
+
+    return results
+
+
+MANIFEST_LOCATIONS = (
+    # the local refugue cache
+    'cache',
+
+    # in the '.refugue' directory of local replicas
+    'replica',
+)
+
+@click.command()
+@click.option("--network",
+              type=click.Path(exists=True),
+              default=None,
+              help="Network specification file to use.")
+@click.option("--image",
+              type=click.Path(exists=True),
+              default=None,
+              help="Image specification file to use.")
+@click.option("--no-config-cache",
+              is_flag=True,
+              default=False,
+              help="Always evaluate the network and image config files instead of using cached results.")
+@click.option("--location",
+              type=click.Choice(MANIFEST_LOCATIONS),
+              default='cache',
+              help="Where the manifests are stored. Default='cache'")
+@click.option("--no-refresh",
+              is_flag=True,
+              default=False,
+              help="Show the last recorded manifests instead of scanning the replicas.")
+@click.option("--restat/--no-restat",
+              default=True,
+              help="Stat files in directories which haven't changed when refreshing. Default=restat")
+@click.option("--hash",
+              is_flag=True,
+              default=False,
+              help="Record content hashes of new and changed files (local replicas only).")
+@click.argument("replicas", nargs=-1, required=True)
+def status(network, image, no_config_cache, location, no_refresh, restat, hash, replicas):
+    """Show what the REPLICAS contain and what changed since they were
+    last scanned.
+
+    If two replicas are given also estimate what syncing the first to
+    the second would transfer.
+
+    """
+
+    from invoke import Context
+    from .manifest import estimate_transfer
+
+    network_config_d, image_config_d = load_configs(network, image,
+                                                    use_cache=not no_config_cache)
+
+    network = Network.from_config(network_config_d)
+    image = Image.from_config(image_config_d, network)
+
+    local_cx = Context()
+
+    manifests = []
+    try:
+        for replica_spec in replicas:
+
+            replica = image.get_replica(replica_spec)
+
+            if replica is None:
+                raise click.BadParameter(f"Unknown replica: {replica_spec}")
+
+            previous = image.load_manifest(local_cx, replica, location)
+
+            if no_refresh:
+
+                if previous is None:
+                    raise click.ClickException(f"No manifest recorded for: {replica_spec}")
+
+                manifest = previous
+                previous = None
+
+            else:
+                manifest = image.refresh_manifest(local_cx, replica, location,
+                                                  restat=restat, hash=hash)
+
+            manifests.append(manifest)
+
+            totals = manifest.totals()
+
+            print(f"{replica.peer.name}/{replica.refinement}")
+            print(f"    files: {totals['files']}  dirs: {totals['dirs']}  "
+                  f"size: {format_bytes(totals['size'])}")
+
+            if previous is not None:
+
+                changes = {'added' : 0, 'removed' : 0, 'modified' : 0}
+                for kind, _, _, _ in manifest.diff(previous):
+                    changes[kind] += 1
+
+                previous.close()
+
+                print("    since last scan: " +
+                      "  ".join(f"{kind}: {count}" for kind, count in changes.items()))
+
+        if len(manifests) == 2:
+
+            src, target = replicas
+
+            sync_spec, _ = resolve_pair_options(image_config_d, src, target)
+
+            plan = estimate_transfer(*manifests, SyncPolicy(**sync_spec))
+
+            print(f"{src} --> {target}")
+            print(f"    create: {plan['created_files']}  update: {plan['updated_files']}  "
+                  f"delete: {plan['deleted_files']}  "
+                  f"transfer: {format_bytes(plan['transferred_size'])}")
+
+    finally:
+        for manifest in manifests:
+            manifest.close()
+
+        network.close()
+
+@click.command()
+@click.option("--network",
+              type=click.Path(exists=True),
+              default=None,
+              help="Network specification file to use.")
+@click.option("--no-config-cache",
+              is_flag=True,
+              default=False,
+              help="Always evaluate the network config file instead of using cached results.")
+@click.option("--timeout",
+              type=float,
+              default=None,
+              help="Seconds to wait for each remote host. Default is PEER_PROBE_TIMEOUT from the network config or 3")
+@click.option("--no-cache",
+              is_flag=True,
+              default=False,
+              help="Probe every peer again instead of using recently cached results.")
+@click.argument("peers", nargs=-1)
+def peers(network, no_config_cache, timeout, no_cache, peers):
+    """Check which PEERS (default all of the network) can be reached
+    right now, probing them concurrently.
+
+    Exits with 1 if any of them can't be reached.
+
+    """
+
+    if network is None:
+        network = DEFAULT_NETWORK_PATH
+
+    network_config_d = read_network_config(
+        Path(osp.expanduser(osp.expandvars(network))),
+        use_cache=not no_config_cache,
+    )
+
+    network = Network.from_config(network_config_d)
+
+    try:
+        probe_peers = [network.get_peer(peer_spec) for peer_spec in peers]
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+
+    reachability = network.probe_reachability(
+        probe_peers if len(probe_peers) > 0 else None,
+        timeout=timeout,
+        use_cache=not no_cache,
+    )
+
+    width = max(len(name) for name in reachability)
+
+    for name, peer_reach in reachability.items():
+
+        rtt = '' if peer_reach.rtt is None else f"  {peer_reach.rtt * 1e3:.1f} ms"
+
+        print(f"{name:<{width}}  {'up' if peer_reach.reachable else 'DOWN':<4}  "
+              f"{peer_reach.reason}{rtt}")
+
+    if not all(peer_reach.reachable for peer_reach in reachability.values()):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,36 +1,644 @@
 import dataclasses as dc
+import re
+import sys
+from functools import lru_cache
 from pathlib import Path
 from enum import Enum
 import platform
+from types import MappingProxyType
 from typing import (
     Optional,
     Union,
     Tuple,
+    List,
     Callable,
     Mapping,
     Any,
+    TYPE_CHECKING,
 )
 
-from invoke import Context
-import fabric as fab
-
 from .network import (
     Network,
     Peer,
+    index_peers,
 )
+from .profiling import span
 from .sync import (
     SyncProtocol,
     SyncSpec,
+    SyncResult,
+    ScanPool,
+)
+from .util import (
+    template_vars,
+    expand_vars,
 )
 
+if TYPE_CHECKING:
+    from invoke import Context
+
 __all__ = [
     'WorkingSet',
+    'WorkingSetMatcher',
     'Replica',
     'Image',
 ]
 
 
-@dc.dataclass
+UNANCHORED_PREFIX = '(?:.*/)?'
+"""Prefix of the regexes for patterns which can match starting at any
+path component."""
+
+def rsync_pattern_regex(pattern):
+    """Translate an rsync include/exclude pattern into a regex which is
+    matched against the full path (relative to the transfer root, without
+    a leading or trailing slash).
+
+    Parameters
+    ----------
+
+    pattern : str
+
+    Returns
+    -------
+
+    regex : str
+
+    dir_only : bool
+        Whether the pattern only matches directories (i.e. had a
+        trailing slash).
+
+    """
+
+    dir_only = pattern.endswith('/') and not pattern.endswith('***')
+    pattern = pattern.rstrip('/') if dir_only else pattern
+
+    anchored = pattern.startswith('/')
+    pattern = pattern.lstrip('/')
+
+    # a trailing '/***' matches the directory and everything in it
+    subtree = pattern.endswith('/***')
+    if subtree:
+        pattern = pattern[:-len('/***')]
+
+    regex = []
+    idx = 0
+    while idx < len(pattern):
+
+        char = pattern[idx]
+
+        if pattern.startswith('**', idx):
+            regex.append('.*')
+            idx += 2
+
+            # three or more stars are the same as two
+            while idx < len(pattern) and pattern[idx] == '*':
+                idx += 1
+
+            continue
+
+        elif char == '*':
+            regex.append('[^/]*')
+
+        elif char == '?':
+            regex.append('[^/]')
+
+        elif char == '[':
+
+            end = pattern.find(']', idx + 2)
+
+            if end < 0:
+                regex.append(re.escape(char))
+
+            else:
+                char_class = pattern[idx + 1:end].replace('\\', '\\\\')
+
+                if char_class.startswith('!'):
+                    char_class = '^' + char_class[1:]
+
+                regex.append(f'[{char_class}]')
+                idx = end
+
+        elif char == '\\' and idx + 1 < len(pattern):
+            regex.append(re.escape(pattern[idx + 1]))
+            idx += 1
+
+        else:
+            regex.append(re.escape(char))
+
+        idx += 1
+
+    regex = ''.join(regex)
+
+    if subtree:
+        regex += '(?:/.*)?'
+
+    # patterns with a slash (or '**') match against the end of the full
+    # path, otherwise just the final component, either way a match
+    # must start at the beginning of a component
+    if not anchored:
+        regex = UNANCHORED_PREFIX + regex
+
+    return regex, dir_only
+
+def normalize_pattern(pattern):
+    """Normalize an rsync pattern so that equivalent ones can be
+    compared, returns None for empty patterns."""
+
+    pattern = pattern.strip()
+
+    # repeated slashes and leading './' don't mean anything to rsync
+    pattern = re.sub(r'/{2,}', '/', pattern)
+
+    while pattern.startswith('./'):
+        pattern = pattern[2:]
+
+    if pattern in ('', '/'):
+        return None
+
+    return pattern
+
+def is_catch_all(pattern):
+    """Whether a (normalized) pattern matches every path, so that no
+    rules after it can ever apply.
+
+    Anchored patterns like '/*' only match at the top of the transfer
+    and aren't catch-alls.
+
+    """
+
+    return pattern in ('*', '**', '***')
+
+def parent_patterns(pattern):
+    """Get the include patterns for the parent directories of a pattern
+    that rsync needs to descend into in order to reach what the pattern
+    matches, e.g. 'a/b/*.txt' needs 'a/' and 'a/b/'.
+
+    Parents after a '**' component can be at any depth and aren't
+    given.
+
+    """
+
+    anchored = pattern.startswith('/')
+    components = pattern.strip('/').split('/')
+
+    # the subtree marker is part of the last directory
+    if components[-1] == '***':
+        components = components[:-1]
+
+    parents = []
+    for idx in range(1, len(components)):
+
+        if '**' in components[idx - 1]:
+            break
+
+        parent = '/'.join(components[:idx]) + '/'
+        parents.append('/' + parent if anchored else parent)
+
+    return parents
+
+@lru_cache(maxsize=None)
+def compile_filter_rules(includes, excludes):
+    """Compile the include and exclude patterns of a working set into
+    an equivalent but minimal list of rsync filter rules.
+
+    The includes are applied before the excludes (as when they are given
+    as options) and the rules are:
+
+    - normalized and deduplicated, only the first rule for a pattern
+      can ever match,
+    - cut off after the first rule which matches everything,
+    - preceded by includes for the parent directories of include
+      patterns which are inside directories, which rsync otherwise
+      won't descend into when they are excluded,
+    - without includes at all if nothing is excluded, since everything
+      is included by default.
+
+    Parameters
+    ----------
+
+    includes : tuple of str
+
+    excludes : tuple of str
+
+    Returns
+    -------
+
+    rules : tuple of (bool, str)
+        Whether each rule is an include and its pattern, in order.
+
+    """
+
+    # '...' includes everything or excludes everything
+    if includes is Ellipsis:
+        includes = ()
+
+    if excludes is Ellipsis:
+        excludes = ('*',)
+
+    rules = []
+    seen = set()
+
+    def _add(include, pattern):
+
+        pattern = normalize_pattern(pattern)
+
+        if pattern is None or pattern in seen:
+            return
+
+        seen.add(pattern)
+        rules.append((include, pattern))
+
+    for pattern in includes:
+
+        pattern = normalize_pattern(pattern)
+
+        if pattern is None:
+            continue
+
+        for parent in parent_patterns(pattern):
+            _add(True, parent)
+
+        _add(True, pattern)
+
+    for pattern in excludes:
+        _add(False, pattern)
+
+    # nothing after a catch-all is ever used
+    for idx, (_, pattern) in enumerate(rules):
+        if is_catch_all(pattern):
+            rules = rules[:idx + 1]
+            break
+
+    if all(include for include, _ in rules):
+        return ()
+
+    return tuple(rules)
+
+def render_filter_rules(rules):
+    """Render filter rules in the syntax of an rsync merge file."""
+
+    return ''.join(f"{'+' if include else '-'} {pattern}\n"
+                   for include, pattern in rules)
+
+REPLICA_METADATA_FILTER_RULES = (
+    'P /.refugue/',
+    '- /.refugue/',
+)
+"""Filter rules which come before the rules of the working set in every
+sync so that the files refugue keeps in the top of a replica (e.g.
+manifests stored in it) are neither transferred nor deleted, even when
+pruning."""
+
+def render_sync_filter(rules):
+    """Render the merge file for a sync: the replica metadata rules and
+    then the compiled filter rules of the working set."""
+
+    metadata_text = ''.join(f"{rule}\n" for rule in REPLICA_METADATA_FILTER_RULES)
+
+    return metadata_text + render_filter_rules(rules)
+
+@lru_cache(maxsize=None)
+def compile_rule_regexes(rules):
+    """Compile ordered filter rules of (include, pattern) for matching
+    paths with Python regexes."""
+
+    compiled = []
+    for include, pattern in rules:
+
+        regex, dir_only = rsync_pattern_regex(pattern)
+        compiled.append((re.compile(regex, re.DOTALL), dir_only, include))
+
+    return tuple(compiled)
+
+_WILDCARD_CHARS = frozenset('*?[\\')
+
+def _combine_regexes(rules):
+    """Combine (rule index, regex) into one regex where the first rule
+    to match is the name of the group that matched ('r<index>')."""
+
+    if len(rules) == 0:
+        return None
+
+    # alternatives are tried in order
+    return re.compile(
+        '|'.join(f"(?P<r{idx}>{regex})" for idx, regex in rules),
+        re.DOTALL,
+    )
+
+class _RuleTrie():
+    """Regexes of rules by the literal path components they start with.
+
+    A rule can only match starting at some component of a path if the
+    path continues with its literal leading components, so only the
+    rules along one branch of the trie need to be tried.
+
+    """
+
+    __slots__ = ('children', 'rules', 'dir_regex', 'file_regex',)
+
+    def __init__(self):
+
+        self.children = {}
+
+        # rule index, regex, dir only
+        self.rules = []
+
+        self.dir_regex = None
+        self.file_regex = None
+
+    def add(self, components, rule):
+
+        node = self
+        for component in components:
+            node = node.children.setdefault(component, _RuleTrie())
+
+        node.rules.append(rule)
+
+    def compile(self):
+
+        self.dir_regex = _combine_regexes(
+            [(idx, regex) for idx, regex, _ in self.rules])
+
+        self.file_regex = _combine_regexes(
+            [(idx, regex) for idx, regex, dir_only in self.rules if not dir_only])
+
+        for child in self.children.values():
+            child.compile()
+
+    def first_rule(self, path, components, component_idx, pos, is_dir, first):
+        """Get the first rule matching the path from the component at
+        position pos, or first if it is earlier."""
+
+        node = self
+        while node is not None:
+
+            regex = node.dir_regex if is_dir else node.file_regex
+
+            if regex is not None:
+
+                match = regex.fullmatch(path, pos)
+
+                if match is not None:
+
+                    idx = int(match.lastgroup[1:])
+
+                    if first is None or idx < first:
+                        first = idx
+
+            if component_idx >= len(components):
+                break
+
+            node = node.children.get(components[component_idx])
+            component_idx += 1
+
+        return first
+
+class WorkingSetMatcher():
+    """Matches paths against compiled filter rules with rsync semantics
+    (first matching rule wins, everything is included by default).
+
+    Rules for literal names and paths (e.g. 'node_modules', '/lab/' or
+    'lab/projects/***') are looked up by path component in an index. The
+    other rules are put in tries by their literal leading components,
+    one for anchored rules which are only tried from the start of paths
+    and one for the rest which are tried from every component, and
+    each node combines its rules into a single regex. The earliest rule
+    matched by any of these is the one that applies.
+
+    """
+
+    def __init__(self, rules):
+
+        self.rules = tuple(rules)
+
+        # rule index, literal components, anchored, dir only for
+        # literals which match paths ending in them by last component
+        self._literals = {}
+
+        # the same for literal subtrees ('dir/***') by their last
+        # component, these match any path below them as well
+        self._subtrees = {}
+
+        self._anchored = _RuleTrie()
+        self._unanchored = _RuleTrie()
+
+        for idx, (include, pattern) in enumerate(self.rules):
+
+            regex, dir_only = rsync_pattern_regex(pattern)
+
+            literal = pattern.rstrip('/')
+            subtree = literal.endswith('/***')
+            if subtree:
+                literal = literal[:-len('/***')]
+
+            anchored = literal.startswith('/')
+            components = tuple(literal.lstrip('/').split('/'))
+
+            if (len(_WILDCARD_CHARS.intersection(literal)) == 0 and
+                '' not in components):
+
+                index = self._subtrees if subtree else self._literals
+                index.setdefault(components[-1], []).append(
+                    (idx, components, anchored, dir_only)
+                )
+                continue
+
+            # the literal components the pattern starts with
+            prefix = []
+            for component in pattern.lstrip('/').split('/'):
+
+                if len(_WILDCARD_CHARS.intersection(component)) > 0:
+                    break
+
+                prefix.append(component)
+
+            if regex.startswith(UNANCHORED_PREFIX):
+                self._unanchored.add(prefix, (idx, regex[len(UNANCHORED_PREFIX):], dir_only))
+            else:
+                self._anchored.add(prefix, (idx, regex, dir_only))
+
+        self._anchored.compile()
+        self._unanchored.compile()
+
+    def _first_rule(self, components, path, is_dir):
+        """Get the index of the first rule matching the path, or None."""
+
+        first = self._anchored.first_rule(path, components, 0, 0, is_dir, None)
+
+        # a rule matches if it does from any component and the first
+        # rule to match is the earliest of those from each component
+        pos = 0
+        for component_idx, component in enumerate(components):
+
+            first = self._unanchored.first_rule(path, components, component_idx,
+                                                pos, is_dir, first)
+
+            pos += len(component) + 1
+
+        n_components = len(components)
+
+        for idx, literal, anchored, dir_only in self._literals.get(components[-1], ()):
+
+            if first is not None and idx >= first:
+                break
+
+            if dir_only and not is_dir:
+                continue
+
+            if _ends_with(components, n_components, literal, anchored):
+                first = idx
+                break
+
+        if len(self._subtrees) > 0:
+            for end in range(1, n_components + 1):
+
+                for idx, literal, anchored, dir_only in self._subtrees.get(components[end - 1], ()):
+
+                    if first is not None and idx >= first:
+                        break
+
+                    if _ends_with(components, end, literal, anchored):
+                        first = idx
+                        break
+
+        return first
+
+    def match(self, path, is_dir=False):
+        """Test whether the rules include this path (not considering its
+        parent directories)."""
+
+        path = str(path).strip('/')
+
+        idx = self._first_rule(path.split('/'), path, is_dir)
+
+        if idx is None:
+            return True
+
+        return self.rules[idx][0]
+
+    def filter_paths(self, paths):
+        """Filter a listing of paths, including a path only if all of its
+        parent directories are included as well, like rsync does when
+        it walks a tree.
+
+        Decisions for directories are kept in a trie of path components
+        so that everything below an excluded directory is pruned
+        without evaluating any rules and each directory is only
+        evaluated once.
+
+        Parameters
+        ----------
+
+        paths : iterable of (str, bool)
+            The paths and whether they are directories, in any order.
+
+        Yields
+        ------
+
+        path : str
+
+        is_dir : bool
+
+        """
+
+        # component : (included, children)
+        trie = {}
+
+        for path, is_dir in paths:
+
+            path = str(path).strip('/')
+            components = path.split('/')
+
+            node = trie
+            included = True
+            for end in range(1, len(components)):
+
+                entry = node.get(components[end - 1])
+
+                if entry is None:
+                    entry = (
+                        self.match('/'.join(components[:end]), is_dir=True),
+                        {},
+                    )
+                    node[components[end - 1]] = entry
+
+                if not entry[0]:
+                    included = False
+                    break
+
+                node = entry[1]
+
+            if not included:
+                continue
+
+            if is_dir:
+
+                entry = node.get(components[-1])
+
+                if entry is None:
+                    entry = (self.match(path, is_dir=True), {})
+                    node[components[-1]] = entry
+
+                included = entry[0]
+
+            else:
+                included = self.match(path, is_dir=False)
+
+            if included:
+                yield path, is_dir
+
+def _ends_with(components, end, literal, anchored):
+    """Whether components[:end] ends with (or is, when anchored) the
+    literal components."""
+
+    start = end - len(literal)
+
+    if start < 0 or (anchored and start != 0):
+        return False
+
+    return tuple(components[start:end]) == literal
+
+@lru_cache(maxsize=None)
+def working_set_matcher(rules):
+    """Get the (cached) matcher for compiled filter rules."""
+
+    return WorkingSetMatcher(rules)
+
+def _compile_rules(includes, excludes):
+    """Compile the rules of a working set in the order rsync applies
+    them (includes then excludes)."""
+
+    return compile_rule_regexes(
+        tuple((True, pattern) for pattern in includes) +
+        tuple((False, pattern) for pattern in excludes)
+    )
+
+def _freeze_patterns(patterns, pattern_cache=None):
+    """Get a list of patterns as a tuple.
+
+    Generated configs usually share the same lists of patterns between
+    many replicas, so with a cache each distinct list object is only
+    copied once. The cache holds on to the lists so their ids aren't
+    reused.
+
+    """
+
+    if isinstance(patterns, tuple):
+        return patterns
+
+    if pattern_cache is None:
+        return tuple(patterns)
+
+    cached = pattern_cache.get(id(patterns))
+
+    if cached is None or cached[0] is not patterns:
+        cached = (patterns, tuple(patterns))
+        pattern_cache[id(patterns)] = cached
+
+    return cached[1]
+
+@dc.dataclass(frozen=True)
 class WorkingSet():
 
     includes: Union[ Tuple[str], type(Ellipsis) ]
@@ -41,7 +649,7 @@ class WorkingSet():
     #     pass
 
     @classmethod
-    def from_config(cls, config, peer, refinement):
+    def from_config(cls, config, peer, refinement, pattern_cache=None):
         """Generate the working set for the replica spec given the configuration.
 
         Parameters
@@ -53,6 +661,10 @@ class WorkingSet():
 
         refinement : str
 
+        pattern_cache : dict or None
+            Shared between calls for the same config so that pattern
+            lists used by many replicas are only converted once.
+
         Returns
         -------
 
@@ -92,12 +704,49 @@ class WorkingSet():
 
 
         wset = WorkingSet(
-            includes = includes,
-            excludes = excludes,
+            includes = _freeze_patterns(includes, pattern_cache),
+            excludes = _freeze_patterns(excludes, pattern_cache),
         )
         return wset
 
-@dc.dataclass
+    def contains(self, path, is_dir=False):
+        """Test whether a path is in the working set, i.e. it isn't
+        excluded by the filters.
+
+        The compiled filter rules (see filter_rules) are evaluated like
+        rsync does (first matching rule wins) but only against this path
+        and not its parent directories, which when excluded exclude
+        everything inside of them as well.
+
+        Parameters
+        ----------
+
+        path : str
+            Path relative to the root of the replica.
+
+        is_dir : bool
+
+        Returns
+        -------
+
+        contained : bool
+
+        """
+
+        return self.matcher().match(path, is_dir)
+
+    def matcher(self):
+        """Get the matcher for the working set's filter rules."""
+
+        return working_set_matcher(self.filter_rules())
+
+    def filter_rules(self):
+        """Get the compiled rsync filter rules for the working set, see
+        compile_filter_rules."""
+
+        return compile_filter_rules(self.includes, self.excludes)
+
+@dc.dataclass(frozen=True)
 class Replica():
 
     peer: Peer
@@ -202,7 +851,9 @@ class Replica():
 
         config : dict
 
-        peers : list of Peer obj.
+        peers : list of Peer obj. or mapping of str : Peer
+            A mapping is used as a peer index by name and alias
+            (see network.index_peers).
 
         Returns
         -------
@@ -211,6 +862,14 @@ class Replica():
 
         """
 
+        if isinstance(peers, Mapping):
+            peer_index = peers
+        else:
+            peer_index = index_peers(peers)
+
+        # the pattern lists are usually shared between replicas
+        pattern_cache = {}
+
         replicas = []
         for replica_spec in config['REPLICAS']:
 
@@ -218,8 +877,10 @@ class Replica():
 
             replica_peer_spec, refinement = cls.normalize_replica(config, replica_spec)
 
-            peer = [peer for peer in peers
-                    if peer.name == replica_peer_spec][0]
+            try:
+                peer = peer_index[replica_peer_spec]
+            except KeyError:
+                raise ValueError(f"Unknown peer for replica: {replica_spec}")
 
             # get the path prefix for this replica on the peer
             prefix_path = cls.resolve_replica_prefix(config, peer, refinement)
@@ -230,6 +891,7 @@ class Replica():
                 config,
                 peer,
                 refinement,
+                pattern_cache=pattern_cache,
             )
 
             replica = Replica(
@@ -253,6 +915,37 @@ class Image():
     # TODO: make this more precise
     image_config: Any
 
+    replica_index: Mapping[Tuple[str, str], Replica] = dc.field(init=False, repr=False)
+    """Replicas by the name of their peer and their refinement"""
+
+    peer_replicas: Mapping[str, Tuple[Replica]] = dc.field(init=False, repr=False)
+    """The replicas on each peer by peer name"""
+
+    scan_pool: ScanPool = dc.field(default_factory=ScanPool, repr=False)
+    """Scans of replicas shared by the syncs planned from this image."""
+
+    def __post_init__(self):
+
+        self.replicas = tuple(self.replicas)
+
+        replica_index = {}
+        peer_replicas = {}
+        for replica in self.replicas:
+
+            key = (replica.peer.name, replica.refinement)
+
+            if key in replica_index:
+                raise ValueError(f"Replica given more than once: {'/'.join(key)}")
+
+            replica_index[key] = replica
+            peer_replicas.setdefault(replica.peer.name, []).append(replica)
+
+        self.replica_index = MappingProxyType(replica_index)
+        self.peer_replicas = MappingProxyType(
+            {peer_name : tuple(replicas)
+             for peer_name, replicas in peer_replicas.items()}
+        )
+
     @classmethod
     def from_config(cls, image_config, network):
         """Generate an Image object from a configuration file.
@@ -271,7 +964,7 @@ class Image():
 
         """
 
-        replicas = Replica.from_config(image_config, network.peers)
+        replicas = Replica.from_config(image_config, network.peer_index)
 
         image = Image(
             network = network,
@@ -294,44 +987,206 @@ class Image():
 
 
     def get_replica(self, replica_spec):
-        """Get a replica by a string name."""
+        """Get a replica by a string name.
+
+        The peer part of the name can be any of the peer's aliases.
+
+        """
 
         # normalize and parse
         peer_spec, refinement_spec = Replica.normalize_replica(self.image_config, replica_spec)
 
-        for replica in self.replicas:
+        peer = self.network.peer_index.get(peer_spec, None)
+
+        if peer is None:
+            return None
+
+        return self.replica_index.get((peer.name, refinement_spec), None)
 
-            if (peer_spec == replica.peer.name and
-                refinement_spec == replica.refinement):
+    def get_peer_replicas(self, peer_spec):
+        """Get all of the replicas on a peer given its name or alias."""
 
-                return replica
+        peer = self.network.get_peer(peer_spec)
+
+        return self.peer_replicas.get(peer.name, ())
 
     def resolve_replica_path(self,
                              local_cx,
                              replica,
     ):
+        """Get the fully expanded path to the replica on its peer.
 
-        replica_cx = self.network.resolve_peer_context(local_cx, replica.peer)
-        peer_mount_prefix = self.network.resolve_peer_mount(replica_cx, replica.peer)
+        Variables in the path templates are expanded with a snapshot of
+        the peer's environment (see Network.resolve_peer_env) instead of
+        by the peer's shell, so this usually doesn't need to contact the
+        peer.
 
+        Parameters
+        ----------
 
-        # combine the mount prefix with the replica's path prefix
+        local_cx : Context
 
-        # if there is no peer mount prefix leave it out of the template
-        if peer_mount_prefix is None:
+        replica : Replica
 
-            replica_path = f"{replica.prefix}"
+        Returns
+        -------
+
+        replica_path : str
+
+        """
+
+        with span('image.resolve_replica_path',
+                  peer=replica.peer.name, refinement=replica.refinement):
+
+            # the context isn't needed to resolve the mount from the config
+            peer_mount_prefix = self.network.resolve_peer_mount(None, replica.peer)
 
-        else:
-            replica_path = f"{peer_mount_prefix}/{replica.prefix}"
 
+            # combine the mount prefix with the replica's path prefix
 
-        # fully expand the replica prefix if it has variables and such
-        # by using the replica's context
-        replica_path = replica_cx.run(f'echo "{replica_path}"', hide='out', pty=True).stdout.strip()
+            # if there is no peer mount prefix leave it out of the template
+            if peer_mount_prefix is None:
+
+                replica_path = f"{replica.prefix}"
+
+            else:
+                replica_path = f"{peer_mount_prefix}/{replica.prefix}"
+
+
+            # fully expand the replica prefix if it has variables and such
+            # using the environment of the replica's peer
+            peer_env = self.network.resolve_peer_env(
+                local_cx,
+                replica.peer,
+                var_names=template_vars(replica_path),
+            )
+
+            replica_path = expand_vars(replica_path, peer_env).strip()
 
         return replica_path
 
+    def replica_manifest_path(self,
+                              local_cx,
+                              replica,
+                              location: str = 'cache',
+    ) -> Path:
+        """Get the directory the manifest of a replica is stored in.
+
+        Parameters
+        ----------
+
+        local_cx : Context
+
+        replica : Replica
+
+        location : str
+            Either 'cache' to keep it in the local refugue cache or
+            'replica' to keep it in the root of the replica itself, which
+            is only possible for replicas on the local peer.
+
+        Returns
+        -------
+
+        manifest_path : Path
+
+        """
+
+        from .manifest import manifest_dir, REPLICA_MANIFEST_DIR
+        from .network import LocalConnection
+
+        if location == 'cache':
+            return manifest_dir(replica.peer.name, replica.refinement)
+
+        elif location == 'replica':
+
+            conn = self.network.resolve_peer_connection(replica.peer)
+
+            if not isinstance(conn, LocalConnection):
+                raise ValueError(
+                    f"Manifests can only be stored in local replicas: "
+                    f"{replica.peer.name}/{replica.refinement}")
+
+            return Path(self.resolve_replica_path(local_cx, replica)) / REPLICA_MANIFEST_DIR
+
+        else:
+            raise ValueError(f"Unknown manifest location: {location}")
+
+    def load_manifest(self,
+                      local_cx,
+                      replica,
+                      location: str = 'cache',
+    ):
+        """Get the last manifest recorded for a replica without scanning
+        it, None if there isn't one."""
+
+        from .manifest import Manifest
+
+        return Manifest.load(self.replica_manifest_path(local_cx, replica, location))
+
+    def refresh_manifest(self,
+                         local_cx,
+                         replica,
+                         location: str = 'cache',
+                         restat: bool = True,
+                         hash: bool = False,
+    ):
+        """Scan a replica and update its manifest.
+
+        Replicas on the local peer are scanned incrementally, for remote
+        peers the replica is listed over the connection.
+
+        Parameters
+        ----------
+
+        local_cx : Context
+
+        replica : Replica
+
+        location : str
+            See replica_manifest_path
+
+        restat : bool
+            See manifest.scan_local_manifest
+
+        hash : bool
+            Compute content hashes, only for local replicas.
+
+        Returns
+        -------
+
+        manifest : Manifest
+
+        """
+
+        from .manifest import scan_local_manifest, scan_context_manifest
+        from .network import LocalConnection
+
+        manifest_path = self.replica_manifest_path(local_cx, replica, location)
+        replica_path = self.resolve_replica_path(local_cx, replica)
+
+        conn = self.network.resolve_peer_connection(replica.peer)
+
+        if isinstance(conn, LocalConnection):
+
+            return scan_local_manifest(
+                replica_path,
+                manifest_path,
+                wset=replica.wset,
+                restat=restat,
+                hash=hash,
+            )
+
+        else:
+
+            peer_cx = self.network.resolve_peer_context(local_cx, replica.peer)
+
+            return scan_context_manifest(
+                peer_cx,
+                replica_path,
+                manifest_path,
+                wset=replica.wset,
+            )
+
     def pair(self,
              local_cx,
              sync_spec,
@@ -354,6 +1209,177 @@ class Image():
 
         return sync_pair
 
+    def fan_out(self,
+                local_cx,
+                sync_specs,
+                subtree,
+                src,
+                targets,
+    ) -> List['SyncPair']:
+        """Make sync pairs from one source replica to many targets.
+
+        Parameters
+        ----------
+
+        local_cx : Context
+
+        sync_specs : SyncSpec or list of SyncSpec
+            Either one for all the pairs or one for each target.
+
+        subtree : Path or None
+
+        src : str
+            Replica spec of the source.
+
+        targets : list of str
+            Replica specs of the targets.
+
+        Returns
+        -------
+
+        sync_pairs : list of SyncPair
+
+        """
+
+        if isinstance(sync_specs, SyncSpec):
+            sync_specs = [sync_specs for _ in targets]
+
+        return [self.pair(local_cx, sync_spec, subtree, src, target)
+                for sync_spec, target in zip(sync_specs, targets)]
+
+    def relay(self,
+              local_cx,
+              sync_specs,
+              subtree,
+              src,
+              targets,
+              rtts: Optional[Mapping[str, float]] = None,
+    ) -> Tuple[List['SyncPair'], List[Optional[int]]]:
+        """Make sync pairs which distribute a source replica to many
+        targets along a spanning tree of the links between their peers,
+        so that data crosses a slow link once and is relayed onwards
+        from the other side.
+
+        A target can be synced from another target instead of the
+        source if it has the same working set and sync spec (and it
+        isn't a dry run), and for two remote peers only if the link
+        between them is declared in 'PEER_LINKS' of the network
+        config. Links are compared by their class (see
+        Network.classify_link) and then by the measured round trip
+        times.
+
+        Parameters
+        ----------
+
+        local_cx : Context
+
+        sync_specs : SyncSpec or list of SyncSpec
+            Either one for all the pairs or one for each target.
+
+        subtree : Path or None
+
+        src : str
+            Replica spec of the source.
+
+        targets : list of str
+            Replica specs of the targets.
+
+        rtts : dict of str : float, optional
+            Measured round trip times to peers by name, e.g. from
+            Network.probe_reachability.
+
+        Returns
+        -------
+
+        sync_pairs : list of SyncPair
+            One for each target, from the replica it is synced from.
+
+        parents : list of int or None
+            For each target the index of the target it is synced from,
+            None for the source.
+
+        """
+
+        from .network import (
+            LINK_CLASSES,
+            LocalConnection,
+        )
+
+        if isinstance(sync_specs, SyncSpec):
+            sync_specs = [sync_specs for _ in targets]
+
+        if rtts is None:
+            rtts = {}
+
+        replicas = [self.get_replica(spec) for spec in [src] + list(targets)]
+
+        local = [issubclass(type(self.network.resolve_peer_connection(replica.peer)),
+                            LocalConnection)
+                 for replica in replicas]
+
+        def _cost(parent_idx, child_idx):
+
+            parent = replicas[parent_idx]
+            child = replicas[child_idx]
+
+            if parent_idx != 0:
+
+                parent_spec = sync_specs[parent_idx - 1]
+
+                # a dry run doesn't update the parent
+                if parent_spec.transport_pol.dry:
+                    return None
+
+                # the child gets what the parent ended up with, which
+                # is only the same as from the source when synced the
+                # same way
+                if parent_spec != sync_specs[child_idx - 1]:
+                    return None
+
+                # everything the child gets has to be in the parent
+                if (parent.wset.includes != child.wset.includes or
+                    parent.wset.excludes != child.wset.excludes):
+                    return None
+
+                # otherwise the parent can't be known to reach the child
+                if (not local[parent_idx] and not local[child_idx] and
+                    self.network.declared_peer_link(parent.peer, child.peer) is None):
+                    return None
+
+            link = self.network.classify_link(parent.peer, child.peer)
+
+            if self.network.declared_peer_link(parent.peer, child.peer) is not None:
+                rtt = 0.0
+            else:
+                rtt = max((rtts.get(replica.peer.name) or 0.0
+                           for replica, is_local in ((parent, local[parent_idx]),
+                                                     (child, local[child_idx]))
+                           if not is_local),
+                          default=0.0)
+
+            return (LINK_CLASSES.index(link), rtt)
+
+        with span('image.relay_tree', targets=len(targets)):
+            tree = relay_tree(len(replicas), _cost)
+
+        sync_pairs = [
+            SyncPair(
+                image = self,
+                src = replicas[parent_idx],
+                target = replicas[child_idx],
+                sync_spec = sync_spec,
+                subtree = subtree,
+            )
+            for child_idx, (parent_idx, sync_spec)
+            in enumerate(zip(tree[1:], sync_specs), start=1)
+        ]
+
+        # indices of the targets
+        parents = [None if parent_idx == 0 else parent_idx - 1
+                   for parent_idx in tree[1:]]
+
+        return sync_pairs, parents
+
 
 @dc.dataclass
 class SyncPair():
@@ -365,22 +1391,331 @@ class SyncPair():
     sync_spec: SyncSpec
 
     def sync(self,
-             local_cx: Context,
+             local_cx: 'Context',
              sync_protocol: SyncProtocol,
     ):
         """Perform the sync specified by this SyncPair choosing a protocol to
-        do it over, e.g. rsync"""
+        do it over, e.g. rsync
+
+        Returns
+        -------
+
+        sync_func : callable
+            Called with the local, source, and target contexts it
+            executes the sync and returns a SyncResult.
+
+        confirm_message : str
+
+        """
 
         # TODO: consider the subpath
 
         # generate the function
-        sync_func, confirm_message = sync_protocol.gen_sync_func(
-            local_cx,
-            self.image,
-            self.src,
-            self.target,
-            self.sync_spec,
-            subtree = self.subtree,
-        )
+        with span('sync.plan', protocol=sync_protocol.__name__):
+            sync_func, confirm_message = sync_protocol.gen_sync_func(
+                local_cx,
+                self.image,
+                self.src,
+                self.target,
+                self.sync_spec,
+                subtree = self.subtree,
+            )
         # return them
         return sync_func, confirm_message
+
+    @property
+    def label(self) -> str:
+        """The target replica as 'peer/refinement'."""
+
+        return f"{self.target.peer.name}/{self.target.refinement}"
+
+    def execute(self,
+                local_cx: 'Context',
+                sync_func,
+    ) -> SyncResult:
+        """Run the sync function made by 'sync' in the contexts of the
+        peers.
+
+        Parameters
+        ----------
+
+        local_cx : Context
+
+        sync_func : callable
+
+        Returns
+        -------
+
+        result : SyncResult
+
+        """
+
+        network = self.image.network
+
+        src_cx = network.resolve_peer_context(local_cx, self.src.peer)
+        target_cx = network.resolve_peer_context(local_cx, self.target.peer)
+
+        return sync_func(local_cx, src_cx, target_cx)
+
+def relay_tree(n_nodes: int,
+               edge_cost: Callable[[int, int], Any],
+) -> List[Optional[int]]:
+    """Find the spanning tree rooted at the first node with the cheapest
+    edges (Prim's algorithm).
+
+    Of equally cheap edges the one found first is used, so nodes are
+    attached as close to the root as they can be.
+
+    Parameters
+    ----------
+
+    n_nodes : int
+
+    edge_cost : callable
+        Called with the indices of the parent and child nodes, returns
+        the comparable cost of the edge or None if there isn't one. The
+        root must have an edge to every node.
+
+    Returns
+    -------
+
+    parents : list of int or None
+        The parent of each node, None for the root.
+
+    """
+
+    parents = [None for _ in range(n_nodes)]
+
+    # the cheapest known edge into each node not in the tree yet
+    best = {}
+    for node in range(1, n_nodes):
+
+        cost = edge_cost(0, node)
+
+        if cost is None:
+            raise ValueError(f"No edge from the root to node {node}")
+
+        best[node] = (cost, 0)
+
+    while len(best) > 0:
+
+        node = min(best, key=lambda node: (best[node][0], node))
+        _, parents[node] = best.pop(node)
+
+        for other in best:
+
+            cost = edge_cost(node, other)
+
+            if cost is not None and cost < best[other][0]:
+                best[other] = (cost, node)
+
+    return parents
+
+def plan_sync_pairs(local_cx: 'Context',
+                    sync_pairs: List[SyncPair],
+                    sync_protocols,
+):
+    """Generate the sync functions for the pairs of a fan out.
+
+    Pairs which their protocol can batch together (see
+    SyncProtocol.batch_key) are planned together when there is more
+    than one of them and the others on their own. The first pair of a
+    batch comes first in the order of the pairs so run_sync_pairs starts
+    it before the others.
+
+    Parameters
+    ----------
+
+    local_cx : Context
+
+    sync_pairs : list of SyncPair
+
+    sync_protocols : list of SyncProtocol subclasses
+        The protocol to use for each pair.
+
+    Returns
+    -------
+
+    planned : list of (callable, str)
+        The sync function and confirmation message of each pair.
+
+    """
+
+    batches = {}
+    for idx, (sync_pair, sync_protocol) in enumerate(zip(sync_pairs, sync_protocols)):
+
+        key = sync_protocol.batch_key(sync_pair.image, sync_pair)
+
+        if key is not None:
+            batches.setdefault((sync_protocol, key), []).append(idx)
+
+    planned = [None for _ in sync_pairs]
+
+    for (sync_protocol, _), idxs in batches.items():
+
+        if len(idxs) < 2:
+            continue
+
+        first = sync_pairs[idxs[0]]
+
+        with span('sync.plan_batch', protocol=sync_protocol.__name__, targets=len(idxs)):
+            batch_planned = sync_protocol.gen_batch_sync_funcs(
+                local_cx,
+                first.image,
+                first.src,
+                [sync_pairs[idx].target for idx in idxs],
+                first.sync_spec,
+                subtree = first.subtree,
+            )
+
+        for idx, sync_planned in zip(idxs, batch_planned):
+            planned[idx] = sync_planned
+
+    for idx, (sync_pair, sync_protocol) in enumerate(zip(sync_pairs, sync_protocols)):
+
+        if planned[idx] is None:
+            planned[idx] = sync_pair.sync(local_cx, sync_protocol)
+
+    return planned
+
+DEFAULT_FAN_OUT_JOBS = 4
+"""Default maximum number of targets synced to at once."""
+
+SYNC_ERROR_EXIT_CODE = 1
+"""Exit code of a sync which failed with an error instead of the exit
+code of a process."""
+
+def _error_exit_code(err) -> int:
+    """The exit code to report for an error raised by a sync."""
+
+    # RefugueSyncError
+    exit_code = getattr(err, 'exit_code', None)
+
+    # invoke.UnexpectedExit of a command run for the sync
+    if exit_code is None and hasattr(err, 'result'):
+        exit_code = getattr(err.result, 'exited', None)
+
+    if not exit_code:
+        exit_code = SYNC_ERROR_EXIT_CODE
+
+    return exit_code
+
+def run_sync_pairs(local_cx: 'Context',
+                   planned,
+                   jobs: Optional[int] = None,
+                   parents: Optional[List[Optional[int]]] = None,
+) -> List[SyncResult]:
+    """Execute the syncs of many pairs concurrently, e.g. of a fan out.
+
+    The output of each is labelled with its target (see
+    output.output_label).
+
+    Parameters
+    ----------
+
+    local_cx : Context
+
+    planned : list of (SyncPair, callable)
+        The pairs with the sync functions made for them.
+
+    jobs : int or None
+        Maximum number of syncs run at once, defaults to
+        DEFAULT_FAN_OUT_JOBS.
+
+    parents : list of int or None, optional
+        For relayed syncs (see Image.relay) the index of the pair each
+        pair has to wait for, None to start right away. Pairs whose
+        parent failed aren't synced and fail with the same exit code.
+
+    Returns
+    -------
+
+    results : list of SyncResult
+        In the order of the pairs. Syncs which raised an error fail
+        with an 'error' result instead of stopping the others.
+
+    """
+
+    from concurrent.futures import (
+        ThreadPoolExecutor,
+        wait,
+        FIRST_COMPLETED,
+    )
+    from .output import (
+        OutputAggregator,
+        output_label,
+    )
+
+    if jobs is None:
+        jobs = DEFAULT_FAN_OUT_JOBS
+
+    if parents is None:
+        parents = [None for _ in planned]
+
+    children = {}
+    for idx, parent in enumerate(parents):
+        children.setdefault(parent, []).append(idx)
+
+    def _execute(sync_pair, sync_func):
+
+        with output_label(sync_pair.label), \
+             span('sync.target', target=sync_pair.label):
+
+            try:
+                return sync_pair.execute(local_cx, sync_func)
+
+            # one target failing doesn't stop the others
+            except Exception as err:
+
+                print(f"refugue: sync to {sync_pair.label} failed: {err}",
+                      file=sys.stderr)
+
+                return SyncResult(
+                    'error',
+                    exit_code=_error_exit_code(err),
+                    dry=sync_pair.sync_spec.transport_pol.dry,
+                )
+
+    results = [None for _ in planned]
+
+    def _skip(idx, parent_idx):
+
+        sync_pair, _ = planned[idx]
+        parent_result = results[parent_idx]
+
+        OutputAggregator(sync_pair.sync_spec.transport_pol.output,
+                         label=sync_pair.label).message(
+            f"Not synced, the sync of {planned[parent_idx][0].label} failed")
+
+        results[idx] = SyncResult(
+            parent_result.protocol,
+            exit_code=parent_result.exit_code,
+            dry=parent_result.dry,
+        )
+
+        for child in children.get(idx, []):
+            _skip(child, idx)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(planned)))) as executor:
+
+        # children are started in order when their parent finishes
+        futures = {executor.submit(_execute, *planned[idx]) : idx
+                   for idx in children.get(None, [])}
+
+        while len(futures) > 0:
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+            for future in done:
+
+                idx = futures.pop(future)
+                results[idx] = future.result()
+
+                for child in children.get(idx, []):
+
+                    if results[idx].ok:
+                        futures[executor.submit(_execute, *planned[child])] = child
+                    else:
+                        _skip(child, idx)
+
+    return results
@@ -0,0 +1,896 @@
+"""File manifests for replicas.
+
+A manifest is a record of every path in a replica (after filtering by
+its working set) with its size, modification time, inode, mode and
+optionally a content hash.
+
+Manifests are stored column-wise as flat binary arrays in a directory so
+that they can be memory mapped and used without creating Python objects
+for every entry. Entries are stored in depth-first order with the
+children of each directory sorted by name, so the subtree of every
+directory is a contiguous range of entries. This means manifests can be
+written while the replica is walked and compared to each other in a
+single streaming pass.
+
+"""
+
+import os
+import os.path as osp
+import stat
+import json
+import mmap
+import time
+import shlex
+import shutil
+import hashlib
+from array import array
+from pathlib import Path
+from urllib.parse import quote
+from collections import namedtuple
+from typing import (
+    Optional,
+    Tuple,
+    Iterator,
+)
+
+from .cache import (
+    cache_dir,
+    make_tmp_dir,
+    replace_dir,
+)
+
+__all__ = [
+    'ManifestEntry',
+    'Manifest',
+    'ManifestWriter',
+    'scan_local_manifest',
+    'scan_context_manifest',
+    'manifest_dir',
+    'baseline_dir',
+    'record_baseline',
+    'diff_paths',
+    'estimate_transfer',
+]
+
+
+MANIFEST_VERSION = 1
+"""Version of the on-disk manifest format."""
+
+REPLICA_METADATA_DIR = b'.refugue'
+"""Top-level directory of a replica where refugue keeps its own files,
+this is never recorded in manifests."""
+
+HASH_SIZE = 16
+"""Number of bytes in a content hash (blake2b)."""
+
+NO_HASH = bytes(HASH_SIZE)
+"""The hash stored for entries which weren't hashed."""
+
+MANIFEST_COLUMNS = (
+    # file name, array typecode
+    ('offsets', 'Q'),
+    ('size', 'q'),
+    ('mtime', 'q'),
+    ('inode', 'Q'),
+    ('mode', 'I'),
+    ('end', 'Q'),
+)
+"""The numeric columns of a manifest. 'offsets' has one more element
+than there are entries and gives the location of each path in the
+names file. 'end' is the index one past the last entry in the subtree
+of each entry."""
+
+REPLICA_MANIFEST_DIR = '.refugue/manifest'
+"""Where manifests are kept when they are stored in the replica
+itself."""
+
+WRITE_BUFFER_ENTRIES = 1 << 16
+"""Number of entries buffered in memory before being written out."""
+
+ManifestEntry = namedtuple(
+    'ManifestEntry',
+    ['path', 'size', 'mtime_ns', 'inode', 'mode', 'digest'],
+)
+
+
+def manifest_key(path: bytes) -> bytes:
+    """Sort key for paths in a manifest, orders entries depth-first."""
+
+    return path.replace(b'/', b'\x00')
+
+def manifest_dir(peer_name, refinement) -> Path:
+    """Directory in the local cache where the manifest of a replica is
+    stored."""
+
+    return cache_dir() / 'manifests' / quote(f"{peer_name}/{refinement}", safe='')
+
+def baseline_dir(src, target, subtree=None) -> Path:
+    """Directory in the local cache where the manifests of both replicas
+    of a pair after their last successful sync are recorded."""
+
+    pair = f"{src.peer.name}/{src.refinement}-->{target.peer.name}/{target.refinement}"
+
+    if subtree is not None:
+        pair += f":{str(subtree).strip('/')}"
+
+    return cache_dir() / 'baselines' / quote(pair, safe='')
+
+def source_scan_dir(src, wset=None, subtree=None) -> Path:
+    """Directory in the local cache where the source replica of
+    incremental syncs is scanned to, shared by all the targets which
+    filter it the same way."""
+
+    scan = f"{src.peer.name}/{src.refinement}"
+
+    if subtree is not None:
+        scan += f":{str(subtree).strip('/')}"
+
+    fingerprint = wset_fingerprint(wset)
+    if fingerprint is not None:
+        scan += f"@{fingerprint[:16]}"
+
+    return cache_dir() / 'scans' / quote(scan, safe='')
+
+def record_baseline(manifest: 'Manifest', path):
+    """Record a copy of a manifest, e.g. as the baseline of a sync.
+
+    Manifest files are never modified after being written so they are
+    hard linked when possible.
+
+    """
+
+    tmp_path = make_tmp_dir(path)
+
+    for file_path in manifest.path.iterdir():
+        try:
+            os.link(file_path, tmp_path / file_path.name)
+        except OSError:
+            shutil.copy2(file_path, tmp_path / file_path.name)
+
+    replace_dir(tmp_path, path)
+
+def wset_fingerprint(wset) -> Optional[str]:
+    """Identify a working set so manifests made with different filters
+    aren't mixed up."""
+
+    if wset is None:
+        return None
+
+    return hashlib.sha256(
+        json.dumps([list(wset.includes), list(wset.excludes)]).encode()
+    ).hexdigest()
+
+
+class ManifestWriter():
+    """Writes the entries of a manifest as they are added.
+
+    Entries must be added in manifest order (see manifest_key) and the
+    end of the subtree of each directory set once its subtree has been
+    added.
+
+    """
+
+    def __init__(self, path):
+
+        self.path = Path(path)
+        self.tmp_path = make_tmp_dir(self.path)
+
+        self.count = 0
+        self._names_size = 0
+
+        self._files = {
+            name : open(self.tmp_path / f"{name}.bin", 'w+b')
+            for name in ('names', 'hash') + tuple(name for name, _ in MANIFEST_COLUMNS)
+        }
+
+        self._buffers = {name : array(typecode) for name, typecode in MANIFEST_COLUMNS}
+        self._names_buffer = bytearray()
+        self._hash_buffer = bytearray()
+
+        self._buffers['offsets'].append(0)
+
+        # subtree ends which couldn't be set in the buffer
+        self._pending_ends = {}
+
+    def add(self,
+            path: bytes,
+            size: int,
+            mtime_ns: int,
+            inode: int,
+            mode: int,
+            digest: bytes = NO_HASH,
+    ) -> int:
+        """Add an entry, returns its index."""
+
+        idx = self.count
+
+        self._names_buffer += path
+        self._names_size += len(path)
+
+        self._buffers['offsets'].append(self._names_size)
+        self._buffers['size'].append(size)
+        self._buffers['mtime'].append(mtime_ns)
+        self._buffers['inode'].append(inode)
+        self._buffers['mode'].append(mode)
+        self._buffers['end'].append(idx + 1)
+        self._hash_buffer += digest
+
+        self.count += 1
+
+        if len(self._buffers['size']) >= WRITE_BUFFER_ENTRIES:
+            self._flush()
+
+        return idx
+
+    def set_end(self, idx, end):
+        """Set the end of the subtree of a directory entry."""
+
+        # the index of the first entry in the buffer
+        buffer_start = self.count - len(self._buffers['end'])
+
+        if idx >= buffer_start:
+            self._buffers['end'][idx - buffer_start] = end
+
+        else:
+            self._pending_ends[idx] = end
+
+    def _flush(self):
+
+        for name, buffer in self._buffers.items():
+            buffer.tofile(self._files[name])
+            del buffer[:]
+
+        self._files['names'].write(self._names_buffer)
+        self._files['hash'].write(self._hash_buffer)
+
+        self._names_buffer.clear()
+        self._hash_buffer.clear()
+
+    def finish(self, **meta):
+        """Write everything out and atomically put the manifest in place.
+
+        Parameters
+        ----------
+
+        meta : dict
+            Extra JSON serializable values for the metadata file.
+
+        """
+
+        self._flush()
+
+        # patch the ends of subtrees which were already written
+        typecode = dict(MANIFEST_COLUMNS)['end']
+        item_size = array(typecode).itemsize
+        end_file = self._files['end']
+        for idx, end in self._pending_ends.items():
+            end_file.seek(idx * item_size)
+            array(typecode, [end]).tofile(end_file)
+
+        for f in self._files.values():
+            f.close()
+
+        meta = {
+            'version' : MANIFEST_VERSION,
+            'count' : self.count,
+            'created' : time.time(),
+            **meta,
+        }
+
+        with open(self.tmp_path / 'meta.json', 'w') as wf:
+            json.dump(meta, wf)
+
+        # swap the old manifest out, readers which still have it mapped
+        # keep working
+        replace_dir(self.tmp_path, self.path)
+
+    def abort(self):
+
+        for f in self._files.values():
+            f.close()
+
+        shutil.rmtree(self.tmp_path)
+
+
+class Manifest():
+    """A read-only memory mapped manifest."""
+
+    def __init__(self, path):
+
+        self.path = Path(path)
+
+        with open(self.path / 'meta.json', 'r') as rf:
+            self.meta = json.load(rf)
+
+        if self.meta['version'] != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported manifest version: {self.meta['version']}")
+
+        self.count = self.meta['count']
+
+        self._maps = []
+
+        self.names = self._map('names', 'B')
+        self.hashes = self._map('hash', 'B')
+
+        for name, typecode in MANIFEST_COLUMNS:
+            setattr(self, name, self._map(name, typecode))
+
+    @classmethod
+    def load(cls, path) -> Optional['Manifest']:
+        """Open a manifest if there is a valid one at the path."""
+
+        try:
+            return cls(path)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _map(self, name, typecode):
+
+        with open(self.path / f"{name}.bin", 'rb') as rf:
+
+            if os.fstat(rf.fileno()).st_size == 0:
+                return memoryview(array(typecode))
+
+            mapped = mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._maps.append(mapped)
+
+        return memoryview(mapped).cast(typecode)
+
+    def close(self):
+
+        # release the views before the maps they point into
+        for name in ('names', 'hashes') + tuple(name for name, _ in MANIFEST_COLUMNS):
+            getattr(self, name).release()
+
+        for mapped in self._maps:
+            mapped.close()
+
+        self._maps = []
+
+    def __len__(self):
+        return self.count
+
+    def path_bytes(self, idx) -> bytes:
+        return bytes(self.names[self.offsets[idx]:self.offsets[idx + 1]])
+
+    def digest(self, idx) -> bytes:
+        return bytes(self.hashes[idx * HASH_SIZE:(idx + 1) * HASH_SIZE])
+
+    def entry(self, idx) -> ManifestEntry:
+
+        return ManifestEntry(
+            path = os.fsdecode(self.path_bytes(idx)),
+            size = self.size[idx],
+            mtime_ns = self.mtime[idx],
+            inode = self.inode[idx],
+            mode = self.mode[idx],
+            digest = self.digest(idx),
+        )
+
+    def is_dir(self, idx) -> bool:
+        return stat.S_ISDIR(self.mode[idx])
+
+    def __iter__(self) -> Iterator[ManifestEntry]:
+
+        for idx in range(self.count):
+            yield self.entry(idx)
+
+    def find(self, path) -> Optional[int]:
+        """Get the index of a path by binary search."""
+
+        key = manifest_key(os.fsencode(path).strip(b'/'))
+
+        low, high = 0, self.count
+        while low < high:
+
+            mid = (low + high) // 2
+
+            if manifest_key(self.path_bytes(mid)) < key:
+                low = mid + 1
+            else:
+                high = mid
+
+        if low < self.count and manifest_key(self.path_bytes(low)) == key:
+            return low
+
+        return None
+
+    def children(self, idx=None) -> Iterator[int]:
+        """Iterate over the indices of the direct children of a directory
+        entry, or of the root if idx is None."""
+
+        if idx is None:
+            child, end = 0, self.count
+        else:
+            child, end = idx + 1, self.end[idx]
+
+        while child < end:
+            yield child
+            child = self.end[child]
+
+    def totals(self):
+        """Count the files, directories and bytes in the manifest."""
+
+        files = 0
+        dirs = 0
+        size = 0
+        for idx in range(self.count):
+
+            if self.is_dir(idx):
+                dirs += 1
+            else:
+                files += 1
+                size += self.size[idx]
+
+        return {'files' : files, 'dirs' : dirs, 'size' : size}
+
+    def diff(self, other: 'Manifest') -> Iterator[Tuple[str, bytes, Optional[int], Optional[int]]]:
+        """Compare this (newer) manifest to another one in a single pass.
+
+        Entries are modified if their type, size or modification time
+        differ, or both have content hashes and those differ.
+
+        Yields
+        ------
+
+        kind : str
+            'added', 'removed' or 'modified'
+
+        path : bytes
+
+        idx : int or None
+            Index in this manifest.
+
+        other_idx : int or None
+            Index in the other manifest.
+
+        """
+
+        idx = 0
+        other_idx = 0
+        while idx < self.count or other_idx < other.count:
+
+            if idx >= self.count:
+                yield ('removed', other.path_bytes(other_idx), None, other_idx)
+                other_idx += 1
+                continue
+
+            if other_idx >= other.count:
+                yield ('added', self.path_bytes(idx), idx, None)
+                idx += 1
+                continue
+
+            path = self.path_bytes(idx)
+            other_path = other.path_bytes(other_idx)
+
+            key = manifest_key(path)
+            other_key = manifest_key(other_path)
+
+            if key < other_key:
+                yield ('added', path, idx, None)
+                idx += 1
+
+            elif key > other_key:
+                yield ('removed', other_path, None, other_idx)
+                other_idx += 1
+
+            else:
+
+                digest = self.digest(idx)
+                other_digest = other.digest(other_idx)
+
+                if (stat.S_IFMT(self.mode[idx]) != stat.S_IFMT(other.mode[other_idx]) or
+                    (not self.is_dir(idx) and
+                     (self.size[idx] != other.size[other_idx] or
+                      self.mtime[idx] != other.mtime[other_idx])) or
+                    (digest != NO_HASH and other_digest != NO_HASH and
+                     digest != other_digest)):
+
+                    yield ('modified', path, idx, other_idx)
+
+                idx += 1
+                other_idx += 1
+
+
+def diff_paths(new: 'Manifest',
+               old: 'Manifest',
+               prefix=None,
+) -> Iterator[Tuple[str, str, bool]]:
+    """Compare two manifests and give the differences under a
+    directory.
+
+    Parameters
+    ----------
+
+    new : Manifest
+
+    old : Manifest
+
+    prefix : path-like or None
+        Only give paths in this directory, relative to it.
+
+    Yields
+    ------
+
+    kind : str
+        'added', 'removed' or 'modified', see Manifest.diff
+
+    path : str
+
+    is_dir : bool
+
+    """
+
+    prefix = os.fsencode(str(prefix)).strip(b'/') + b'/' if prefix is not None else b''
+
+    for kind, path, idx, old_idx in new.diff(old):
+
+        if not path.startswith(prefix):
+            continue
+
+        if idx is not None:
+            is_dir = new.is_dir(idx)
+        else:
+            is_dir = old.is_dir(old_idx)
+
+        yield kind, os.fsdecode(path[len(prefix):]), is_dir
+
+def hash_file(path) -> bytes:
+
+    hasher = hashlib.blake2b(digest_size=HASH_SIZE)
+    with open(path, 'rb') as rf:
+        for chunk in iter(lambda: rf.read(1 << 20), b''):
+            hasher.update(chunk)
+
+    return hasher.digest()
+
+def scan_local_manifest(root,
+                        path,
+                        wset=None,
+                        restat: bool = True,
+                        hash: bool = False,
+) -> Manifest:
+    """Scan a local replica and write its manifest, reusing the existing
+    manifest to make it incremental.
+
+    Directories whose modification time hasn't changed since the last
+    scan aren't listed again, their entries are taken from the old
+    manifest. Note that changing a file in place doesn't change its
+    directory, so unless restat is False the entries are still
+    stat'ed.
+
+    Parameters
+    ----------
+
+    root : path-like
+        Root of the replica.
+
+    path : path-like
+        Directory of the manifest.
+
+    wset : WorkingSet or None
+        Only record paths in the working set.
+
+    restat : bool
+        Stat the files in unchanged directories. If False these are
+        trusted to be unchanged as well, which is much faster but misses
+        files which were modified in place.
+
+    hash : bool
+        Compute content hashes for new and changed files.
+
+    Returns
+    -------
+
+    manifest : Manifest
+
+    """
+
+    root = os.fsencode(osp.abspath(root))
+    fingerprint = wset_fingerprint(wset)
+
+    old = Manifest.load(path)
+
+    # can't reuse listings which were filtered differently
+    if old is not None and (old.meta.get('wset') != fingerprint or
+                            old.meta.get('root') != os.fsdecode(root)):
+        old.close()
+        old = None
+
+    # a replica which doesn't exist yet is empty
+    try:
+        root_mtime_ns = os.lstat(root).st_mtime_ns
+    except FileNotFoundError:
+        root_mtime_ns = None
+
+    root_unchanged = (old is not None and root_mtime_ns is not None and
+                      old.meta.get('root_mtime_ns') == root_mtime_ns)
+
+    writer = ManifestWriter(path)
+
+    def _record(rel_path, abs_path, st, old_idx):
+
+        digest = NO_HASH
+
+        if hash and stat.S_ISREG(st.st_mode):
+
+            if (old_idx is not None and
+                old.size[old_idx] == st.st_size and
+                old.mtime[old_idx] == st.st_mtime_ns and
+                old.inode[old_idx] == st.st_ino and
+                old.digest(old_idx) != NO_HASH):
+
+                digest = old.digest(old_idx)
+
+            else:
+                digest = hash_file(abs_path)
+
+        return writer.add(rel_path, st.st_size, st.st_mtime_ns, st.st_ino,
+                          st.st_mode, digest)
+
+    def _scan_dir(rel_dir, abs_dir, old_dir_idx, unchanged):
+
+        # the children and their index in the old manifest
+        if unchanged:
+            children = sorted(
+                (old.path_bytes(idx).rsplit(b'/', 1)[-1], idx)
+                for idx in old.children(old_dir_idx)
+            )
+
+        else:
+            with os.scandir(abs_dir) as entries:
+                names = sorted(os.fsencode(entry.name) for entry in entries)
+
+            # the directory refugue keeps its own files in
+            if not rel_dir:
+                names = [name for name in names if name != REPLICA_METADATA_DIR]
+
+            children = []
+            for name in names:
+
+                rel_path = rel_dir + b'/' + name if rel_dir else name
+                old_idx = old.find(rel_path) if old is not None else None
+                children.append((name, old_idx))
+
+        for name, old_idx in children:
+
+            rel_path = rel_dir + b'/' + name if rel_dir else name
+            abs_path = abs_dir + b'/' + name
+
+            # trust the old record of files in unchanged directories
+            if (unchanged and not restat and not old.is_dir(old_idx)):
+
+                if wset is not None and not wset.contains(os.fsdecode(rel_path), False):
+                    continue
+
+                writer.add(rel_path, old.size[old_idx], old.mtime[old_idx],
+                           old.inode[old_idx], old.mode[old_idx], old.digest(old_idx))
+                continue
+
+            try:
+                st = os.lstat(abs_path)
+
+            # deleted since it was listed
+            except FileNotFoundError:
+                continue
+
+            is_dir = stat.S_ISDIR(st.st_mode)
+
+            if wset is not None and not wset.contains(os.fsdecode(rel_path), is_dir):
+                continue
+
+            idx = _record(rel_path, abs_path, st, old_idx)
+
+            if is_dir:
+
+                child_unchanged = (old_idx is not None and
+                                   old.is_dir(old_idx) and
+                                   old.mtime[old_idx] == st.st_mtime_ns and
+                                   old.inode[old_idx] == st.st_ino)
+
+                _scan_dir(rel_path, abs_path, old_idx, child_unchanged)
+
+                writer.set_end(idx, writer.count)
+
+    try:
+        if root_mtime_ns is not None:
+            _scan_dir(b'', root, None, root_unchanged)
+
+    except BaseException:
+        writer.abort()
+        raise
+
+    finally:
+        if old is not None:
+            old.close()
+
+    writer.finish(
+        root = os.fsdecode(root),
+        root_mtime_ns = root_mtime_ns,
+        wset = fingerprint,
+        hashed = hash,
+    )
+
+    return Manifest(path)
+
+def parse_find_mtime(mtime: str) -> int:
+    """Parse the modification time printed by find ('%T@') to
+    nanoseconds exactly, like os.stat gives them for local scans."""
+
+    seconds, _, fraction = mtime.partition('.')
+
+    nanoseconds = int(fraction[:9].ljust(9, '0')) if fraction else 0
+
+    if seconds.startswith('-'):
+        nanoseconds = -nanoseconds
+
+    return int(seconds) * 1_000_000_000 + nanoseconds
+
+def scan_context_manifest(cx,
+                          root,
+                          path,
+                          wset=None,
+) -> Manifest:
+    """Scan a replica through an execution context (e.g. on a remote
+    peer) with GNU find and write its manifest.
+
+    This is always a full scan, use scan_local_manifest for local
+    replicas. The listing is sorted on the peer and the entries are
+    written as they are received.
+
+    """
+
+    from .output import stream_command
+    from .sync import RefugueSyncError
+
+    # sort works on whole lines so the path goes last and its slashes
+    # are swapped for the lowest byte ('\1') to sort like manifest_key,
+    # names which have that byte themselves aren't supported, and like
+    # local scans the metadata directory isn't recorded
+    quoted_root = shlex.quote(str(root))
+
+    # a replica which doesn't exist yet is empty
+    command = (
+        f"[ -e {quoted_root} ] || exit 0; "
+        f"cd {quoted_root} && "
+        f"find . -mindepth 1 \\( -path ./{REPLICA_METADATA_DIR.decode()} "
+        f"-o -name \"$(printf '*\\001*')\" \\) -prune "
+        f"-o -printf '%s %T@ %i %m %y %P\\0' "
+        f"| tr / '\\001' "
+        f"| LC_ALL=C sort -z -t ' ' -k 6"
+    )
+
+    type_modes = {
+        'f' : stat.S_IFREG,
+        'd' : stat.S_IFDIR,
+        'l' : stat.S_IFLNK,
+    }
+
+    writer = ManifestWriter(path)
+
+    # directories whose subtree is still being written
+    dir_stack = []
+    excluded_dirs = []
+
+    def _add(record):
+
+        fields = record.rstrip('\0').split(' ', 5)
+
+        if len(fields) != 6:
+            return
+
+        size, mtime, inode, perms, file_type, rel_path = fields
+
+        if file_type not in type_modes:
+            return
+
+        rel_path = os.fsencode(rel_path.replace('\1', '/'))
+
+        while dir_stack and not rel_path.startswith(dir_stack[-1][0] + b'/'):
+            _, dir_idx = dir_stack.pop()
+            writer.set_end(dir_idx, writer.count)
+
+        # excluded directories exclude everything in them
+        while excluded_dirs and not rel_path.startswith(excluded_dirs[-1] + b'/'):
+            excluded_dirs.pop()
+
+        if excluded_dirs:
+            return
+
+        mode = type_modes[file_type] | int(perms, 8)
+        is_dir = stat.S_ISDIR(mode)
+
+        if wset is not None and not wset.contains(os.fsdecode(rel_path), is_dir):
+            if is_dir:
+                excluded_dirs.append(rel_path)
+            return
+
+        idx = writer.add(rel_path, int(size), parse_find_mtime(mtime), int(inode), mode)
+
+        if is_dir:
+            dir_stack.append((rel_path, idx))
+
+    try:
+        exit_code = stream_command(cx, command, _add, separator='\0')
+
+        if exit_code != 0:
+            raise RefugueSyncError(f"Scanning {root} failed with code {exit_code}",
+                                   exit_code=exit_code)
+
+    except BaseException:
+        writer.abort()
+        raise
+
+    for _, dir_idx in dir_stack:
+        writer.set_end(dir_idx, writer.count)
+
+    writer.finish(
+        root = str(root),
+        wset = wset_fingerprint(wset),
+        hashed = False,
+    )
+
+    return Manifest(path)
+
+def estimate_transfer(src: Manifest,
+                      target: Manifest,
+                      sync_pol,
+):
+    """Estimate what a sync from src to target would do from their
+    manifests without touching either replica.
+
+    Parameters
+    ----------
+
+    src : Manifest
+
+    target : Manifest
+
+    sync_pol : SyncPolicy
+
+    Returns
+    -------
+
+    plan : dict of str : int
+        Counts of the files to create, update and delete and the number
+        of bytes to transfer.
+
+    """
+
+    plan = {
+        'created_files' : 0,
+        'updated_files' : 0,
+        'deleted_files' : 0,
+        'transferred_size' : 0,
+    }
+
+    for kind, _, idx, target_idx in src.diff(target):
+
+        if kind == 'added':
+
+            if sync_pol.inject:
+                continue
+
+            plan['created_files'] += 1
+
+            if not src.is_dir(idx):
+                plan['transferred_size'] += src.size[idx]
+
+        elif kind == 'modified':
+
+            if src.is_dir(idx):
+                continue
+
+            # newer files on the target are left alone
+            if (not sync_pol.clobber and
+                target.mtime[target_idx] > src.mtime[idx]):
+                continue
+
+            plan['updated_files'] += 1
+            plan['transferred_size'] += src.size[idx]
+
+        elif kind == 'removed' and sync_pol.clean:
+            plan['deleted_files'] += 1
+
+    return plan
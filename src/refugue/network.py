@@ -1,18 +1,33 @@
 import dataclasses as dc
 from pathlib import Path
 from enum import Enum
+import os
+import os.path as osp
+import re
+import time
+import queue
+import shlex
+import socket
 import platform
+import threading
+import subprocess
+from types import MappingProxyType
 from typing import (
     Optional,
     Union,
     Tuple,
+    Dict,
     Callable,
     Mapping,
+    FrozenSet,
     Any,
 )
 
-from invoke import Context
-import fabric as fab
+from .cache import (
+    read_cache,
+    write_cache,
+)
+from .profiling import span
 
 __all__ = [
     'WorkingSet',
@@ -37,7 +52,7 @@ class ImpossibleConnection():
     """No connection to the requested peer is possible."""
     pass
 
-@dc.dataclass
+@dc.dataclass(frozen=True)
 class SSHConnection():
     """Connection via SSH is possible.
 
@@ -48,6 +63,532 @@ class SSHConnection():
     host: str
     user: str
 
+    link: Optional[str] = None
+    """The declared class of the link to the host, one of LINK_CLASSES,
+    None if not known."""
+
+    jump: Optional[str] = None
+    """Jump host ('[user@]host') to connect through, like ssh's
+    '-J'."""
+
+@dc.dataclass(frozen=True)
+class SandboxConnection(SSHConnection):
+    """A stand-in for an SSH connection which runs commands locally in a
+    sandbox with a simulated latency and bandwidth, see
+    refugue.sandbox.
+
+    """
+
+    root: str = ''
+    """Directory the sandbox is in, the peer's home is in it."""
+
+    rtt: float = 0.0
+    """Round trip time of the link in seconds."""
+
+    bandwidth: Optional[int] = None
+    """Bandwidth of the link in bytes per second, None is unlimited."""
+
+    isolated: bool = False
+    """Other peers can't connect to it, only the invoking host."""
+
+@dc.dataclass(frozen=True)
+class Reachability():
+    """Whether a peer could be reached when it was probed."""
+
+    peer: str
+
+    reachable: bool
+
+    reason: str
+    """How it was (or wasn't) reached, e.g. 'local', 'mounted',
+    'timed out'."""
+
+    rtt: Optional[float] = None
+    """Seconds it took to connect to a remote host, None if not
+    measured."""
+
+
+LINK_CLASSES = (
+    # both replicas are on the same host
+    'same-host',
+
+    # one of the replicas is on a drive mounted on the local host
+    'local-drive',
+
+    # a remote host on a fast local network
+    'lan',
+
+    # a remote host over a slow or high latency link
+    'wan',
+)
+
+DEFAULT_REMOTE_LINK = 'wan'
+"""Link class assumed for remote hosts which don't declare one, the
+conservative choice."""
+
+LAN_RTT_THRESHOLD = 0.005
+"""Round trip time in seconds under which a measured link is
+considered a LAN."""
+
+DEFAULT_SSH_CONTROL_PATH = "~/.ssh/refugue-cm-%C"
+"""Default socket path for OpenSSH connection multiplexing, '%C' is
+expanded by ssh to a hash of the connection parameters."""
+
+DEFAULT_SSH_CONTROL_PERSIST = "10m"
+"""Default time an idle OpenSSH master connection is kept open."""
+
+PEER_ENV_VARS = ('HOME', 'USER',)
+"""Environment variables always fetched for a peer's environment
+snapshot."""
+
+DEFAULT_PEER_ENV_TTL = 7 * 24 * 60 * 60
+"""Default number of seconds a cached peer environment snapshot is
+valid for."""
+
+DEFAULT_PEER_PROBE_TIMEOUT = 3.0
+"""Default number of seconds to wait for a peer to answer a
+reachability probe."""
+
+DEFAULT_REACHABILITY_TTL = 60
+"""Default number of seconds a cached reachability probe is valid for,
+short since hosts come and go."""
+
+DEFAULT_SSH_PORT = 22
+
+DEFAULT_ROUTE_TTL = 10 * 60
+"""Default number of seconds the route chosen for a peer is kept for
+on the same local network."""
+
+ROUTE_PROBE_ADDRESS = ('192.0.2.1', 9)
+"""Address used to find the local address of the default route, no
+packets are sent to it (TEST-NET-1, RFC 5737)."""
+
+REMOTE_SYNC_ROUTES = (
+    # rsync runs on the source and pushes to the target
+    'push',
+
+    # rsync runs on the target and pulls from the source
+    'pull',
+
+    # rsync runs on the target and pulls from the source through the
+    # invoking host, which connects to both
+    'pipe',
+)
+"""Ways to sync between two remote peers, see
+Network.resolve_remote_route."""
+
+MAX_PROBE_WORKERS = 32
+"""Maximum number of peers probed (or whose routes are raced) at
+once."""
+
+DEFAULT_PEER_CAPABILITIES_TTL = 24 * 60 * 60
+"""Default number of seconds the cached capabilities of a peer are
+valid for, shorter than for environments since rsync may be upgraded."""
+
+def parse_rsync_version(text: str) -> dict:
+    """Parse the output of 'rsync --version'.
+
+    Parameters
+    ----------
+
+    text : str
+
+    Returns
+    -------
+
+    rsync_caps : dict
+        With the keys 'version' (list of int or None), 'protocol' (int
+        or None), 'capabilities', 'compress_choices', and
+        'checksum_choices' (lists of str, empty for rsyncs older than
+        3.2 which don't have the lists).
+
+    """
+
+    version_match = re.search(r"version\s+v?(\d+)\.(\d+)\.(\d+)", text)
+    protocol_match = re.search(r"protocol version\s+(\d+)", text)
+
+    version = (None if version_match is None
+               else [int(part) for part in version_match.groups()])
+
+    # the indented lines after a 'Heading:' line are its items, the
+    # capabilities are comma separated phrases (e.g. '64-bit files,
+    # hardlinks,') and the rest are space separated names with
+    # parenthesized notes (e.g. 'xxh128 xxh3 (xxhash) md5')
+    sections = {}
+    heading = None
+    for line in text.splitlines():
+
+        if line.strip() == '':
+            continue
+
+        if not line[0].isspace():
+            heading = line.strip()[:-1] if line.strip().endswith(':') else None
+            continue
+
+        if heading is None:
+            continue
+
+        if heading == 'Capabilities':
+            items = [phrase.strip() for phrase in line.split(',')]
+        else:
+            items = [name for name in line.split() if not name.startswith('(')]
+
+        sections.setdefault(heading, []).extend(item for item in items if item != '')
+
+    return {
+        'version' : version,
+        'protocol' : None if protocol_match is None else int(protocol_match.group(1)),
+        'capabilities' : sections.get('Capabilities', []),
+        'compress_choices' : [name for name in sections.get('Compress list', [])
+                              if name != 'none'],
+        'checksum_choices' : [name for name in sections.get('Checksum list', [])
+                              if name != 'none'],
+    }
+
+
+def peer_link_probe_command(rsh: Optional[str],
+                            ssh_conn,
+                            timeout: float = DEFAULT_PEER_PROBE_TIMEOUT,
+) -> str:
+    """The command run on one peer to time connecting to another over
+    SSH, which prints the exit code of ssh ('exit CODE'), the last line
+    of its error messages ('error MESSAGE') if there were any and then
+    the nanoseconds it took ('ns NANOSECONDS') if date supports them.
+
+    Parameters
+    ----------
+
+    rsh : str or None
+        The remote shell to connect with, 'ssh' if None.
+
+    ssh_conn : SSHConnection
+        The peer connected to.
+
+    timeout : float
+
+    """
+
+    # never wait on a password prompt
+    connect = ' '.join([
+        rsh if rsh is not None else 'ssh',
+        '-o BatchMode=yes',
+        f"-o ConnectTimeout={max(1, int(round(timeout)))}",
+        shlex.quote(f"{ssh_conn.user}@{ssh_conn.host}"),
+        'true',
+    ])
+
+    # without %N (e.g. BSD date) the times aren't numbers and the
+    # arithmetic would abort the command, so the exit code goes first.
+    # ssh exits with 255 for any failure, its message tells e.g. a
+    # refused key from an unreachable host
+    return (f"s=$(date +%s%N); m=$({connect} </dev/null 2>&1 >/dev/null); c=$?; "
+            f"e=$(date +%s%N); echo \"exit $c\"; "
+            f"[ -n \"$m\" ] && echo \"error $(printf '%s\\n' \"$m\" | tail -n 1)\"; "
+            f"case \"$s$e\" in *[!0-9]*) ;; *) echo \"ns $((e - s))\" ;; esac")
+
+def connect_rtt(ssh_conn,
+                timeout: float = DEFAULT_PEER_PROBE_TIMEOUT,
+) -> Tuple[bool, Optional[float], str]:
+    """Time opening a TCP connection to the SSH server of a connection.
+
+    For connections through a jump host only the jump host is checked,
+    the host behind it isn't and no RTT is given for it. So these are
+    only chosen when no direct route answers (see race_routes).
+
+    Returns
+    -------
+
+    reachable : bool
+
+    rtt : float or None
+        Seconds it took to connect, None if it wasn't measured.
+
+    reason : str
+        How it was (or wasn't) reached.
+
+    """
+
+    # connecting to a sandbox is always possible but takes a round
+    # trip
+    if isinstance(ssh_conn, SandboxConnection):
+
+        time.sleep(ssh_conn.rtt)
+
+        return True, ssh_conn.rtt, 'sandbox'
+
+    if ssh_conn.jump is not None:
+
+        user, _, host = ssh_conn.jump.rpartition('@')
+        hostname, port, proxied = ssh_endpoint(
+            SSHConnection(host=host, user=user or ssh_conn.user),
+            timeout=timeout,
+        )
+
+        via = f" (jump host {ssh_conn.jump})"
+
+    else:
+        hostname, port, proxied = ssh_endpoint(ssh_conn, timeout=timeout)
+        via = ''
+
+    # can't check a host behind a jump host (from the SSH config)
+    # without connecting through it
+    if proxied:
+        return True, None, 'proxied, not checked'
+
+    start = time.monotonic()
+    try:
+        with socket.create_connection((hostname, port), timeout=timeout):
+            rtt = time.monotonic() - start
+
+    except socket.timeout:
+        return False, None, f"timed out{via}"
+
+    except OSError as err:
+        return False, None, (err.strerror or str(err)) + via
+
+    # the time to the jump host says nothing about the whole route
+    if ssh_conn.jump is not None:
+        return True, None, f"jump host ssh {hostname}:{port} answered, {ssh_conn.host} not checked"
+
+    return True, rtt, f"ssh {hostname}:{port}"
+
+def race_routes(routes,
+                timeout: float = DEFAULT_PEER_PROBE_TIMEOUT,
+) -> Tuple[Optional[int], Optional[float]]:
+    """Connect to all of the routes at once and get the one with the
+    lowest RTT.
+
+    The answers are collected until all routes answered or the timeout
+    is up, since the order they arrive in also depends on how long
+    resolving each endpoint took (see connect_rtt). If nothing answered
+    by then the first route to answer is used.
+
+    Routes which can't be measured (see connect_rtt) are only used if
+    none of the others answer.
+
+    Parameters
+    ----------
+
+    routes : list of SSHConnection
+
+    timeout : float
+
+    Returns
+    -------
+
+    route_idx : int or None
+        Index of the fastest route, None if none could be reached.
+
+    rtt : float or None
+
+    """
+
+    answers = queue.Queue()
+
+    def _connect(route_idx, route):
+        answers.put((route_idx, *connect_rtt(route, timeout=timeout)))
+
+    deadline = time.monotonic() + timeout
+
+    # daemon threads so the stragglers don't hold up anything
+    for route_idx, route in enumerate(routes):
+        threading.Thread(target=_connect, args=(route_idx, route), daemon=True).start()
+
+    # (rtt, route index) of the routes which answered
+    measured = []
+    unmeasured = []
+    for _ in routes:
+
+        # wait for the first reachable route however long it takes,
+        # and for the others only until the deadline
+        wait = None
+        if len(measured) + len(unmeasured) > 0:
+            wait = max(0.0, deadline - time.monotonic())
+
+        try:
+            route_idx, reachable, rtt, _ = answers.get(timeout=wait)
+        except queue.Empty:
+            break
+
+        if reachable and rtt is not None:
+            measured.append((rtt, route_idx))
+
+        elif reachable:
+            unmeasured.append(route_idx)
+
+    if len(measured) > 0:
+        rtt, route_idx = min(measured)
+        return route_idx, rtt
+
+    if len(unmeasured) > 0:
+        return min(unmeasured), None
+
+    return None, None
+
+def peer_cache_key(peer, peer_conn) -> str:
+    """Get the key things discovered about a peer are cached under.
+
+    The connection is part of the key so that changing it in the
+    config gets fresh values.
+
+    """
+
+    if isinstance(peer_conn, LocalConnection):
+        return f"{peer.name}:local:{platform.node()}"
+
+    elif isinstance(peer_conn, ImpossibleConnection):
+        return f"{peer.name}:none"
+
+    cache_key = f"{peer.name}:{peer_conn.user}@{peer_conn.host}"
+
+    if isinstance(peer_conn, SandboxConnection):
+        cache_key += f":sandbox:{peer_conn.root}"
+
+    return cache_key
+
+def connection_from_config(conn_d, peer_name, defaults=None):
+    """Make the connection spec for a CONNECTIONS entry or one of its
+    routes.
+
+    Parameters
+    ----------
+
+    conn_d : dict
+
+    peer_name : str
+
+    defaults : dict or None
+        Values for keys not given in conn_d, i.e. the CONNECTIONS entry
+        a route is in.
+
+    Returns
+    -------
+
+    connection : SSHConnection or SandboxConnection
+
+    """
+
+    conn_d = {**(defaults if defaults is not None else {}), **conn_d}
+
+    # stand in for the remote host locally
+    if 'sandbox' in conn_d:
+        sandbox_d = conn_d['sandbox']
+        return SandboxConnection(
+            host = conn_d.get('host', peer_name),
+            user = conn_d.get('user', os.environ.get('USER', '')),
+            link = conn_d.get('link', None),
+            jump = conn_d.get('jump', None),
+            root = sandbox_d['root'],
+            rtt = float(sandbox_d.get('rtt', 0.0)),
+            bandwidth = sandbox_d.get('bandwidth', None),
+            isolated = bool(sandbox_d.get('isolated', False)),
+        )
+
+    return SSHConnection(
+        host = conn_d['host'],
+        user = conn_d['user'],
+        link = conn_d.get('link', None),
+        jump = conn_d.get('jump', None),
+    )
+
+def local_network_id() -> str:
+    """Identify the network the local host is on, by the local address
+    of its default route.
+
+    Nothing is sent over the network to find it.
+
+    """
+
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(ROUTE_PROBE_ADDRESS)
+            address = sock.getsockname()[0]
+
+    except OSError:
+        address = 'offline'
+
+    return f"{platform.node()}:{address}"
+
+def ssh_endpoint(ssh_conn,
+                 timeout: float = DEFAULT_PEER_PROBE_TIMEOUT,
+) -> Tuple[str, int, bool]:
+    """Get the address SSH actually connects to for a connection, from
+    the user's SSH config ('ssh -G').
+
+    Returns
+    -------
+
+    hostname : str
+
+    port : int
+
+    proxied : bool
+        Whether the connection goes through a jump host or proxy
+        command, so the address isn't connected to directly.
+
+    """
+
+    try:
+        result = subprocess.run(
+            ['ssh', '-G', '-l', ssh_conn.user, ssh_conn.host],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+
+    # without ssh just use the host as given
+    except (OSError, subprocess.TimeoutExpired):
+        return ssh_conn.host, DEFAULT_SSH_PORT, False
+
+    options = {}
+    for line in result.stdout.splitlines():
+
+        key, _, value = line.partition(' ')
+        options[key.lower()] = value.strip()
+
+    proxied = any(options.get(key, 'none') != 'none'
+                  for key in ('proxyjump', 'proxycommand'))
+
+    return (
+        options.get('hostname', ssh_conn.host),
+        int(options.get('port', DEFAULT_SSH_PORT)),
+        proxied,
+    )
+
+@dc.dataclass
+class ConnectionPool():
+    """Open remote execution contexts keyed by their connection spec.
+
+    Every consumer asking for a context to the same peer gets the same
+    context, so a single invocation only pays for each SSH handshake
+    once.
+
+    """
+
+    connections: dict = dc.field(default_factory=dict)
+    _lock: Any = dc.field(default_factory=threading.Lock, repr=False)
+
+    def get(self, conn_spec, factory):
+        """Get the open context for the spec, constructing it with the
+        factory if there isn't one yet."""
+
+        with self._lock:
+
+            if conn_spec not in self.connections:
+                self.connections[conn_spec] = factory(conn_spec)
+
+            return self.connections[conn_spec]
+
+    def close(self):
+        """Close all of the open contexts and empty the pool."""
+
+        with self._lock:
+
+            for conn in self.connections.values():
+                conn.close()
+
+            self.connections.clear()
+
 
 class RefugueNetworkError(ValueError):
     """Error for network failures."""
@@ -58,7 +599,7 @@ class PeerTypes(Enum):
     host = 1
     drive = 2
 
-@dc.dataclass
+@dc.dataclass(frozen=True)
 class Peer():
 
     name: str
@@ -81,6 +622,37 @@ class Peer():
 
         return peer_type
 
+    @classmethod
+    def resolve_peer_aliases(cls, config):
+        """Get the aliases for all peers from the config.
+
+        'PEER_ALIASES' can either map an alias to the name of a peer or
+        map the name of a peer to a collection of aliases.
+
+        Parameters
+        ----------
+
+        config : dict
+
+        Returns
+        -------
+
+        aliases : dict of str : tuple of str
+            Mapping of peer names to their aliases.
+
+        """
+
+        aliases = {}
+        for key, value in config['PEER_ALIASES'].items():
+
+            if isinstance(value, str):
+                aliases.setdefault(value, []).append(key)
+
+            else:
+                aliases.setdefault(key, []).extend(value)
+
+        return {peer_name : tuple(peer_aliases)
+                for peer_name, peer_aliases in aliases.items()}
 
     @classmethod
     def from_config(cls, config):
@@ -98,25 +670,27 @@ class Peer():
 
         """
 
+        # make the lookups constant time
+        drive_names = frozenset(config['DRIVES'])
+        host_names = frozenset(config['HOSTS'])
+        peer_aliases = cls.resolve_peer_aliases(config)
+
         peers = []
         for peer_name in config['PEERS']:
 
-            if peer_name in config['PEER_ALIASES']:
-                aliases = config['PEER_ALIASES'][peer_name]
-            else:
-                aliases = ()
+            aliases = peer_aliases.get(peer_name, ())
 
-            if peer_name in config['DRIVES']:
+            if peer_name in drive_names:
 
                 peer = PeerDrive(
                     name = peer_name,
                     aliases = aliases,
                 )
 
-            elif peer_name in config['HOSTS']:
+            elif peer_name in host_names:
 
                 if peer_name in config['HOST_NODE_ALIASES']:
-                    node_aliases = config['HOST_NODE_ALIASES'][peer_name]
+                    node_aliases = tuple(config['HOST_NODE_ALIASES'][peer_name])
                 else:
                     node_aliases = ()
 
@@ -133,7 +707,7 @@ class Peer():
 
         return peers
 
-@dc.dataclass
+@dc.dataclass(frozen=True)
 class PeerHost(Peer):
 
     node_aliases: Optional[ Tuple[str] ]
@@ -141,12 +715,38 @@ class PeerHost(Peer):
 
     peer_type = PeerTypes.host
 
-@dc.dataclass
+@dc.dataclass(frozen=True)
 class PeerDrive(Peer):
 
     peer_type = PeerTypes.drive
 
 
+def index_peers(peers) -> Mapping[str, Peer]:
+    """Make a read-only lookup table of peers by their names and aliases.
+
+    Parameters
+    ----------
+
+    peers : iterable of Peer
+
+    Returns
+    -------
+
+    peer_index : mapping of str : Peer
+
+    """
+
+    peer_index = {}
+    for peer in peers:
+        for peer_spec in (peer.name,) + tuple(peer.aliases):
+
+            if peer_index.get(peer_spec, peer) != peer:
+                raise ValueError(f"Peer name or alias used more than once: {peer_spec}")
+
+            peer_index[peer_spec] = peer
+
+    return MappingProxyType(peer_index)
+
 @dc.dataclass
 class Network():
 
@@ -154,10 +754,62 @@ class Network():
     # TODO: make this more exact
     network_config: Any
 
+    connection_pool: ConnectionPool = dc.field(
+        default_factory=ConnectionPool,
+        repr=False,
+    )
+
+    peer_index: Mapping[str, Peer] = dc.field(init=False, repr=False)
+    """Peers by name and alias"""
+
+    host_names: FrozenSet[str] = dc.field(init=False, repr=False)
+    """Names of the hosts in the config."""
+
+    drive_names: FrozenSet[str] = dc.field(init=False, repr=False)
+    """Names of the drives in the config."""
+
+    routes: dict = dc.field(default_factory=dict, repr=False)
+    """The route chosen for each peer with routes in this invocation."""
+
+    _routes_lock: Any = dc.field(default_factory=threading.Lock, repr=False)
+
+    _route_locks: dict = dc.field(default_factory=dict, repr=False)
+    """A lock for racing the routes of each peer, so different peers are
+    raced at the same time."""
+
     # TODO
     # def __repr__(self):
     #     pass
 
+    def __post_init__(self):
+
+        self.peers = tuple(self.peers)
+        self.peer_index = index_peers(self.peers)
+
+        # indexes for lookups by name, built once
+        self.host_names = frozenset(self.network_config['HOSTS'])
+        self.drive_names = frozenset(self.network_config['DRIVES'])
+
+    def resolve_peer_type(self, peer_spec) -> Optional[str]:
+        """Get whether a peer name is a 'host' or 'drive' in the config,
+        None if it is neither."""
+
+        if peer_spec in self.host_names:
+            return 'host'
+
+        elif peer_spec in self.drive_names:
+            return 'drive'
+
+        return None
+
+    def get_peer(self, peer_spec) -> Peer:
+        """Get a peer by its name or one of its aliases."""
+
+        try:
+            return self.peer_index[peer_spec]
+        except KeyError:
+            raise ValueError(f"Unknown peer: {peer_spec}")
+
     @classmethod
     def from_config(cls, config):
         """Generate a Network object from a configuration file.
@@ -193,10 +845,13 @@ class Network():
 
         Currently this is achieved through the fabric.Connection class.
 
+        Connections are pooled for the lifetime of the network so this
+        will return the same object for the same connection spec.
+
         Parameters
         ----------
 
-        conn_d : dict
+        ssh_conn : SSHConnection
 
         Returns
         -------
@@ -205,59 +860,174 @@ class Network():
 
         """
 
-        conn = fab.Connection(
-            host=ssh_conn.host,
-            user=ssh_conn.user,
-        )
-        return conn
+        def _new_connection(ssh_conn):
 
-    def resolve_peer_connection(self,
-                                peer,
-    ) -> Union[ ImpossibleConnection, LocalConnection, SSHConnection ]:
-        """Get the spec for creating a connection spec (not a full context).
+            if isinstance(ssh_conn, SandboxConnection):
+
+                from .sandbox import SandboxContext
+
+                return SandboxContext(ssh_conn)
+
+            # fabric (and paramiko) are expensive to import and only
+            # needed for remote peers
+            import fabric as fab
+
+            gateway = None
+            if ssh_conn.jump is not None:
+                gateway = fab.Connection(ssh_conn.jump)
+
+            return fab.Connection(
+                host=ssh_conn.host,
+                user=ssh_conn.user,
+                gateway=gateway,
+            )
+
+        return self.connection_pool.get(ssh_conn, _new_connection)
+
+    def close(self):
+        """Close all the pooled connections to remote peers."""
+
+        self.connection_pool.close()
+
+    def ssh_control_options(self,
+                            multiplex=False,
+    ) -> Tuple[str]:
+        """Get the OpenSSH options for sharing a master connection
+        across processes and invocations.
+
+        Controlled by the 'SSH_CONTROL' network config value which is a
+        dictionary with the optional keys 'path' and 'persist'. If it is
+        not given no options are generated unless multiplex is True, in
+        which case the defaults are used.
 
         Parameters
         ----------
 
-        peer : Peer
+        multiplex : bool
+            Always generate the options, e.g. when many processes will be
+            started concurrently.
 
         Returns
         -------
 
-        connection : Connection object
+        options : tuple of str
 
         """
 
-        # HOST peers can be across a network and found via a Connection
-        if peer.peer_type == PeerTypes.host:
+        control_d = self.network_config.get('SSH_CONTROL', None)
 
-            # check to see if our local context is on the peer, by getting
-            # the node of the peer and the node we are on (the node is not
-            # a fully-qualified domain name FQDN and is what is returned
-            # by `platform.node()`)
+        if control_d is None:
 
-            peer_node_aliases = [peer.name]
+            if not multiplex:
+                return ()
 
-            # first resolve the alias of the peer if there is one
-            if peer.name in self.network_config['HOST_NODE_ALIASES']:
-                peer_node_aliases += self.network_config['HOST_NODE_ALIASES'][peer.name]
+            control_d = {}
 
-            # if we are on one of the recognized host node names its a
-            # local context
-            if platform.node() in peer_node_aliases:
-                peer_conn = LocalConnection()
+        control_path = control_d.get('path', DEFAULT_SSH_CONTROL_PATH)
+        control_persist = control_d.get('persist', DEFAULT_SSH_CONTROL_PERSIST)
 
-            # otherwise we get the connection spec for this peer
-            else:
+        return (
+            "-o ControlMaster=auto",
+            f"-o ControlPath={control_path}",
+            f"-o ControlPersist={control_persist}",
+        )
 
-                if peer.name not in self.network_config['CONNECTIONS']:
-                    peer_conn = ImpossibleConnection()
-                else:
-                    conn_d = self.network_config['CONNECTIONS'][peer.name]
-                    peer_conn = SSHConnection(
-                            host = conn_d['host'],
-                            user = conn_d['user'],
-                    )
+    def rsh_command(self,
+                    ssh_conn,
+                    multiplex=False,
+    ) -> Optional[str]:
+        """Get the remote shell command for transports (i.e. rsync's '-e')
+        to reach the peer with.
+
+        Parameters
+        ----------
+
+        ssh_conn : SSHConnection
+
+        multiplex : bool
+            Share a master connection even if it isn't configured, see
+            ssh_control_options.
+
+        Returns
+        -------
+
+        rsh : str or None
+            None if the default remote shell should be used.
+
+        """
+
+        options = self.ssh_control_options(multiplex=multiplex)
+
+        if isinstance(ssh_conn, SandboxConnection):
+
+            from .sandbox import (
+                HANDSHAKE_ROUND_TRIPS,
+                sandbox_command,
+            )
+
+            # a shared master connection only needs a round trip to
+            # open a session
+            return sandbox_command(
+                ssh_conn,
+                1 if len(options) > 0 else HANDSHAKE_ROUND_TRIPS,
+            )
+
+        if ssh_conn.jump is not None:
+            options += ('-J', ssh_conn.jump)
+
+        if len(options) == 0:
+            return None
+
+        return ' '.join(('ssh',) + options)
+
+    def resolve_peer_connection(self,
+                                peer,
+    ) -> Union[ ImpossibleConnection, LocalConnection, SSHConnection ]:
+        """Get the spec for creating a connection spec (not a full context).
+
+        Parameters
+        ----------
+
+        peer : Peer
+
+        Returns
+        -------
+
+        connection : Connection object
+
+        """
+
+        # HOST peers can be across a network and found via a Connection
+        if peer.peer_type == PeerTypes.host:
+
+            # check to see if our local context is on the peer, by getting
+            # the node of the peer and the node we are on (the node is not
+            # a fully-qualified domain name FQDN and is what is returned
+            # by `platform.node()`)
+
+            peer_node_aliases = [peer.name]
+
+            # first resolve the alias of the peer if there is one
+            if peer.name in self.network_config['HOST_NODE_ALIASES']:
+                peer_node_aliases += self.network_config['HOST_NODE_ALIASES'][peer.name]
+
+            # if we are on one of the recognized host node names its a
+            # local context
+            if platform.node() in peer_node_aliases:
+                peer_conn = LocalConnection()
+
+            # otherwise we get the connection spec for this peer
+            else:
+
+                if peer.name not in self.network_config['CONNECTIONS']:
+                    peer_conn = ImpossibleConnection()
+                else:
+                    conn_d = self.network_config['CONNECTIONS'][peer.name]
+
+                    if 'routes' in conn_d:
+                        peer_conn = self.resolve_peer_route(peer)
+                    else:
+                        peer_conn = connection_from_config(conn_d, peer.name)
 
         # DRIVE peers are assumed to be mounted on the local host node
         # peer
@@ -277,6 +1047,211 @@ class Network():
         return peer_conn
 
 
+    def resolve_peer_route(self,
+                           peer,
+    ) -> SSHConnection:
+        """Choose which of the routes of a peer to connect over.
+
+        The routes of a CONNECTIONS entry are given as a list of dicts
+        (with the same keys as the entry, which are the defaults),
+        e.g. a LAN address, a VPN address, and the public hostname:
+
+            'junco' : {
+                'user' : 'salotz',
+                'routes' : [
+                    {'host' : '192.168.1.20', 'link' : 'lan'},
+                    {'host' : '10.8.0.20'},
+                    {'host' : 'junco.example.org'},
+                    {'host' : 'junco', 'jump' : 'gateway.example.org'},
+                ],
+            }
+
+        All routes are raced and the one with the lowest RTT is
+        chosen, routes through a jump host only if no direct one
+        answers. The choice is kept for the invocation and cached on disk
+        for the local network (see 'ROUTE_TTL' in the network config).
+        If none can be reached the first route is used.
+
+        Parameters
+        ----------
+
+        peer : Peer
+
+        Returns
+        -------
+
+        connection : SSHConnection
+
+        """
+
+        with self._routes_lock:
+
+            if peer.name in self.routes:
+                return self.routes[peer.name]
+
+            peer_lock = self._route_locks.setdefault(peer.name, threading.Lock())
+
+        # only one thread races the routes of a peer, the others wait
+        # for its choice
+        with peer_lock:
+
+            if peer.name in self.routes:
+                return self.routes[peer.name]
+
+            conn_d = self.network_config['CONNECTIONS'][peer.name]
+
+            defaults = {key : value for key, value in conn_d.items()
+                        if key != 'routes'}
+
+            if len(conn_d['routes']) == 0:
+                raise ValueError(f"No routes for peer: {peer.name}")
+
+            routes = [connection_from_config(route_d, peer.name, defaults)
+                      for route_d in conn_d['routes']]
+
+            # the routes are part of the key so changing them in the
+            # config races them again
+            cache_key = (f"{peer.name}:{local_network_id()}:" +
+                         ','.join(f"{route.user}@{route.host}~{route.jump}"
+                                  for route in routes))
+
+            ttl = self.network_config.get('ROUTE_TTL', DEFAULT_ROUTE_TTL)
+
+            route_idx = read_cache('routes', cache_key, ttl=ttl)
+
+            if route_idx is None:
+
+                timeout = self.network_config.get('PEER_PROBE_TIMEOUT',
+                                                  DEFAULT_PEER_PROBE_TIMEOUT)
+
+                with span('network.race_routes', peer=peer.name, routes=len(routes)):
+                    route_idx, _ = race_routes(routes, timeout=timeout)
+
+                # don't remember that nothing could be reached
+                if route_idx is None:
+                    route_idx = 0
+                else:
+                    write_cache('routes', cache_key, route_idx)
+
+            with self._routes_lock:
+                self.routes[peer.name] = routes[route_idx]
+
+            return routes[route_idx]
+
+    def _races_routes(self, peer) -> bool:
+        """Whether resolving the connection of a peer races its routes."""
+
+        conn_d = self.network_config['CONNECTIONS'].get(peer.name, {})
+
+        return (peer.peer_type == PeerTypes.host and
+                'routes' in conn_d and
+                peer.name not in self.routes)
+
+    def classify_connection_link(self, conn) -> str:
+        """Get the class of the link to a remote host, see
+        LINK_CLASSES.
+
+        The link declared for the connection is used if there is one,
+        otherwise it is classified by the RTT for sandboxes and assumed
+        to be DEFAULT_REMOTE_LINK for real hosts.
+
+        """
+
+        if conn.link is not None:
+
+            if conn.link not in LINK_CLASSES:
+                raise ValueError(f"Unknown link class for {conn.host}: {conn.link}")
+
+            return conn.link
+
+        if isinstance(conn, SandboxConnection):
+            return 'lan' if conn.rtt < LAN_RTT_THRESHOLD else 'wan'
+
+        return DEFAULT_REMOTE_LINK
+
+    def declared_peer_link(self,
+                           peer_a,
+                           peer_b,
+    ) -> Optional[str]:
+        """Get the class of the direct link between two peers declared in
+        'PEER_LINKS' of the network config, in either order.
+
+        Parameters
+        ----------
+
+        peer_a : Peer
+
+        peer_b : Peer
+
+        Returns
+        -------
+
+        link : str or None
+            One of LINK_CLASSES, None if not declared.
+
+        """
+
+        for (name_a, name_b), link in self.network_config.get('PEER_LINKS', {}).items():
+
+            names = {self.get_peer(name_a).name, self.get_peer(name_b).name}
+
+            if names == {peer_a.name, peer_b.name}:
+
+                if link not in LINK_CLASSES:
+                    raise ValueError(f"Unknown link class for {name_a}, {name_b}: {link}")
+
+                return link
+
+        return None
+
+    def classify_link(self,
+                      src_peer,
+                      target_peer,
+    ) -> str:
+        """Get the class of the link data goes over between two peers,
+        one of LINK_CLASSES.
+
+        Parameters
+        ----------
+
+        src_peer : Peer
+
+        target_peer : Peer
+
+        Returns
+        -------
+
+        link : str
+
+        """
+
+        src_conn = self.resolve_peer_connection(src_peer)
+        target_conn = self.resolve_peer_connection(target_peer)
+
+        for conn, peer in ((src_conn, src_peer), (target_conn, target_peer)):
+            if isinstance(conn, ImpossibleConnection):
+                raise RefugueNetworkError(f"Unreachable peer: {peer.name}")
+
+        if (isinstance(src_conn, LocalConnection) and
+            isinstance(target_conn, LocalConnection)):
+
+            if PeerTypes.drive in (src_peer.peer_type, target_peer.peer_type):
+                return 'local-drive'
+            else:
+                return 'same-host'
+
+        # the peers know better how they are connected to each other
+        declared = self.declared_peer_link(src_peer, target_peer)
+        if declared is not None:
+            return declared
+
+        # the slowest of the remote links
+        links = [self.classify_connection_link(conn)
+                 for conn in (src_conn, target_conn)
+                 if not isinstance(conn, LocalConnection)]
+
+        return max(links, key=LINK_CLASSES.index)
+
     def resolve_peer_context(self,
                              local_cx,
                              peer,
@@ -307,7 +1282,8 @@ class Network():
         # if it is a remote SSH connection make a fabric Connection
         # context for it
         elif issubclass(type(peer_conn), SSHConnection):
-            return self.construct_connection(peer_conn)
+            with span('network.resolve_peer_context', peer=peer.name):
+                return self.construct_connection(peer_conn)
 
         # if it is not possible to connect raise an error
         elif issubclass(type(peer_conn), ImpossibleConnection):
@@ -317,6 +1293,444 @@ class Network():
         else:
             raise TypeError(f"Unknown connection type: {peer_conn}")
 
+    def probe_peer_reachability(self,
+                                peer,
+                                timeout: Optional[float] = None,
+    ) -> Reachability:
+        """Check whether a peer can be reached right now.
+
+        Remote hosts are checked by opening a TCP connection to their
+        SSH server (not a full SSH handshake), drives by checking their
+        mount point is mounted or not empty.
+
+        Parameters
+        ----------
+
+        peer : Peer
+
+        timeout : float or None
+            Seconds to wait for remote hosts, see 'PEER_PROBE_TIMEOUT'
+            in the network config.
+
+        Returns
+        -------
+
+        reachability : Reachability
+
+        """
+
+        if timeout is None:
+            timeout = self.network_config.get('PEER_PROBE_TIMEOUT',
+                                              DEFAULT_PEER_PROBE_TIMEOUT)
+
+        peer_conn = self.resolve_peer_connection(peer)
+
+        if isinstance(peer_conn, ImpossibleConnection):
+            return Reachability(peer.name, False, 'no connection configured')
+
+        if peer.peer_type == PeerTypes.drive:
+
+            mount_dir = osp.expanduser(osp.expandvars(
+                str(self.resolve_peer_mount(None, peer))))
+
+            if osp.ismount(mount_dir):
+                return Reachability(peer.name, True, 'mounted')
+
+            # mount points of unmounted drives are left empty
+            elif osp.isdir(mount_dir) and len(os.listdir(mount_dir)) > 0:
+                return Reachability(peer.name, True, 'present')
+
+            else:
+                return Reachability(peer.name, False, f"not mounted at {mount_dir}")
+
+        if isinstance(peer_conn, LocalConnection):
+            return Reachability(peer.name, True, 'local')
+
+        reachable, rtt, reason = connect_rtt(peer_conn, timeout=timeout)
+
+        return Reachability(peer.name, reachable, reason, rtt=rtt)
+
+    def probe_reachability(self,
+                           peers=None,
+                           timeout: Optional[float] = None,
+                           use_cache: bool = True,
+    ) -> Dict[str, Reachability]:
+        """Check which peers can be reached, probing all of them
+        concurrently.
+
+        At most MAX_PROBE_WORKERS peers are probed at a time. The
+        peers that could be reached are cached on disk (see
+        'REACHABILITY_TTL' in the network config) so that repeated
+        invocations don't probe them again, unreachable ones are always
+        probed again since they may have just come up.
+
+        Parameters
+        ----------
+
+        peers : iterable of Peer or None
+            Peers to probe, all the peers in the network if None.
+
+        timeout : float or None
+            See probe_peer_reachability.
+
+        use_cache : bool
+            Whether to use cached results or probe every peer again.
+
+        Returns
+        -------
+
+        reachability : dict of str : Reachability
+            By peer name.
+
+        """
+
+        peers = self.peers if peers is None else tuple(peers)
+
+        # each peer only once, even if given by an alias
+        peers = tuple({peer.name : peer for peer in peers}.values())
+
+        ttl = self.network_config.get('REACHABILITY_TTL',
+                                      DEFAULT_REACHABILITY_TTL)
+
+        # the routes of peers are raced at the same time
+        racing = [peer for peer in peers if self._races_routes(peer)]
+
+        if len(racing) > 1:
+
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(
+                    max_workers=min(len(racing), MAX_PROBE_WORKERS),
+            ) as executor:
+                list(executor.map(self.resolve_peer_connection, racing))
+
+        table = {}
+        to_probe = []
+        for peer in peers:
+
+            cache_key = peer_cache_key(peer, self.resolve_peer_connection(peer))
+
+            cached = read_cache('reachability', cache_key, ttl=ttl) if use_cache else None
+
+            if cached is None:
+                to_probe.append((peer, cache_key))
+            else:
+                table[peer.name] = Reachability(**cached)
+
+        if len(to_probe) > 0:
+
+            from concurrent.futures import ThreadPoolExecutor
+
+            # the probes just wait on the network
+            with span('network.probe_reachability', peers=len(to_probe)):
+                with ThreadPoolExecutor(
+                        max_workers=min(len(to_probe), MAX_PROBE_WORKERS),
+                ) as executor:
+
+                    probed = list(executor.map(
+                        lambda peer: self.probe_peer_reachability(peer, timeout=timeout),
+                        [peer for peer, _ in to_probe],
+                    ))
+
+            for (peer, cache_key), reachability in zip(to_probe, probed):
+
+                table[peer.name] = reachability
+
+                # a host that is down now may be up on the next try
+                if reachability.reachable:
+                    write_cache('reachability', cache_key, dc.asdict(reachability))
+
+        return {peer.name : table[peer.name] for peer in peers}
+
+    def probe_peer_link(self,
+                        local_cx,
+                        src_peer,
+                        target_peer,
+                        timeout: Optional[float] = None,
+    ) -> Reachability:
+        """Check whether a remote peer can connect to another one over
+        SSH by timing it from the first.
+
+        Connections which worked are cached on disk for 'ROUTE_TTL'
+        seconds (see the network config), failed ones are probed again
+        since they can be temporary.
+
+        Parameters
+        ----------
+
+        local_cx : Context
+
+        src_peer : Peer
+            The peer connecting.
+
+        target_peer : Peer
+            The peer connected to.
+
+        timeout : float or None
+            See 'PEER_PROBE_TIMEOUT' in the network config.
+
+        Returns
+        -------
+
+        reachability : Reachability
+            Of the target peer from the source peer.
+
+        """
+
+        if timeout is None:
+            timeout = self.network_config.get('PEER_PROBE_TIMEOUT',
+                                              DEFAULT_PEER_PROBE_TIMEOUT)
+
+        src_conn = self.resolve_peer_connection(src_peer)
+        target_conn = self.resolve_peer_connection(target_peer)
+
+        cache_key = (f"{peer_cache_key(src_peer, src_conn)}->"
+                     f"{peer_cache_key(target_peer, target_conn)}")
+
+        ttl = self.network_config.get('ROUTE_TTL', DEFAULT_ROUTE_TTL)
+
+        cached = read_cache('peer_links', cache_key, ttl=ttl)
+        if cached is not None:
+            return Reachability(**cached)
+
+        src_cx = self.resolve_peer_context(local_cx, src_peer)
+
+        command = peer_link_probe_command(self.rsh_command(target_conn),
+                                          target_conn,
+                                          timeout=timeout)
+
+        with span('network.probe_peer_link', src=src_peer.name, target=target_peer.name):
+            result = src_cx.run(command, hide=True, pty=False, warn=True)
+
+        fields = dict(line.split(maxsplit=1)
+                      for line in result.stdout.splitlines()
+                      if len(line.split(maxsplit=1)) == 2)
+
+        # without nanoseconds from date it just isn't timed
+        exit_code = fields.get('exit', '').strip()
+        elapsed = fields.get('ns', '').strip()
+        error = fields.get('error', '').strip()
+
+        if not exit_code.isdigit():
+            reachability = Reachability(target_peer.name, False,
+                                        f"couldn't probe from {src_peer.name}")
+
+        elif exit_code != '0':
+
+            reason = f"ssh from {src_peer.name} exited with {exit_code}"
+            if error != '':
+                reason = f"{reason}: {error}"
+
+            reachability = Reachability(target_peer.name, False, reason)
+
+        else:
+            reachability = Reachability(target_peer.name, True,
+                                        f"connected from {src_peer.name}",
+                                        rtt=int(elapsed) / 1e9 if elapsed.isdigit() else None)
+
+        # a failure can be the network or authentication, which may
+        # both be fixed before the next sync
+        if reachability.reachable:
+            write_cache('peer_links', cache_key, dc.asdict(reachability))
+
+        return reachability
+
+    def resolve_remote_route(self,
+                             local_cx,
+                             src_peer,
+                             target_peer,
+                             timeout: Optional[float] = None,
+    ) -> Tuple[str, str]:
+        """Choose how to sync between two remote peers.
+
+        Whether each peer can connect to the other is probed (see
+        probe_peer_link) and rsync is run on the one which connects
+        faster. If neither can the data is streamed through the
+        invoking host, which connects to both.
+
+        Parameters
+        ----------
+
+        local_cx : Context
+
+        src_peer : Peer
+
+        target_peer : Peer
+
+        timeout : float or None
+
+        Returns
+        -------
+
+        route : str
+            One of REMOTE_SYNC_ROUTES.
+
+        reason : str
+            Why it was chosen.
+
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+
+            push_future = executor.submit(self.probe_peer_link, local_cx,
+                                          src_peer, target_peer, timeout)
+            pull_future = executor.submit(self.probe_peer_link, local_cx,
+                                          target_peer, src_peer, timeout)
+
+            push, pull = push_future.result(), pull_future.result()
+
+        if push.reachable and pull.reachable:
+
+            if push.rtt is None or pull.rtt is None:
+                return 'push', "both can connect"
+
+            times = (f"{push.rtt * 1e3:.0f} ms from {src_peer.name}, "
+                     f"{pull.rtt * 1e3:.0f} ms from {target_peer.name}")
+
+            if pull.rtt < push.rtt:
+                return 'pull', f"both can connect, {target_peer.name} faster ({times})"
+            else:
+                return 'push', f"both can connect, {src_peer.name} faster ({times})"
+
+        elif push.reachable:
+            return 'push', f"only {src_peer.name} can connect to {target_peer.name}"
+
+        elif pull.reachable:
+            return 'pull', f"only {target_peer.name} can connect to {src_peer.name}"
+
+        return 'pipe', f"neither can connect to the other ({push.reason}; {pull.reason})"
+
+    def resolve_peer_env(self,
+                         local_cx,
+                         peer,
+                         var_names=(),
+    ) -> Mapping[str, str]:
+        """Get a snapshot of the environment variables of a peer.
+
+        Local peers just use the local environment. For remote peers all
+        the variables are fetched in a single command and cached on disk
+        (see 'PEER_ENV_TTL' in the network config) so that repeated
+        expansions don't need a round trip.
+
+        Parameters
+        ----------
+
+        local_cx : Context
+
+        peer : Peer
+
+        var_names : tuple of str
+            Variables needed in addition to the PEER_ENV_VARS.
+
+        Returns
+        -------
+
+        env : dict of str : str
+
+        """
+
+        var_names = tuple(dict.fromkeys(PEER_ENV_VARS + tuple(var_names)))
+
+        peer_conn = self.resolve_peer_connection(peer)
+
+        # the local environment is what the local context would expand
+        # anyways
+        if issubclass(type(peer_conn), LocalConnection):
+            return {name : os.environ.get(name, '') for name in var_names}
+
+        elif issubclass(type(peer_conn), ImpossibleConnection):
+            raise RefugueNetworkError(f"Impossible connection to peer: {peer}")
+
+        cache_key = peer_cache_key(peer, peer_conn)
+
+        ttl = self.network_config.get('PEER_ENV_TTL', DEFAULT_PEER_ENV_TTL)
+
+        env = read_cache('peer_env', cache_key, ttl=ttl)
+
+        if env is None or not all(name in env for name in var_names):
+
+            peer_cx = self.resolve_peer_context(local_cx, peer)
+
+            # fetch everything at once, NUL separated so any value is
+            # safe, and without a PTY so nothing gets mangled. This
+            # includes the SSH handshake if the connection isn't open
+            values_str = ' '.join(f'"${{{name}}}"' for name in var_names)
+            with span('network.fetch_peer_env', peer=peer.name):
+                result = peer_cx.run(
+                    f"printf '%s\\0' {values_str}",
+                    hide=True,
+                    pty=False,
+                )
+
+            values = result.stdout.split('\0')[:len(var_names)]
+
+            env = {**(env if env is not None else {}),
+                   **dict(zip(var_names, values))}
+
+            write_cache('peer_env', cache_key, env)
+
+        return env
+
+    def resolve_peer_capabilities(self,
+                                  local_cx,
+                                  peer,
+    ) -> dict:
+        """Get what the rsync of a peer supports.
+
+        The peer is probed with 'rsync --version' (local peers too) and
+        the results are cached on disk (see 'PEER_CAPABILITIES_TTL' in
+        the network config), so only planning with a cold cache needs
+        to contact the peer.
+
+        Parameters
+        ----------
+
+        local_cx : Context
+
+        peer : Peer
+
+        Returns
+        -------
+
+        capabilities : dict
+            With the key 'rsync', see parse_rsync_version.
+
+        """
+
+        peer_conn = self.resolve_peer_connection(peer)
+
+        if issubclass(type(peer_conn), ImpossibleConnection):
+            raise RefugueNetworkError(f"Impossible connection to peer: {peer}")
+
+        cache_key = peer_cache_key(peer, peer_conn)
+
+        ttl = self.network_config.get('PEER_CAPABILITIES_TTL',
+                                      DEFAULT_PEER_CAPABILITIES_TTL)
+
+        capabilities = read_cache('peer_capabilities', cache_key, ttl=ttl)
+
+        if capabilities is None:
+
+            peer_cx = self.resolve_peer_context(local_cx, peer)
+
+            # don't fail on a peer without rsync, what it supports is
+            # just unknown
+            with span('network.probe_peer', peer=peer.name):
+                result = peer_cx.run(
+                    'rsync --version',
+                    hide=True,
+                    pty=False,
+                    warn=True,
+                )
+
+            capabilities = {'rsync' : parse_rsync_version(result.stdout)}
+
+            write_cache('peer_capabilities', cache_key, capabilities)
+
+        return capabilities
+
     def resolve_peer_mount(self,
                            peer_cx,
                            peer,
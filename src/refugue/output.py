@@ -0,0 +1,643 @@
+"""Streaming handling of the output of sync processes.
+
+The output of rsync (or the native protocol) is parsed line by line
+into typed events as it is produced and aggregated in constant memory
+instead of being buffered.
+
+"""
+
+import sys
+import re
+import json
+import threading
+import functools
+import subprocess
+import dataclasses as dc
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import (
+    Optional,
+    Dict,
+    Callable,
+)
+
+__all__ = [
+    'OUTPUT_MODES',
+    'RSYNC_OUT_FORMAT',
+    'TransferEvent',
+    'OutputAggregator',
+    'parse_itemize_line',
+    'parse_rsync_stats',
+    'stream_command',
+    'open_command',
+    'output_label',
+]
+
+
+OUTPUT_MODES = (
+    # only errors and the final totals
+    'quiet',
+
+    # a line for each directory with changes and the final totals
+    'summary',
+
+    # every line of output
+    'full',
+
+    # every event as a JSON object on its own line
+    'jsonl',
+)
+
+RSYNC_OUT_FORMAT = "%i %l %b %n%L"
+"""The '--out-format' given to rsync so that the itemized changes
+include the size of each file and the bytes transferred for it."""
+
+DIR_SUMMARY_CAPACITY = 1024
+"""Maximum number of directories changes are aggregated for at once.
+The least recently changed directory is reported when this is
+exceeded, rsync mostly finishes directories in order so this is rarely
+before it is complete."""
+
+STREAM_CHUNK_SIZE = 1 << 16
+"""Number of bytes of output read at once when it isn't split into
+lines."""
+
+EVENT_KINDS = ('created', 'updated', 'attrs', 'deleted',)
+
+RSYNC_STATS_FIELDS = (
+    # label in the rsync output, key
+    ('Number of files', 'files'),
+    ('Number of created files', 'created_files'),
+    ('Number of deleted files', 'deleted_files'),
+    ('Number of regular files transferred', 'transferred_files'),
+    ('Total file size', 'total_size'),
+    ('Total transferred file size', 'transferred_size'),
+    ('Literal data', 'literal_data'),
+    ('Matched data', 'matched_data'),
+    ('File list size', 'file_list_size'),
+    ('Total bytes sent', 'bytes_sent'),
+    ('Total bytes received', 'bytes_received'),
+)
+"""The counters reported by rsync's '--stats' option."""
+
+_STATS_LABELS = dict(RSYNC_STATS_FIELDS)
+
+_STATS_LINE_RE = re.compile(r'^(?P<label>[A-Za-z ]+): (?P<number>[\d,.]+)(?P<unit>[KMGTPE]?)')
+
+_ITEMIZE_LINE_RE = re.compile(
+    r'^(?P<item>[<>ch.][fdLDS][^ ]{7,9}|\*deleting) +'
+    r'(?:(?P<size>[\d,.]+[KMGTPE]?) (?P<transferred>[\d,.]+[KMGTPE]?) )?'
+    r'(?P<path>.+)$'
+)
+
+_HUMAN_UNITS = ('', 'K', 'M', 'G', 'T', 'P', 'E')
+
+def parse_rsync_number(number, unit=''):
+    """Parse a number in rsync's output, which may have thousands
+    separators or a unit suffix (in units of 1000, i.e. '-h')."""
+
+    if unit == '' and number[-1:] in _HUMAN_UNITS[1:]:
+        number, unit = number[:-1], number[-1]
+
+    value = float(number.replace(',', ''))
+
+    return int(round(value * (1000 ** _HUMAN_UNITS.index(unit))))
+
+def parse_stats_line(line):
+    """Parse a line of rsync's '--stats' output into the stats key and
+    value, or None if it isn't one."""
+
+    match = _STATS_LINE_RE.match(line.strip())
+
+    if match is None or match.group('label') not in _STATS_LABELS:
+        return None
+
+    return (
+        _STATS_LABELS[match.group('label')],
+        parse_rsync_number(match.group('number'), match.group('unit')),
+    )
+
+def parse_rsync_stats(output):
+    """Parse the '--stats' section of rsync output.
+
+    Parameters
+    ----------
+
+    output : str
+
+    Returns
+    -------
+
+    stats : dict of str : int
+        Keys are from RSYNC_STATS_FIELDS, only the ones found are given.
+
+    """
+
+    stats = {}
+    for line in output.splitlines():
+
+        parsed = parse_stats_line(line)
+
+        if parsed is not None:
+            stats[parsed[0]] = parsed[1]
+
+    return stats
+
+@dc.dataclass
+class TransferEvent():
+    """A change made (or that would be made) to a path in the target."""
+
+    kind: str
+    """One of EVENT_KINDS"""
+
+    path: str
+
+    is_dir: bool
+
+    size: int = 0
+    """Size of the file."""
+
+    transferred: int = 0
+    """Number of bytes transferred for the file."""
+
+    item: str = ''
+    """The rsync itemize code for the change."""
+
+    @classmethod
+    def from_item(cls, item, path, size=0, transferred=0):
+        """Make an event from an rsync itemize code (e.g. '>f+++++++++')."""
+
+        # messages like '*deleting' have no file type, deleted
+        # directories only end with a slash
+        is_message = item.startswith('*')
+
+        if item.startswith('*deleting'):
+            kind = 'deleted'
+
+        elif item[0] in '<>':
+            kind = 'created' if item[2:].strip('+') == '' else 'updated'
+
+        elif item[0] in 'ch':
+            kind = 'created' if '+' in item else 'attrs'
+
+        else:
+            kind = 'attrs'
+
+        is_dir = (not is_message and item[1:2] == 'd') or path.endswith('/')
+
+        # symlinks are shown with their target
+        if not is_message and item[1:2] == 'L' and ' -> ' in path:
+            path = path.split(' -> ', 1)[0]
+
+        return cls(
+            kind = kind,
+            path = path.rstrip('/'),
+            is_dir = is_dir,
+            size = size,
+            transferred = transferred,
+            item = item.strip(),
+        )
+
+    def to_dict(self):
+        return {'type' : 'event', **dc.asdict(self)}
+
+def parse_itemize_line(line) -> Optional[TransferEvent]:
+    """Parse a line of itemized changes from rsync, None if it isn't
+    one."""
+
+    match = _ITEMIZE_LINE_RE.match(line)
+
+    if match is None:
+        return None
+
+    size = match.group('size')
+    transferred = match.group('transferred')
+
+    return TransferEvent.from_item(
+        match.group('item'),
+        match.group('path'),
+        size = parse_rsync_number(size) if size is not None else 0,
+        transferred = parse_rsync_number(transferred) if transferred is not None else 0,
+    )
+
+def _new_counts():
+
+    counts = {kind : 0 for kind in EVENT_KINDS}
+    counts['bytes'] = 0
+
+    return counts
+
+_THREAD_OUTPUT = threading.local()
+"""Per-thread defaults for the output of syncs, see output_label."""
+
+@contextmanager
+def output_label(label: Optional[str]):
+    """Label the output of the syncs run in this thread, e.g. with the
+    target replica when syncing to many at once.
+
+    Lines are prefixed with the label and JSON records get it as
+    'target'.
+
+    """
+
+    previous = getattr(_THREAD_OUTPUT, 'label', None)
+    _THREAD_OUTPUT.label = label
+    try:
+        yield
+    finally:
+        _THREAD_OUTPUT.label = previous
+
+class OutputAggregator():
+    """Consumes output lines and events, reports them according to the
+    output mode and keeps running totals.
+
+    Changes are counted per directory for at most DIR_SUMMARY_CAPACITY
+    directories at a time so memory use doesn't grow with the number
+    of files. It is safe to feed it from multiple threads.
+
+    """
+
+    def __init__(self,
+                 mode: str = 'full',
+                 stream = None,
+                 dir_capacity: int = DIR_SUMMARY_CAPACITY,
+                 label: Optional[str] = None,
+    ):
+
+        if mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode: {mode}")
+
+        self.mode = mode
+        self.stream = stream if stream is not None else sys.stdout
+        self.dir_capacity = dir_capacity
+
+        self.label = (label if label is not None
+                      else getattr(_THREAD_OUTPUT, 'label', None))
+        """Prefix for the output, defaults to the output_label of the
+        thread."""
+
+        self.totals = _new_counts()
+
+        self.stats = {}
+        """The stats reported by rsync, summed over all processes which
+        reported them."""
+
+        self._dirs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _write(self, text):
+
+        if self.label is not None:
+            text = f"[{self.label}] {text}"
+
+        self.stream.write(text + '\n')
+
+    def _write_json(self, record):
+
+        if self.label is not None:
+            record = {**record, 'target' : self.label}
+
+        self.stream.write(json.dumps(record) + '\n')
+
+    def handle_line(self, line):
+        """Handle a line of output from rsync."""
+
+        line = line.rstrip('\r\n')
+
+        event = parse_itemize_line(line)
+
+        if event is not None:
+            self.handle_event(event, line=line)
+            return
+
+        stat = parse_stats_line(line)
+
+        with self._lock:
+
+            if stat is not None:
+
+                key, value = stat
+                self.stats[key] = self.stats.get(key, 0) + value
+
+                if self.mode == 'full':
+                    self._write(line)
+
+                return
+
+            if line.strip() == '':
+                return
+
+            is_error = line.startswith('rsync:') or line.startswith('rsync error')
+
+            if self.mode == 'full' or (is_error and self.mode != 'jsonl'):
+                self._write(line)
+
+            elif self.mode == 'jsonl':
+                self._write_json({'type' : 'message', 'text' : line})
+
+    def message(self, text):
+        """Report progress of the sync itself, not shown when quiet."""
+
+        with self._lock:
+
+            if self.mode == 'jsonl':
+                self._write_json({'type' : 'message', 'text' : text})
+
+            elif self.mode != 'quiet':
+                self._write(text)
+
+    def handle_event(self, event: TransferEvent, line: Optional[str] = None):
+        """Handle a change to a path."""
+
+        with self._lock:
+
+            self.totals[event.kind] += 1
+            self.totals['bytes'] += event.transferred
+
+            if self.mode == 'full':
+                self._write(line if line is not None else f"{event.item} {event.path}")
+
+            elif self.mode == 'jsonl':
+                self._write_json(event.to_dict())
+
+            elif self.mode == 'summary':
+
+                dir_path = event.path.rsplit('/', 1)[0] if '/' in event.path else '.'
+
+                counts = self._dirs.pop(dir_path, None)
+                if counts is None:
+                    counts = _new_counts()
+
+                counts[event.kind] += 1
+                counts['bytes'] += event.transferred
+
+                # most recently changed last
+                self._dirs[dir_path] = counts
+
+                if len(self._dirs) > self.dir_capacity:
+                    self._write_dir(*self._dirs.popitem(last=False))
+
+    def _write_dir(self, dir_path, counts):
+
+        changes = ', '.join(f"{kind} {counts[kind]}"
+                            for kind in EVENT_KINDS
+                            if counts[kind] > 0)
+
+        self._write(f"{dir_path}/: {changes}, {format_bytes(counts['bytes'])}")
+
+    def finish(self) -> Dict[str, int]:
+        """Report what is left and the totals.
+
+        Returns
+        -------
+
+        stats : dict of str : int
+            The rsync stats.
+
+        """
+
+        with self._lock:
+
+            if self.mode == 'summary':
+                while len(self._dirs) > 0:
+                    self._write_dir(*self._dirs.popitem(last=False))
+
+            if self.mode == 'jsonl':
+                self._write_json({'type' : 'totals', **self.totals})
+                self._write_json({'type' : 'stats', **self.stats})
+
+            elif self.mode != 'full':
+                self._write(
+                    "Total: " +
+                    ', '.join(f"{kind} {self.totals[kind]}" for kind in EVENT_KINDS) +
+                    f", {format_bytes(self.totals['bytes'])} transferred"
+                )
+
+            return dict(self.stats)
+
+def format_bytes(size):
+    """Human readable byte counts."""
+
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(size) < 1000 or unit == 'TB':
+            break
+        size /= 1000
+
+    return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+
+def _iter_records(rfile, separator: bytes):
+    """Iterate over the records of a binary stream ending with the
+    separator, which is kept like the newline of lines."""
+
+    if separator == b'\n':
+        yield from rfile
+        return
+
+    remainder = b''
+    for chunk in iter(lambda: rfile.read(STREAM_CHUNK_SIZE), b''):
+
+        records = (remainder + chunk).split(separator)
+        remainder = records.pop()
+
+        for record in records:
+            yield record + separator
+
+    if remainder:
+        yield remainder
+
+def _feed_input(write, close, data):
+
+    try:
+        write(data)
+    finally:
+        close()
+
+def stream_command(cx,
+                   command: str,
+                   handle_line,
+                   in_stream: Optional[str] = None,
+                   separator: str = '\n',
+) -> int:
+    """Run a command in a context and pass each line of its standard
+    output to a function as it is produced, without keeping it.
+
+    Standard error is passed through.
+
+    Parameters
+    ----------
+
+    cx : invoke.Context or fabric.Connection
+
+    command : str
+
+    handle_line : callable
+        Called with each line of output (as str).
+
+    in_stream : str or None
+        Text to write to the standard input of the command, which is
+        closed afterwards.
+
+    separator : str
+        What lines end with, e.g. '\\0' for output which can have
+        newlines in it.
+
+    Returns
+    -------
+
+    exit_code : int
+
+    """
+
+    data = in_stream.encode('utf-8', 'surrogateescape') if in_stream is not None else None
+    separator = separator.encode()
+
+    # e.g. sandboxed peers run their commands through a wrapper
+    if hasattr(cx, 'wrap_command'):
+        command = cx.wrap_command(command)
+
+    # a fabric connection runs it on the remote peer
+    if hasattr(cx, 'client') and hasattr(cx, 'open'):
+        return _stream_remote(cx, command, handle_line, data, separator)
+
+    proc = subprocess.Popen(
+        command,
+        shell=True,
+        cwd=getattr(cx, 'cwd', None) or None,
+        stdin=subprocess.PIPE if data is not None else None,
+        stdout=subprocess.PIPE,
+    )
+
+    if data is not None:
+        feeder = threading.Thread(
+            target=_feed_input,
+            args=(proc.stdin.write, proc.stdin.close, data),
+            daemon=True,
+        )
+        feeder.start()
+
+    for line in _iter_records(proc.stdout, separator):
+        handle_line(line.decode('utf-8', 'surrogateescape'))
+
+    return proc.wait()
+
+def _stream_remote(cx, command, handle_line, data, separator):
+
+    cx.open()
+
+    channel = cx.client.get_transport().open_session()
+
+    try:
+        channel.exec_command(command)
+
+        if data is not None:
+            feeder = threading.Thread(
+                target=_feed_input,
+                args=(channel.sendall, channel.shutdown_write, data),
+                daemon=True,
+            )
+            feeder.start()
+
+        # standard error has to be drained at the same time
+        def _pass_stderr():
+            for line in channel.makefile_stderr('rb'):
+                sys.stderr.write(line.decode('utf-8', 'surrogateescape'))
+
+        stderr_thread = threading.Thread(target=_pass_stderr, daemon=True)
+        stderr_thread.start()
+
+        for line in _iter_records(channel.makefile('rb'), separator):
+            handle_line(line.decode('utf-8', 'surrogateescape'))
+
+        exit_code = channel.recv_exit_status()
+
+        stderr_thread.join()
+
+    finally:
+        channel.close()
+
+    return exit_code
+
+@dc.dataclass
+class CommandPipe():
+    """A command running in a context with binary pipes to its standard
+    streams, see open_command.
+
+    The reads give whatever is available (at most a number of bytes)
+    and an empty bytes at the end of the stream.
+
+    """
+
+    send: Callable[[bytes], None]
+    close_stdin: Callable[[], None]
+    recv: Callable[[int], bytes]
+    recv_stderr: Callable[[int], bytes]
+    wait: Callable[[], int]
+    close: Callable[[], None]
+
+def _send_local(proc, data):
+
+    proc.stdin.write(data)
+    proc.stdin.flush()
+
+def open_command(cx, command: str) -> CommandPipe:
+    """Start a command in a context without waiting for it, to stream
+    data into and out of it.
+
+    Parameters
+    ----------
+
+    cx : invoke.Context or fabric.Connection
+
+    command : str
+
+    Returns
+    -------
+
+    pipe : CommandPipe
+
+    """
+
+    if hasattr(cx, 'wrap_command'):
+        command = cx.wrap_command(command)
+
+    if hasattr(cx, 'client') and hasattr(cx, 'open'):
+
+        cx.open()
+
+        channel = cx.client.get_transport().open_session()
+        channel.exec_command(command)
+
+        return CommandPipe(
+            send = channel.sendall,
+            close_stdin = channel.shutdown_write,
+            recv = channel.recv,
+            recv_stderr = channel.recv_stderr,
+            wait = channel.recv_exit_status,
+            close = channel.close,
+        )
+
+    proc = subprocess.Popen(
+        command,
+        shell=True,
+        cwd=getattr(cx, 'cwd', None) or None,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    def _close():
+
+        for stream in (proc.stdin, proc.stdout, proc.stderr):
+            try:
+                stream.close()
+            except BrokenPipeError:
+                pass
+
+    return CommandPipe(
+        send = functools.partial(_send_local, proc),
+        close_stdin = proc.stdin.close,
+        recv = proc.stdout.read1,
+        recv_stderr = proc.stderr.read1,
+        wait = proc.wait,
+        close = _close,
+    )
@@ -0,0 +1,183 @@
+"""Lightweight instrumentation of the stages of a refugue invocation.
+
+Stages are wrapped in spans which are only recorded while tracing is
+enabled (e.g. with the '--profile' option), otherwise they cost a
+global lookup. The recorded spans can be written as a Chrome
+trace-event file (viewable in chrome://tracing or Perfetto) or
+summarized in a table.
+
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import (
+    Optional,
+    Dict,
+    Any,
+)
+
+__all__ = [
+    'Tracer',
+    'span',
+    'start_tracing',
+    'stop_tracing',
+]
+
+
+SUMMARY_PROFILE = 'summary'
+"""Value of the '--profile' option which prints a summary table
+instead of writing a trace file."""
+
+class Tracer():
+    """Records completed spans from any thread."""
+
+    def __init__(self):
+
+        self.spans = []
+        """Recorded spans as tuples of (name, start_ns, end_ns,
+        thread_id, args), in the order they completed."""
+
+        self._lock = threading.Lock()
+
+    def record(self,
+               name: str,
+               start_ns: int,
+               end_ns: int,
+               args: Optional[Dict[str, Any]] = None,
+    ):
+
+        with self._lock:
+            self.spans.append((name, start_ns, end_ns, threading.get_ident(), args))
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """Get the spans as Chrome trace-event 'complete' events."""
+
+        pid = os.getpid()
+
+        origin = min((start for _, start, _, _, _ in self.spans), default=0)
+
+        # make the thread ids small and stable
+        tids = {}
+
+        events = []
+        for name, start, end, thread_id, args in sorted(self.spans,
+                                                        key=lambda span: span[1]):
+
+            event = {
+                'name' : name,
+                'cat' : name.split('.', 1)[0],
+                'ph' : 'X',
+                'ts' : (start - origin) / 1e3,
+                'dur' : (end - start) / 1e3,
+                'pid' : pid,
+                'tid' : tids.setdefault(thread_id, len(tids)),
+            }
+
+            if args:
+                event['args'] = {key : str(value) for key, value in args.items()}
+
+            events.append(event)
+
+        return {
+            'traceEvents' : events,
+            'displayTimeUnit' : 'ms',
+        }
+
+    def write_chrome_trace(self, path):
+
+        with open(path, 'w') as trace_file:
+            json.dump(self.to_chrome_trace(), trace_file)
+
+    def summary(self) -> str:
+        """A table of the total, mean, and maximum time of each span name
+        with the most expensive first.
+
+        Spans are nested so the percentages (of the wall time from the
+        first span to the last) add up to more than 100.
+
+        """
+
+        if len(self.spans) == 0:
+            return "No spans recorded"
+
+        wall_ns = (max(end for _, _, end, _, _ in self.spans) -
+                   min(start for _, start, _, _, _ in self.spans))
+
+        totals = {}
+        for name, start, end, _, _ in self.spans:
+
+            calls, total, longest = totals.get(name, (0, 0, 0))
+            totals[name] = (calls + 1, total + (end - start), max(longest, end - start))
+
+        width = max(len('span'), max(len(name) for name in totals))
+
+        lines = [
+            f"{'span':<{width}} {'calls':>7} {'total ms':>10} "
+            f"{'mean ms':>10} {'max ms':>10} {'%':>6}",
+        ]
+
+        for name, (calls, total, longest) in sorted(totals.items(),
+                                                    key=lambda item: item[1][1],
+                                                    reverse=True):
+
+            lines.append(
+                f"{name:<{width}} {calls:>7} {total / 1e6:>10.2f} "
+                f"{total / calls / 1e6:>10.2f} {longest / 1e6:>10.2f} "
+                f"{100 * total / wall_ns if wall_ns > 0 else 0.0:>6.1f}"
+            )
+
+        lines.append(f"wall time: {wall_ns / 1e6:.2f} ms")
+
+        return '\n'.join(lines)
+
+_TRACER: Optional[Tracer] = None
+"""The tracer spans are recorded to, None when tracing is off."""
+
+def start_tracing() -> Tracer:
+    """Start recording spans to a new tracer."""
+
+    global _TRACER
+
+    _TRACER = Tracer()
+
+    return _TRACER
+
+def stop_tracing() -> Optional[Tracer]:
+    """Stop recording spans and get the tracer they were recorded to."""
+
+    global _TRACER
+
+    tracer, _TRACER = _TRACER, None
+
+    return tracer
+
+@contextmanager
+def span(name: str, **args):
+    """Time a block as a named span if tracing is on.
+
+    Parameters
+    ----------
+
+    name : str
+        Dotted name of the stage, the first component is used as the
+        category, e.g. 'config.evaluate'.
+
+    args
+        Extra details about the span to show in the trace.
+
+    """
+
+    tracer = _TRACER
+
+    if tracer is None:
+        yield
+        return
+
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        tracer.record(name, start, time.perf_counter_ns(), args)
@@ -0,0 +1,662 @@
+"""A sync protocol for replicas which are both on the local filesystem
+that copies files directly instead of running an external program.
+
+Files are copied with the fastest mechanism the filesystems support:
+reflinks (FICLONE) on copy-on-write filesystems, then
+os.copy_file_range, then os.sendfile and finally plain reads and
+writes.
+
+"""
+
+from pathlib import Path
+import dataclasses as dc
+import os
+import sys
+import os.path as osp
+import stat
+import errno
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Optional,
+    Callable,
+    Tuple,
+)
+
+from invoke import Context
+
+from refugue.image import (
+    Replica,
+    Image,
+    WorkingSet,
+)
+
+from refugue.network import (
+    RefugueNetworkError,
+    LocalConnection,
+)
+
+from refugue.sync import (
+    SyncProtocol,
+    SyncSpec,
+    SyncPolicy,
+    TransportPolicy,
+    SyncResult,
+    timed_phase,
+)
+
+from refugue.output import (
+    OutputAggregator,
+    TransferEvent,
+)
+
+from refugue.manifest import REPLICA_METADATA_DIR
+
+
+BACKUP_SUFFIX = '.refugue-backup'
+"""Suffix for files backed up with the 'rename' method."""
+
+TMP_PREFIX = '.refugue-tmp.'
+"""Prefix for partial files being copied into place."""
+
+PARTIAL_TRANSFER_EXIT_CODE = 23
+"""Exit code for a sync which failed partway, the same as rsync uses
+for a partial transfer due to an error."""
+
+FICLONE = 0x40049409
+"""The Linux ioctl request for cloning a file (i.e. a reflink)."""
+
+COPY_CHUNK_SIZE = 1 << 30
+"""Maximum number of bytes to copy in one copy_file_range or sendfile
+call."""
+
+DEFAULT_COPY_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+"""Number of threads copying files when not told otherwise."""
+
+# errors which just mean a copy mechanism isn't supported for the files
+_UNSUPPORTED_ERRNOS = frozenset((
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+    errno.EPERM,
+))
+
+
+def clone_file(src_fd, dst_fd) -> bool:
+    """Try to make dst a reflink of src, returns whether it worked."""
+
+    try:
+        import fcntl
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+    except (ImportError, OSError) as err:
+
+        if isinstance(err, OSError) and err.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+
+        return False
+
+    return True
+
+def copy_file_data(src_fd, dst_fd, size) -> str:
+    """Copy the contents of an open file to another using the fastest
+    available mechanism.
+
+    Parameters
+    ----------
+
+    src_fd : int
+
+    dst_fd : int
+
+    size : int
+        The size of the source file.
+
+    Returns
+    -------
+
+    method : str
+        The mechanism which was used.
+
+    """
+
+    if clone_file(src_fd, dst_fd):
+        return 'clone'
+
+    # copy in the kernel without going through user space
+    for method in ('copy_file_range', 'sendfile'):
+
+        if not hasattr(os, method):
+            continue
+
+        offset = 0
+        try:
+            while offset < size:
+
+                count = min(COPY_CHUNK_SIZE, size - offset)
+
+                if method == 'copy_file_range':
+                    copied = os.copy_file_range(src_fd, dst_fd, count)
+                else:
+                    copied = os.sendfile(dst_fd, src_fd, offset, count)
+
+                if copied == 0:
+                    break
+
+                offset += copied
+
+        except OSError as err:
+
+            if err.errno not in _UNSUPPORTED_ERRNOS or offset > 0:
+                raise
+
+            continue
+
+        # some filesystems (e.g. procfs and FUSE) don't support the
+        # mechanism and just copy nothing, or report no size at all,
+        # so they are read until the end instead
+        if offset == 0:
+            continue
+
+        # the file was truncated while copying
+        if offset != size:
+            raise OSError(errno.EIO,
+                          f"Copied {offset} of {size} bytes with {method}, "
+                          "the file changed while copying")
+
+        return method
+
+    with open(src_fd, 'rb', closefd=False) as rf, \
+         open(dst_fd, 'wb', closefd=False) as wf:
+        shutil.copyfileobj(rf, wf)
+
+    return 'copy'
+
+def copy_metadata(src_stat, dst_path, follow_symlinks=True):
+    """Copy the permissions, times and (when possible) ownership like
+    'rsync --archive'."""
+
+    # only root can give files away
+    if os.geteuid() == 0:
+        os.chown(dst_path, src_stat.st_uid, src_stat.st_gid,
+                 follow_symlinks=follow_symlinks)
+
+    if follow_symlinks or os.chmod in os.supports_follow_symlinks:
+        os.chmod(dst_path, stat.S_IMODE(src_stat.st_mode),
+                 follow_symlinks=follow_symlinks)
+
+    if follow_symlinks or os.utime in os.supports_follow_symlinks:
+        os.utime(dst_path,
+                 ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns),
+                 follow_symlinks=follow_symlinks)
+
+def copy_file(src_path, dst_path, src_stat, backup=None) -> str:
+    """Copy a regular file into place atomically with its metadata.
+
+    The data is written to a temporary file next to the destination
+    which is then renamed over it.
+
+    Parameters
+    ----------
+
+    src_path : str
+
+    dst_path : str
+
+    src_stat : os.stat_result
+
+    backup : str or None
+        If given the existing destination is renamed with this suffix
+        instead of replaced.
+
+    Returns
+    -------
+
+    method : str
+        The mechanism used to copy the data.
+
+    """
+
+    dst_dir, dst_name = osp.split(dst_path)
+    tmp_path = osp.join(dst_dir, f"{TMP_PREFIX}{dst_name}")
+
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        dst_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            method = copy_file_data(src_fd, dst_fd, src_stat.st_size)
+        finally:
+            os.close(dst_fd)
+
+    except BaseException:
+
+        if osp.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    finally:
+        os.close(src_fd)
+
+    copy_metadata(src_stat, tmp_path)
+
+    if backup is not None and osp.lexists(dst_path):
+        backup_path(dst_path, backup)
+
+    os.replace(tmp_path, dst_path)
+
+    return method
+
+def backup_path(path, backup):
+    """Rename a file or directory tree with the backup suffix, an older
+    backup is replaced like rsync does."""
+
+    backed_up = path + backup
+
+    # a directory (or a file in place of one) can't be renamed over
+    if osp.isdir(backed_up) and not osp.islink(backed_up):
+        shutil.rmtree(backed_up)
+
+    elif osp.lexists(backed_up) and osp.isdir(path) and not osp.islink(path):
+        os.unlink(backed_up)
+
+    os.replace(path, backed_up)
+
+def remove_path(path, backup=None):
+    """Remove a file or directory tree, or back it up by renaming it
+    with the backup suffix."""
+
+    if backup is not None:
+        backup_path(path, backup)
+
+    elif osp.isdir(path) and not osp.islink(path):
+        shutil.rmtree(path)
+
+    else:
+        os.unlink(path)
+
+
+@dc.dataclass
+class NativeSyncer():
+    """Walks a pair of local trees and brings the target up to date with
+    the source according to a working set and sync policy.
+
+    Directory traversal and metadata updates happen in the calling
+    thread while file data is copied by a pool of worker threads.
+
+    """
+
+    src_root: str
+    target_root: str
+    wset: WorkingSet
+    sync_pol: SyncPolicy
+    transport_pol: TransportPolicy
+
+    workers: int = DEFAULT_COPY_WORKERS
+    verbose: bool = True
+
+    output: Optional[OutputAggregator] = None
+    """Where changes are reported, if not given they are printed."""
+
+    def __post_init__(self):
+
+        self.backup = BACKUP_SUFFIX if self.transport_pol.backup == 'rename' else None
+
+        self.stats = {
+            'files' : 0,
+            'created_files' : 0,
+            'deleted_files' : 0,
+            'transferred_files' : 0,
+            'total_size' : 0,
+            'transferred_size' : 0,
+        }
+
+        self.copy_methods = {}
+        self._copy_methods_lock = threading.Lock()
+
+    def itemize(self, item, path, size=0):
+
+        if not self.verbose:
+            return
+
+        if self.output is not None:
+            self.output.handle_event(TransferEvent.from_item(item, path, size, size))
+        else:
+            print(f"{item} {path}")
+
+    def message(self, text):
+
+        if self.output is not None:
+            self.output.message(text)
+        else:
+            print(text, file=sys.stderr)
+
+    def is_metadata(self, rel_dir, name):
+        """Whether an entry is the directory refugue keeps its own files
+        in at the top of a replica, which is never synced."""
+
+        return rel_dir == '' and os.fsencode(name) == REPLICA_METADATA_DIR
+
+    def is_protected(self, rel_path, is_dir):
+        """Whether a target entry must not be deleted."""
+
+        # like rsync, excluded files are protected unless pruning and
+        # backups are always protected unless pruning
+        if self.sync_pol.prune:
+            return False
+
+        if self.backup is not None and rel_path.endswith(self.backup):
+            return True
+
+        return not self.wset.contains(rel_path, is_dir)
+
+    def sync(self):
+        """Run the sync.
+
+        Returns
+        -------
+
+        stats : dict of str : int
+            Counts named like the keys of rsync's stats.
+
+        """
+
+        if not self.transport_pol.dry:
+            os.makedirs(self.target_root, exist_ok=True)
+
+        # directory metadata is set after everything inside of them is
+        # done, deepest first
+        self._dirs = []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            self._executor = executor
+            self._futures = []
+
+            self._sync_dir('')
+
+            # raise the first error from copying
+            for future in self._futures:
+                future.result()
+
+        if not self.transport_pol.dry:
+            for src_stat, target_path in reversed(self._dirs):
+                copy_metadata(src_stat, target_path)
+
+        return self.stats
+
+    def _scan(self, dir_path):
+
+        try:
+            with os.scandir(dir_path) as entries:
+                return {entry.name : entry for entry in entries}
+
+        except FileNotFoundError:
+            return {}
+
+    def _sync_dir(self, rel_dir):
+
+        src_dir = osp.join(self.src_root, rel_dir)
+        target_dir = osp.join(self.target_root, rel_dir)
+
+        src_entries = {}
+        for name, entry in self._scan(src_dir).items():
+
+            if self.is_metadata(rel_dir, name):
+                continue
+
+            rel_path = osp.join(rel_dir, name)
+
+            if self.wset.contains(rel_path, entry.is_dir(follow_symlinks=False)):
+                src_entries[name] = entry
+
+        target_entries = self._scan(target_dir)
+
+        ## Deletions
+
+        if self.sync_pol.clean or self.sync_pol.prune:
+
+            for name, target_entry in target_entries.items():
+
+                rel_path = osp.join(rel_dir, name)
+                target_is_dir = target_entry.is_dir(follow_symlinks=False)
+
+                if (name in src_entries or name.startswith(TMP_PREFIX) or
+                    self.is_metadata(rel_dir, name)):
+                    continue
+
+                if self.is_protected(rel_path, target_is_dir):
+                    continue
+
+                self.itemize('*deleting  ', rel_path + ('/' if target_is_dir else ''))
+                self.stats['deleted_files'] += 1
+
+                if not self.transport_pol.dry:
+                    remove_path(target_entry.path, backup=self.backup)
+
+        ## Updates
+
+        for name, src_entry in sorted(src_entries.items()):
+
+            rel_path = osp.join(rel_dir, name)
+            target_path = osp.join(target_dir, name)
+            target_entry = target_entries.get(name, None)
+
+            src_stat = src_entry.stat(follow_symlinks=False)
+
+            self.stats['files'] += 1
+
+            # new files aren't created when injecting
+            if target_entry is None and self.sync_pol.inject:
+                continue
+
+            # the type changed so the old one has to go first
+            if (target_entry is not None and
+                stat.S_IFMT(target_entry.stat(follow_symlinks=False).st_mode)
+                != stat.S_IFMT(src_stat.st_mode)):
+
+                if not self.transport_pol.dry:
+                    remove_path(target_entry.path, backup=self.backup)
+
+                target_entry = None
+
+            if stat.S_ISDIR(src_stat.st_mode):
+
+                if target_entry is None:
+
+                    self.itemize('cd+++++++++', rel_path + '/')
+                    self.stats['created_files'] += 1
+
+                    if not self.transport_pol.dry:
+                        os.mkdir(target_path)
+
+                if not self.transport_pol.dry:
+                    self._dirs.append((src_stat, target_path))
+
+                self._sync_dir(rel_path)
+
+            elif stat.S_ISLNK(src_stat.st_mode):
+
+                link_target = os.readlink(src_entry.path)
+
+                if (target_entry is not None and
+                    os.readlink(target_path) == link_target):
+                    continue
+
+                self.itemize('cL+++++++++', f"{rel_path} -> {link_target}")
+
+                if target_entry is None:
+                    self.stats['created_files'] += 1
+
+                if not self.transport_pol.dry:
+
+                    if target_entry is not None:
+                        remove_path(target_path, backup=self.backup)
+
+                    os.symlink(link_target, target_path)
+                    copy_metadata(src_stat, target_path, follow_symlinks=False)
+
+            elif stat.S_ISREG(src_stat.st_mode):
+
+                self.stats['total_size'] += src_stat.st_size
+
+                if target_entry is not None:
+
+                    target_stat = target_entry.stat(follow_symlinks=False)
+
+                    # the same quick check as rsync
+                    if (target_stat.st_size == src_stat.st_size and
+                        target_stat.st_mtime_ns == src_stat.st_mtime_ns):
+                        continue
+
+                    # unless clobbering never overwrite newer files
+                    if (not self.sync_pol.clobber and
+                        target_stat.st_mtime_ns > src_stat.st_mtime_ns):
+                        continue
+
+                    self.itemize('>f.st......', rel_path, src_stat.st_size)
+
+                else:
+                    self.itemize('>f+++++++++', rel_path, src_stat.st_size)
+                    self.stats['created_files'] += 1
+
+                self.stats['transferred_files'] += 1
+                self.stats['transferred_size'] += src_stat.st_size
+
+                if not self.transport_pol.dry:
+                    self._futures.append(self._executor.submit(
+                        self._copy_file,
+                        src_entry.path,
+                        target_path,
+                        src_stat,
+                    ))
+
+            # IDEA: support devices and other special files
+            else:
+                self.message(f"skipping non-regular file \"{rel_path}\"")
+
+    def _copy_file(self, src_path, target_path, src_stat):
+
+        method = copy_file(src_path, target_path, src_stat, backup=self.backup)
+
+        with self._copy_methods_lock:
+            self.copy_methods[method] = self.copy_methods.get(method, 0) + 1
+
+
+@dc.dataclass
+class NativeProtocol(SyncProtocol):
+    """Syncs replicas which are both on the local filesystem in-process."""
+
+    @classmethod
+    def validate_sync_spec(cls,
+                           sync_spec: SyncSpec,
+    ):
+        """Validate that the sync_spec is supported by this protocol."""
+
+        # compression and encryption don't mean anything locally
+        return sync_spec.transport_pol.backup in (None, 'rename')
+
+    @classmethod
+    def supports_pair(cls,
+                      image: Image,
+                      src: Replica,
+                      target: Replica,
+    ) -> bool:
+        """Whether the protocol can sync between the replicas."""
+
+        return all(
+            issubclass(type(image.network.resolve_peer_connection(replica.peer)),
+                       LocalConnection)
+            for replica in (src, target)
+        )
+
+    @classmethod
+    def gen_sync_func(cls,
+                      local_cx: Context,
+                      image: Image,
+                      src: Replica,
+                      target: Replica,
+                      sync_spec: SyncSpec,
+                      subtree = None,
+    ) -> Tuple[Callable[[Context, Context, Context], SyncResult], str]:
+
+        ## Validate
+
+        if not cls.validate_sync_spec(sync_spec):
+            raise ValueError(f"Invalid SyncSpec for this protocol: {cls.__name__}")
+
+        if not cls.supports_pair(image, src, target):
+            raise RefugueNetworkError(
+                f"Both replicas must be local for the native protocol: "
+                f"{src.peer.name}, {target.peer.name}")
+
+        src_replica_path = Path(image.resolve_replica_path(local_cx, src))
+        target_replica_path = Path(image.resolve_replica_path(local_cx, target))
+
+        if subtree is not None:
+
+            src_replica_path = src_replica_path / subtree
+            target_replica_path = target_replica_path / subtree
+
+        sync_pol = sync_spec.sync_pol
+        transport_pol = sync_spec.transport_pol
+
+        # like rsync the filters are relative to the subtree being
+        # synced
+        wset = target.wset
+
+        workers = (transport_pol.parallel
+                   if transport_pol.parallel > 1
+                   else DEFAULT_COPY_WORKERS)
+
+        def _sync_func(local_cx, src_cx, target_cx):
+
+            output = OutputAggregator(transport_pol.output)
+
+            syncer = NativeSyncer(
+                src_root = str(src_replica_path),
+                target_root = str(target_replica_path),
+                wset = wset,
+                sync_pol = sync_pol,
+                transport_pol = transport_pol,
+                workers = workers,
+                output = output,
+            )
+
+            result = SyncResult('native', dry=transport_pol.dry)
+
+            try:
+                with timed_phase(result.phases, 'transfer'):
+                    syncer.sync()
+
+            except OSError as err:
+                print(f"refugue: native sync failed: {err}", file=sys.stderr)
+                result.exit_code = PARTIAL_TRANSFER_EXIT_CODE
+
+            output.finish()
+
+            result.add_stats(syncer.stats)
+            result.changes = dict(output.totals)
+            result.copy_methods = dict(syncer.copy_methods)
+
+            return result
+
+        policy_flags = [field.name for field in dc.fields(sync_pol)
+                        if getattr(sync_pol, field.name)]
+
+        confirm_message = '\n'.join([
+            f"native copy{' (dry run)' if transport_pol.dry else ''} "
+            f"with {workers} workers",
+            f"    from: {src_replica_path}/",
+            f"    to: {target_replica_path}",
+            f"    sync policy: {', '.join(policy_flags) if policy_flags else 'None'}",
+            f"    backup: {transport_pol.backup}",
+            f"    includes: {', '.join(wset.includes)}",
+            f"    excludes: {', '.join(wset.excludes)}",
+        ])
+
+        return _sync_func, confirm_message
+
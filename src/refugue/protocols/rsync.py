@@ -1,5 +1,17 @@
 from pathlib import Path
 import dataclasses as dc
+import io
+import os
+import re
+import hashlib
+import heapq
+import shlex
+import shutil
+import threading
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed,
+)
 from typing import (
     Optional,
     Union,
@@ -7,6 +19,7 @@ from typing import (
     Callable,
     Mapping,
     Any,
+    List,
 )
 
 from invoke import Context
@@ -15,19 +28,616 @@ import py_rsync as rsync
 from refugue.image import (
     Replica,
     Image,
+    render_sync_filter,
+)
+
+from refugue.cache import (
+    atomic_write,
+    cache_dir,
 )
+from refugue.profiling import span
 
 from refugue.network import (
     RefugueNetworkError,
     LocalConnection,
     ImpossibleConnection,
     SSHConnection,
+    LINK_CLASSES,
 )
 
 from refugue.sync import (
     SyncProtocol,
     SyncSpec,
+    SyncResult,
+    RefugueSyncError,
+    ScanPool,
+    timed_phase,
+)
+
+from refugue.output import (
+    RSYNC_OUT_FORMAT,
+    RSYNC_STATS_FIELDS,
+    OutputAggregator,
+    stream_command,
+    open_command,
+)
+
+from refugue.manifest import (
+    Manifest,
+    baseline_dir,
+    source_scan_dir,
+    wset_fingerprint,
+    record_baseline,
+    diff_paths,
+    scan_local_manifest,
+    scan_context_manifest,
+)
+
+
+SHARDS_PER_WORKER = 4
+"""Number of shards to split a replica into for each parallel worker.
+More shards balance the load between workers better at the cost of
+starting more rsync processes."""
+
+SKIP_COMPRESS_SUFFIXES = (
+    # archives
+    '7z', 'bz2', 'gz', 'lz4', 'lzma', 'rar', 'tbz', 'tgz', 'txz', 'xz',
+    'zip', 'zst',
+    # media
+    'avi', 'flac', 'gif', 'jpeg', 'jpg', 'mkv', 'mov', 'mp3', 'mp4',
+    'ogg', 'png', 'webm', 'webp',
+    # packages and documents which are zip files
+    'deb', 'docx', 'jar', 'odt', 'rpm', 'whl', 'xlsx',
+    # compressed data formats
+    'h5', 'npz', 'parquet',
 )
+"""Suffixes of files which are already compressed, given to
+'--skip-compress' so they aren't compressed again."""
+
+PIPE_RSH = ("sh -c 'shift; printf \"%s\\n\" \"$*\" >&4; "
+            "exec 5<&0; cat <&5 >&4 & exec cat <&3' pipe")
+"""The remote shell rsync is given to reach the source through the
+invoking host (see pipe_rsync). It prints the command rsync wants to
+run on the source and then passes its data to and from the file
+descriptors which pipe_rsync opens on the connection to this host
+(standard input is duplicated since background commands get
+/dev/null)."""
+
+PIPE_CHUNK_SIZE = 64 * 1024
+"""Number of bytes passed between the piped rsync processes at
+once."""
+
+RSYNC_LINK_PROFILES = {
+
+    # local copies are bound by the disk, the delta algorithm and
+    # compression only cost CPU
+    'same-host' : {
+        'whole_file' : True,
+        'compress' : False,
+        'compress_choice' : (),
+        'checksum_choice' : (),
+        'skip_compress' : False,
+        'delete_timing' : 'delete-during',
+        'inplace' : False,
+    },
+
+    # a drive is bound by the disk like local copies, writing in place
+    # would save writing files twice but leaves partially written files
+    # behind if the transfer is interrupted so it has to be opted into
+    'local-drive' : {
+        'whole_file' : True,
+        'compress' : False,
+        'compress_choice' : (),
+        'checksum_choice' : (),
+        'skip_compress' : False,
+        'delete_timing' : 'delete-during',
+        'inplace' : False,
+    },
+
+    # sending whole files is usually faster than computing deltas on a
+    # fast network
+    'lan' : {
+        'whole_file' : True,
+        'compress' : False,
+        'compress_choice' : (),
+        'checksum_choice' : ('xxh128', 'xxh3', 'xxh64', 'md5'),
+        'skip_compress' : False,
+        'delete_timing' : 'delete-during',
+        'inplace' : False,
+    },
+
+    # the bandwidth is the bottleneck so send as little as possible
+    'wan' : {
+        'whole_file' : False,
+        'compress' : True,
+        # algorithm and level in order of preference
+        'compress_choice' : (('zstd', 3), ('lz4', None), ('zlib', 6)),
+        'checksum_choice' : ('xxh128', 'xxh3', 'xxh64', 'md5'),
+        'skip_compress' : True,
+        # don't delete anything until the transfer succeeded
+        'delete_timing' : 'delete-delay',
+        'inplace' : False,
+    },
+}
+"""Tuning of the rsync options for each class of link (see
+network.LINK_CLASSES). Can be updated for each link class with
+'RSYNC_PROFILES' in the network config."""
+
+DELETE_FLAGS = ('delete', 'delete-before', 'delete-during', 'delete-delay', 'delete-after',)
+"""The flags which turn on deleting files in the target."""
+
+def rsync_link_profile(link, overrides=None):
+    """Get the rsync tuning profile for a class of link.
+
+    Parameters
+    ----------
+
+    link : str or None
+        One of network.LINK_CLASSES, None is treated as 'wan'.
+
+    overrides : dict of str : dict or None
+        Updates to the profiles by link class, i.e. RSYNC_PROFILES from
+        the network config.
+
+    Returns
+    -------
+
+    profile : dict
+
+    """
+
+    if link is None:
+        link = 'wan'
+
+    profile = dict(RSYNC_LINK_PROFILES[link])
+
+    if overrides is not None and link in overrides:
+        profile.update(overrides[link])
+
+    return profile
+
+def common_rsync_capabilities(*peer_capabilities):
+    """Get what the rsyncs on all of the peers support.
+
+    Parameters
+    ----------
+
+    peer_capabilities : dict
+        As from Network.resolve_peer_capabilities.
+
+    Returns
+    -------
+
+    capabilities : dict
+        With the keys 'compress_choices' and 'checksum_choices', in the
+        order of the first peer.
+
+    """
+
+    capabilities = {}
+    for key in ('compress_choices', 'checksum_choices'):
+
+        choices = [set(caps['rsync'][key]) for caps in peer_capabilities[1:]]
+
+        capabilities[key] = [choice
+                             for choice in peer_capabilities[0]['rsync'][key]
+                             if all(choice in others for others in choices)]
+
+    return capabilities
+
+def format_rsync_stats(stats):
+    """Format stats like rsync would."""
+
+    return '\n'.join(f"{label}: {stats[key]:,}"
+                     for label, key in RSYNC_STATS_FIELDS
+                     if key in stats)
+
+def partition_shards(weights, n_shards):
+    """Greedily partition named items into shards with similar total
+    weights.
+
+    Parameters
+    ----------
+
+    weights : dict of str : int
+
+    n_shards : int
+        Maximum number of shards.
+
+    Returns
+    -------
+
+    shards : list of (int, tuple of str)
+        The total weight and names for each non-empty shard, heaviest
+        first.
+
+    """
+
+    # the lightest shard is always at the top of the heap
+    bins = [(0, idx, []) for idx in range(n_shards)]
+
+    for name, weight in sorted(weights.items(),
+                               key=lambda item: item[1],
+                               reverse=True):
+
+        total, idx, names = heapq.heappop(bins)
+        names.append(name)
+        heapq.heappush(bins, (total + weight, idx, names))
+
+    shards = [(total, tuple(names))
+              for total, _, names in bins
+              if len(names) > 0]
+
+    return sorted(shards, key=lambda shard: shard[0], reverse=True)
+
+REMOTE_FILTER_DIR = ".cache/refugue/filters"
+"""Where filter files are staged on remote peers, relative to the
+home directory (where remote commands are run)."""
+
+def filter_file_path(filter_text, local=True):
+    """Get the path of the filter file for some filter rules on the
+    peer executing rsync.
+
+    Files are named by the hash of their contents so they only need to be
+    written once.
+
+    """
+
+    name = hashlib.sha256(filter_text.encode()).hexdigest()[:16] + '.rules'
+
+    if local:
+        return str(cache_dir() / 'filters' / name)
+    else:
+        return f"{REMOTE_FILTER_DIR}/{name}"
+
+def stage_filter_file(cx, filter_text, local=True):
+    """Make sure the filter file exists on the peer of the context
+    which executes rsync."""
+
+    path = filter_file_path(filter_text, local=local)
+
+    if local:
+
+        path = Path(path)
+
+        if path.exists():
+            return
+
+        with atomic_write(path) as wf:
+            wf.write(filter_text)
+
+    else:
+
+        cx.run(f"mkdir -p {REMOTE_FILTER_DIR}", hide=True, pty=False)
+        cx.put(io.BytesIO(filter_text.encode()), remote=path)
+
+def finish_result(output, result):
+    """Report the totals of the output and add its stats and changes
+    to the result."""
+
+    result.add_stats(output.finish())
+    result.changes = dict(output.totals)
+
+    return result
+
+def run_rsync(cx, command_str, output, in_stream=None):
+    """Run an rsync command streaming its output to an aggregator.
+
+    Raises
+    ------
+
+    RefugueSyncError
+        If rsync fails.
+
+    """
+
+    with span('rsync.run'):
+
+        if isinstance(cx, PipedContext):
+            exit_code = pipe_rsync(cx.cx, cx.remote_cx, command_str,
+                                   output.handle_line, in_stream=in_stream)
+
+        else:
+            exit_code = stream_command(cx, command_str, output.handle_line,
+                                       in_stream=in_stream)
+
+    if exit_code != 0:
+        raise RefugueSyncError(f"rsync exited with code {exit_code}",
+                               exit_code=exit_code)
+
+class PipedContext():
+    """The context of a peer which executes rsync through the invoking
+    host, see pipe_rsync.
+
+    rsync run with run_rsync reaches the other peer through the
+    invoking host, everything else is run on the peer as usual.
+
+    """
+
+    def __init__(self, cx, remote_cx):
+
+        self.cx = cx
+        self.remote_cx = remote_cx
+
+    def __getattr__(self, name):
+
+        return getattr(self.cx, name)
+
+def _pipe_stream(recv, send, close):
+    """Pass a stream between commands until it ends."""
+
+    try:
+        for chunk in iter(lambda: recv(PIPE_CHUNK_SIZE), b''):
+            send(chunk)
+
+    except (BrokenPipeError, OSError):
+        pass
+
+    finally:
+        try:
+            close()
+        except (BrokenPipeError, OSError):
+            pass
+
+def _pipe_lines(recv, handle_line):
+    """Pass each line of a stream to a function."""
+
+    remainder = b''
+    for chunk in iter(lambda: recv(PIPE_CHUNK_SIZE), b''):
+
+        *lines, remainder = (remainder + chunk).split(b'\n')
+
+        for line in lines:
+            handle_line(line.decode('utf-8', 'surrogateescape'))
+
+    if remainder:
+        handle_line(remainder.decode('utf-8', 'surrogateescape'))
+
+def pipe_rsync(cx, remote_cx, command_str, handle_line, in_stream=None) -> int:
+    """Run an rsync command in a context with the remote peer of the
+    command reached through the invoking host instead of directly.
+
+    rsync is given PIPE_RSH as its remote shell, which prints the
+    command to run on the remote peer ('rsync --server ...') and then
+    passes the data of the rsync protocol over the standard input and
+    output of the connection to the invoking host. The output of rsync
+    is moved to standard error for this. The invoking host runs the
+    command on the remote peer with its own connection and credentials
+    and passes the data between the two.
+
+    Parameters
+    ----------
+
+    cx : Context
+        Where rsync is executed.
+
+    remote_cx : Context
+        The peer of the remote endpoint of the command.
+
+    command_str : str
+        The rsync command, with PIPE_RSH as its remote shell.
+
+    handle_line : callable
+        Called with each line of output of either rsync.
+
+    in_stream : str or None
+        Standard input for rsync.
+
+    Returns
+    -------
+
+    exit_code : int
+
+    """
+
+    data = (in_stream.encode('utf-8', 'surrogateescape')
+            if in_stream is not None else b'')
+
+    # the standard input is read into a file first since the
+    # connection's is taken by the rsync protocol afterwards
+    if len(data) > 0:
+        setup = (f'f=$(mktemp) && head -c {len(data)} >"$f" && '
+                 'exec 3<&0 4>&1 1>&2 <"$f" && rm -f "$f"')
+    else:
+        setup = 'exec 3<&0 4>&1 1>&2 </dev/null'
+
+    pipe = open_command(cx, f"{setup} && {command_str}")
+
+    remote_pipe = None
+    threads = []
+    try:
+
+        output_thread = threading.Thread(
+            target=_pipe_lines,
+            args=(pipe.recv_stderr, handle_line),
+            daemon=True,
+        )
+        output_thread.start()
+        threads.append(output_thread)
+
+        if len(data) > 0:
+            pipe.send(data)
+
+        # the remote command comes first on its own line, anything
+        # after it is already data
+        head = b''
+        while b'\n' not in head:
+
+            chunk = pipe.recv(PIPE_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+
+            head += chunk
+
+        if b'\n' in head:
+
+            remote_command, head = head.split(b'\n', 1)
+
+            remote_pipe = open_command(
+                remote_cx,
+                remote_command.decode('utf-8', 'surrogateescape'),
+            )
+
+            if len(head) > 0:
+                remote_pipe.send(head)
+
+            threads.extend([
+                threading.Thread(target=_pipe_stream,
+                                 args=(pipe.recv, remote_pipe.send,
+                                       remote_pipe.close_stdin),
+                                 daemon=True),
+                threading.Thread(target=_pipe_stream,
+                                 args=(remote_pipe.recv, pipe.send, pipe.close_stdin),
+                                 daemon=True),
+                threading.Thread(target=_pipe_lines,
+                                 args=(remote_pipe.recv_stderr, handle_line),
+                                 daemon=True),
+            ])
+
+            for thread in threads[1:]:
+                thread.start()
+
+        exit_code = pipe.wait()
+
+        if remote_pipe is not None:
+            remote_pipe.wait()
+
+        for thread in threads:
+            thread.join()
+
+    finally:
+        pipe.close()
+
+        if remote_pipe is not None:
+            remote_pipe.close()
+
+    return exit_code
+
+def render_read_batch_command(options, dest_endpoint):
+    """Render an rsync command which applies a batch file (given with
+    'read-batch' in the options) to a destination.
+
+    The batch file takes the place of the source but py_rsync always
+    renders one, so it is dropped from the command.
+
+    """
+
+    lines = rsync.Command(
+        src=dest_endpoint,
+        dest=dest_endpoint,
+        options=options,
+    ).render().rstrip('\n').split('\n')
+
+    # the source is the second to last line
+    return '\n'.join(lines[:-2] + lines[-1:]) + '\n'
+
+@dc.dataclass
+class RsyncPlan():
+    """The compiled options and endpoints of an rsync command for a
+    pair of replicas."""
+
+    link: str
+    options: Any
+    src_endpoint: Any
+    target_endpoint: Any
+
+    ex_endpoint: str
+    """Which endpoint executes rsync, 'src' or 'target'."""
+
+    src_replica_path: Path
+    target_replica_path: Path
+    src_local: bool
+    target_local: bool
+
+    filter_text: str
+    """The merge file of filter rules, see image.render_sync_filter."""
+
+    route: Optional[str] = None
+    """How two remote replicas are synced, one of
+    network.REMOTE_SYNC_ROUTES, None if either is local."""
+
+    route_reason: str = ''
+
+
+    @property
+    def ex_local(self) -> bool:
+
+        return self.src_local if self.ex_endpoint == 'src' else self.target_local
+
+    def describe_route(self) -> Optional[str]:
+        """Where rsync is executed for two remote replicas and why."""
+
+        if self.route is None:
+            return None
+
+        descriptions = {
+            'push' : "executed on the source, pushing to the target",
+            'pull' : "executed on the target, pulling from the source",
+            'pipe' : "executed on the target, pulling from the source through this host",
+        }
+
+        return f"{descriptions[self.route]}: {self.route_reason}"
+
+    def pipe_contexts(self, src_cx, target_cx):
+        """The contexts to sync in, for the 'pipe' route rsync on the
+        target reaches the source through the invoking host."""
+
+        if self.route != 'pipe':
+            return src_cx, target_cx
+
+        return src_cx, PipedContext(target_cx, src_cx)
+
+    def stage_filter(self, src_cx, target_cx):
+        """Make sure the filter file exists where rsync is executed."""
+
+        ex_cx = src_cx if self.ex_endpoint == 'src' else target_cx
+
+        stage_filter_file(ex_cx, self.filter_text, self.ex_local)
+
+class _BatchState():
+    """Coordinates the syncs of a batch between threads.
+
+    The reference sync announces when the state of its target before the
+    sync is scanned and when the batch is written, the others wait for
+    these and the last one to finish removes the batch.
+
+    """
+
+    def __init__(self, batch_dir: Path, n_syncs: int):
+
+        # made when the syncs are run
+        self.batch_dir = batch_dir
+        self.batch_path = batch_dir / 'batch'
+        self.reference_scan_path = batch_dir / 'reference'
+
+        self.scanned = threading.Event()
+        self.written = threading.Event()
+
+        # set by the reference
+        self.reference_scanned = False
+        self.batch_ok = False
+
+        self._remaining = n_syncs
+        self._lock = threading.Lock()
+
+    def scan_path(self, replica_path) -> Path:
+        """Where a target is scanned to before the sync."""
+
+        self.batch_dir.mkdir(parents=True, exist_ok=True)
+
+        if replica_path is None:
+            return self.reference_scan_path
+
+        return self.batch_dir / hashlib.sha256(str(replica_path).encode()).hexdigest()[:16]
+
+    def done(self):
+
+        with self._lock:
+            self._remaining -= 1
+            last = self._remaining == 0
+
+        if last:
+            shutil.rmtree(self.batch_dir, ignore_errors=True)
 
 @dc.dataclass
 class RsyncProtocol(SyncProtocol):
@@ -48,9 +658,35 @@ class RsyncProtocol(SyncProtocol):
                                sync_spec: SyncSpec,
                                src,
                                target,
+                               profile=None,
+                               capabilities=None,
     ):
         """Given the high level specification of intended behavior compile the
-        appropriate options for rsync."""
+        appropriate options for rsync.
+
+        Parameters
+        ----------
+
+        sync_spec : SyncSpec
+
+        src : Replica
+
+        target : Replica
+
+        profile : dict or None
+            Tuning for the link between the replicas, see
+            rsync_link_profile. Defaults to the 'wan' profile.
+
+        capabilities : dict or None
+            What the rsyncs on both ends support, with the keys
+            'compress_choices' and 'checksum_choices' (lists of algorithm
+            names). If not known options newer than rsync 3.0 aren't
+            used.
+
+        """
+
+        if profile is None:
+            profile = rsync_link_profile(None)
 
 
         # info
@@ -62,17 +698,10 @@ class RsyncProtocol(SyncProtocol):
         # the key-value options
         opts = {}
 
-        # includes
-        if len(target.wset.includes) > 0:
-            includes = target.wset.includes
-        else:
-            includes = ()
-
-        # excludes
-        if len(target.wset.excludes) > 0:
-            excludes = target.wset.excludes
-        else:
-            excludes = ()
+        # the working set is given as a compiled filter file instead
+        # of individual includes and excludes, see gen_sync_func
+        includes = ()
+        excludes = ()
 
         # policy options
         sync = sync_spec.sync_pol
@@ -80,11 +709,12 @@ class RsyncProtocol(SyncProtocol):
 
         # collect which flags to use
 
-        # always use these ones
+        # always use these ones, without 'human-readable' so that the
+        # sizes in the stats and itemized changes are exact (see
+        # format_rsync_stats for the report)
         opt_flags = [
             'archive',
             'verbose',
-            'human-readable',
             'itemize-changes',
             'stats',
         ]
@@ -97,15 +727,45 @@ class RsyncProtocol(SyncProtocol):
             opt_flags.append('dry-run')
 
 
-        # TODO: this should be set intelligently depending on location
-        # of replicas but we just always turn on for now. This isn't
-        # so bad for modern computers anyhow.
-        if transport.compression == 'rsync':
-            opt_flags.append('compress')
+        # 'auto' compresses depending on the link
+        compress = (transport.compression == 'rsync' or
+                    (transport.compression == 'auto' and profile['compress']))
 
-        if transport.compression == 'auto':
+        if compress:
             opt_flags.append('compress')
 
+            # the first algorithm both ends support
+            supported = (capabilities or {}).get('compress_choices', ())
+            for algorithm, level in profile['compress_choice']:
+                if algorithm in supported:
+
+                    opts['compress-choice'] = algorithm
+
+                    if level is not None:
+                        opts['compress-level'] = str(level)
+
+                    break
+
+            if profile['skip_compress']:
+                opts['skip-compress'] = '/'.join(SKIP_COMPRESS_SUFFIXES)
+
+        if profile['whole_file']:
+            opt_flags.append('whole-file')
+        else:
+            opt_flags.append('no-whole-file')
+
+        supported = (capabilities or {}).get('checksum_choices', ())
+        for algorithm in profile['checksum_choice']:
+            if algorithm in supported:
+                opts['checksum-choice'] = algorithm
+                break
+
+        if profile['inplace']:
+            opt_flags.append('inplace')
+
+
+        # itemized changes with sizes for parsing the output
+        opts['out-format'] = f"'{RSYNC_OUT_FORMAT}'"
 
         if transport.backup == 'rename':
             opt_flags.append('backup')
@@ -130,6 +790,7 @@ class RsyncProtocol(SyncProtocol):
 
         if sync.clean:
             opt_flags.append('delete')
+            opt_flags.append(profile['delete_timing'])
 
         if sync.prune:
             opt_flags.append('delete-excluded')
@@ -148,50 +809,30 @@ class RsyncProtocol(SyncProtocol):
 
 
     @classmethod
-    def gen_sync_func(cls,
-                      local_cx: Context,
-                      image: Image,
-                      src: Replica,
-                      target: Replica,
-                      sync_spec: SyncSpec,
-                      subtree = None,
-    ) -> Callable[[Context], None]:
-
-        ## Validate
-
-        # validate the sync spec for this protocol
-        if not cls.validate_sync_spec(sync_spec):
-            raise ValueError(f"Invalid SyncSpec for this protocol: {self.__name__}")
-
-        ## Compile Sync Spec to Options
-        options = cls._compile_rsync_options(sync_spec, src, target)
-
-        ## Generate enpoint URLs
-
-        # get the paths the file paths for the replicas
-        src_replica_path = Path(image.resolve_replica_path(
-            local_cx,
-            src,
-        ))
-
-        target_replica_path = Path(image.resolve_replica_path(
-            local_cx,
-            target,
-        ))
-
-        if subtree is not None:
-
-            src_replica_path = src_replica_path / subtree
-            target_replica_path = target_replica_path / subtree
-
-        # generate the rsync.Endpoints
+    def _plan_rsync(cls,
+                    local_cx: Context,
+                    image: Image,
+                    src: Replica,
+                    target: Replica,
+                    sync_spec: SyncSpec,
+                    subtree = None,
+    ) -> RsyncPlan:
+        """Compile the options and endpoints of the rsync command syncing
+        two replicas.
+
+        Planning only works offline once the environments and
+        capabilities of both peers are cached, with a cold cache both
+        peers are probed (see Network.resolve_peer_env and
+        Network.resolve_peer_capabilities).
+
+        """
 
         # get the conn specs for user and host etc.
 
         src_conn = image.network.resolve_peer_connection(src.peer)
         target_conn = image.network.resolve_peer_connection(target.peer)
 
-        # one or the other can be remote but not both. We can't always
+        # one or the other can be remote or both. We can't always
         # rely on the source being local since endpoints you are
         # running from may not be IP addressable so we want to allow
         # for remote 'pull' as well as 'push'
@@ -222,6 +863,72 @@ class RsyncProtocol(SyncProtocol):
                         if issubclass(type(target_conn), LocalConnection)
                         else False)
 
+        # between two remote peers it depends on which can reach the
+        # other
+        route = None
+        route_reason = ''
+        if not src_local and not target_local:
+
+            with span('rsync.resolve_route'):
+                route, route_reason = image.network.resolve_remote_route(
+                    local_cx, src.peer, target.peer)
+
+        ## Compile Sync Spec to Options
+
+        # tune the options for the link between the replicas
+        if route == 'pipe':
+
+            # the data goes over both links to the invoking host
+            link = max((image.network.classify_connection_link(conn)
+                        for conn in (src_conn, target_conn)),
+                       key=LINK_CLASSES.index)
+
+        else:
+            link = image.network.classify_link(src.peer, target.peer)
+
+        profile = rsync_link_profile(
+            link,
+            image.network.network_config.get('RSYNC_PROFILES', None),
+        )
+
+        # get the paths the file paths for the replicas
+        with span('rsync.resolve_paths'):
+
+            src_replica_path = Path(image.resolve_replica_path(
+                local_cx,
+                src,
+            ))
+
+            target_replica_path = Path(image.resolve_replica_path(
+                local_cx,
+                target,
+            ))
+
+        # only use the algorithms both ends have, this contacts the
+        # peers unless their capabilities are cached
+        capabilities = common_rsync_capabilities(
+            image.network.resolve_peer_capabilities(local_cx, src.peer),
+            image.network.resolve_peer_capabilities(local_cx, target.peer),
+        )
+
+        with span('rsync.compile_options'):
+            options = cls._compile_rsync_options(sync_spec, src, target,
+                                                 profile=profile,
+                                                 capabilities=capabilities)
+
+        ## Generate enpoint URLs
+
+        if subtree is not None:
+
+            src_replica_path = src_replica_path / subtree
+            target_replica_path = target_replica_path / subtree
+
+        # generate the rsync.Endpoints
+
+        # the connection of the endpoint which is remote to the
+        # executing one
+        remote_conn = None
+
         if src_local and target_local:
 
             # both local doesn't matter, execute on src
@@ -235,13 +942,12 @@ class RsyncProtocol(SyncProtocol):
                 path=str(target_replica_path),
             )
 
-        elif (not src_local and not target_local):
+        elif route == 'push':
 
-            # neither are local execute on src by convention
+            # the source connects to the target
             ex_endpoint = 'src'
+            remote_conn = target_conn
 
-
-            # make the src endpoint local
             src_endpoint = rsync.Endpoint.construct(
                 path=str(src_replica_path),
             )
@@ -252,11 +958,44 @@ class RsyncProtocol(SyncProtocol):
                 host=target_conn.host,
             )
 
+        elif route == 'pull':
+
+            # the target connects to the source
+            ex_endpoint = 'target'
+            remote_conn = src_conn
+
+            src_endpoint = rsync.Endpoint.construct(
+                path=str(src_replica_path),
+                user=src_conn.user,
+                host=src_conn.host,
+            )
+
+            target_endpoint = rsync.Endpoint.construct(
+                path=str(target_replica_path),
+            )
+
+        elif route == 'pipe':
+
+            # the target pulls from the source through the invoking
+            # host, which connects to each of them, see pipe_rsync
+            ex_endpoint = 'target'
+
+            options.kv['rsh'] = shlex.quote(PIPE_RSH)
+
+            src_endpoint = rsync.Endpoint.construct(
+                path=str(src_replica_path),
+                host=src_conn.host,
+            )
+
+            target_endpoint = rsync.Endpoint.construct(
+                path=str(target_replica_path),
+            )
 
         elif src_local and not target_local:
 
             # execute on src
             ex_endpoint = 'src'
+            remote_conn = target_conn
 
             src_endpoint = rsync.Endpoint.construct(
                 path=str(src_replica_path),
@@ -272,6 +1011,7 @@ class RsyncProtocol(SyncProtocol):
 
             # execute on target
             ex_endpoint = 'target'
+            remote_conn = src_conn
 
             src_endpoint = rsync.Endpoint.construct(
                 path=str(src_replica_path),
@@ -284,6 +1024,433 @@ class RsyncProtocol(SyncProtocol):
                 path=str(target_replica_path),
             )
 
+        # use the network's remote shell for whichever endpoint is
+        # remote so that the transport can share a master connection,
+        # running transfers in parallel always shares a master
+        # connection
+        parallel = sync_spec.transport_pol.parallel
+
+        if remote_conn is not None:
+
+            rsh = image.network.rsh_command(remote_conn,
+                                            multiplex=parallel > 1)
+
+            if rsh is not None:
+                options.kv['rsh'] = f"'{rsh}'"
+
+        # the filter file is read by the rsync process which executes
+        # the sync
+        ex_local = src_local if ex_endpoint == 'src' else target_local
+
+        with span('rsync.compile_filter'):
+            filter_text = render_sync_filter(target.wset.filter_rules())
+
+        options.kv['filter'] = f"'merge {filter_file_path(filter_text, ex_local)}'"
+
+        return RsyncPlan(
+            link = link,
+            options = options,
+            src_endpoint = src_endpoint,
+            target_endpoint = target_endpoint,
+            ex_endpoint = ex_endpoint,
+            src_replica_path = src_replica_path,
+            target_replica_path = target_replica_path,
+            src_local = src_local,
+            target_local = target_local,
+            filter_text = filter_text,
+            route = route,
+            route_reason = route_reason,
+        )
+
+    @classmethod
+    def gen_sync_func(cls,
+                      local_cx: Context,
+                      image: Image,
+                      src: Replica,
+                      target: Replica,
+                      sync_spec: SyncSpec,
+                      subtree = None,
+    ) -> Callable[[Context], None]:
+
+        ## Validate
+
+        # validate the sync spec for this protocol
+        if not cls.validate_sync_spec(sync_spec):
+            raise ValueError(f"Invalid SyncSpec for this protocol: {self.__name__}")
+
+        plan = cls._plan_rsync(local_cx, image, src, target, sync_spec,
+                               subtree=subtree)
+
+        return cls._gen_planned_sync_func(plan, src, target, sync_spec, subtree,
+                                          scan_pool=image.scan_pool)
+
+    @classmethod
+    def _gen_planned_sync_func(cls,
+                               plan: RsyncPlan,
+                               src: Replica,
+                               target: Replica,
+                               sync_spec: SyncSpec,
+                               subtree = None,
+                               scan_pool: Optional[ScanPool] = None,
+    ):
+        """Generate the sync function and confirmation message for a
+        plan, staging its filter file before syncing."""
+
+        with span('rsync.render_command'):
+            sync_func, command_str = cls._gen_sync_func(
+                plan.options,
+                plan.src_endpoint,
+                plan.target_endpoint,
+                plan.ex_endpoint,
+                src,
+                target,
+                plan.src_replica_path,
+                plan.target_replica_path,
+                plan.src_local,
+                plan.target_local,
+                subtree,
+                sync_spec,
+                scan_pool=scan_pool,
+            )
+
+        command_str = f"# tuned for a '{plan.link}' link\n{command_str}"
+
+        if plan.route is not None:
+            command_str = f"# {plan.describe_route()}\n{command_str}"
+
+        def _staged_sync_func(local_cx, src_cx, target_cx):
+
+            with span('rsync.stage_filter'):
+                plan.stage_filter(src_cx, target_cx)
+
+            return sync_func(local_cx, *plan.pipe_contexts(src_cx, target_cx))
+
+        confirm_message = (
+            f"{command_str}\n"
+            f"# with the filter rules:\n"
+            f"{plan.filter_text}"
+        )
+
+        return _staged_sync_func, confirm_message
+
+    @classmethod
+    def batch_key(cls,
+                  image: Image,
+                  sync_pair,
+    ):
+        """Pairs with the same key compute the same update and can be
+        synced together with a batch, see gen_batch_sync_funcs.
+
+        Only targets local to the invocation (e.g. drives) are batched
+        since the batch file is read where it is written, and only plain
+        transfers, not dry, incremental, or parallel ones.
+
+        """
+
+        transport = sync_pair.sync_spec.transport_pol
+
+        if (not transport.batch or
+            transport.dry or
+            transport.incremental or
+            transport.parallel > 1):
+
+            return None
+
+        target_conn = image.network.resolve_peer_connection(sync_pair.target.peer)
+        if not issubclass(type(target_conn), LocalConnection):
+            return None
+
+        return (
+            sync_pair.src.peer.name,
+            sync_pair.src.refinement,
+            str(sync_pair.subtree),
+            image.network.classify_link(sync_pair.src.peer, sync_pair.target.peer),
+            wset_fingerprint(sync_pair.target.wset),
+            repr(sync_pair.sync_spec),
+        )
+
+    @classmethod
+    def gen_batch_sync_funcs(cls,
+                             local_cx: Context,
+                             image: Image,
+                             src: Replica,
+                             targets: List[Replica],
+                             sync_spec: SyncSpec,
+                             subtree = None,
+    ):
+        """Generate the sync functions for syncing a source to many
+        identical targets by computing the update once.
+
+        The first target is the reference, it is synced normally while
+        writing the update to a batch file with '--write-batch'. The
+        others are checked against the state of the reference before
+        its sync and if they were identical the batch is applied to them
+        with '--read-batch' instead of comparing them with the source
+        again. Targets which diverge, or for which applying the batch
+        fails, fall back to a normal sync.
+
+        The sync functions can be run concurrently but the reference's
+        must be started before the others, which wait for it.
+
+        Parameters
+        ----------
+
+        local_cx : Context
+
+        image : Image
+
+        src : Replica
+
+        targets : list of Replica
+            Local replicas with the same working set, see batch_key.
+
+        sync_spec : SyncSpec
+
+        subtree : Path or None
+
+        Returns
+        -------
+
+        planned : list of (callable, str)
+            The sync function and confirmation message for each target.
+
+        """
+
+        if not cls.validate_sync_spec(sync_spec):
+            raise ValueError(f"Invalid SyncSpec for this protocol: {cls.__name__}")
+
+        transport = sync_spec.transport_pol
+
+        plans = [cls._plan_rsync(local_cx, image, src, target, sync_spec,
+                                 subtree=subtree)
+                 for target in targets]
+
+        # the normal syncs to fall back on
+        fallbacks = [cls._gen_planned_sync_func(plan, src, target, sync_spec, subtree,
+                                                scan_pool=image.scan_pool)
+                     for plan, target in zip(plans, targets)]
+
+        ref_plan = plans[0]
+
+        # unique to the invocation
+        batch_name = hashlib.sha256(
+            f"{os.getpid()}:{id(plans)}:{ref_plan.target_replica_path}".encode()
+        ).hexdigest()[:16]
+
+        state = _BatchState(cache_dir() / 'batches' / batch_name, len(targets))
+
+        write_command_str = rsync.Command(
+            src=ref_plan.src_endpoint,
+            dest=ref_plan.target_endpoint,
+            options=dc.replace(
+                ref_plan.options,
+                kv={**ref_plan.options.kv, 'write-batch' : f"'{state.batch_path}'"},
+            ),
+        ).render()
+
+        # the batch is applied without a remote shell and with the same
+        # options otherwise
+        read_kv = {key : value
+                   for key, value in ref_plan.options.kv.items()
+                   if key != 'rsh'}
+        read_kv['read-batch'] = f"'{state.batch_path}'"
+
+        read_command_strs = [
+            render_read_batch_command(dc.replace(plan.options, kv=read_kv),
+                                      plan.target_endpoint)
+            for plan in plans
+        ]
+
+        # the working set is the same for all the targets
+        wset = targets[0].wset
+
+        def _reference_sync_func(local_cx, src_cx, target_cx):
+
+            output = OutputAggregator(transport.output)
+            result = SyncResult('rsync', dry=transport.dry)
+
+            try:
+
+                # the state the others have to be in to apply the batch
+                try:
+                    with timed_phase(result.phases, 'scan'):
+                        scan_local_manifest(ref_plan.target_replica_path,
+                                            state.scan_path(None),
+                                            wset=wset).close()
+
+                    state.reference_scanned = True
+
+                finally:
+                    state.scanned.set()
+
+                ref_plan.stage_filter(src_cx, target_cx)
+
+                output.message("Syncing and writing the batch:")
+                try:
+                    with timed_phase(result.phases, 'transfer'):
+                        run_rsync(local_cx, write_command_str, output)
+
+                    state.batch_ok = True
+
+                except RefugueSyncError as err:
+                    result.exit_code = err.exit_code
+
+            finally:
+                state.written.set()
+                state.done()
+
+            return finish_result(output, result)
+
+        def _gen_follower_sync_func(plan, read_command_str, fallback_func):
+
+            def _sync_func(local_cx, src_cx, target_cx):
+
+                output = OutputAggregator(transport.output)
+                result = SyncResult('rsync', dry=transport.dry)
+
+                try:
+
+                    with timed_phase(result.phases, 'scan'):
+                        target_manifest = scan_local_manifest(plan.target_replica_path,
+                                                              state.scan_path(plan.target_replica_path),
+                                                              wset=wset)
+
+                    try:
+                        with timed_phase(result.phases, 'wait'):
+                            state.scanned.wait()
+
+                        reference_manifest = (Manifest.load(state.reference_scan_path)
+                                              if state.reference_scanned
+                                              else None)
+
+                        diverged = (reference_manifest is None or
+                                    next(diff_paths(target_manifest, reference_manifest),
+                                         None) is not None)
+
+                        if reference_manifest is not None:
+                            reference_manifest.close()
+
+                    finally:
+                        target_manifest.close()
+
+                    if diverged:
+                        output.message("Running a normal sync, the target differs "
+                                       "from the reference")
+                        return fallback_func(local_cx, src_cx, target_cx)
+
+                    with timed_phase(result.phases, 'wait'):
+                        state.written.wait()
+
+                    if not state.batch_ok:
+                        output.message("Running a normal sync, the batch wasn't written")
+                        return fallback_func(local_cx, src_cx, target_cx)
+
+                    plan.stage_filter(src_cx, target_cx)
+
+                    output.message("Applying the batch:")
+                    try:
+                        with timed_phase(result.phases, 'transfer'):
+                            run_rsync(local_cx, read_command_str, output)
+
+                    except RefugueSyncError:
+                        output.message("Running a normal sync, applying the batch failed")
+                        return fallback_func(local_cx, src_cx, target_cx)
+
+                finally:
+                    state.done()
+
+                return finish_result(output, result)
+
+            return _sync_func
+
+        planned = []
+
+        ref_confirm = (
+            f"# tuned for a '{ref_plan.link}' link, writing the update to a batch\n"
+            f"{write_command_str}"
+            f"# with the filter rules:\n{ref_plan.filter_text}"
+        )
+
+        planned.append((_reference_sync_func, ref_confirm))
+
+        for target, plan, read_command_str, (fallback_func, fallback_confirm) in zip(
+                targets[1:], plans[1:], read_command_strs[1:], fallbacks[1:]):
+
+            confirm_message = (
+                f"# if identical to {targets[0].peer.name}/{targets[0].refinement} "
+                f"before its sync, apply its batch:\n"
+                f"{read_command_str}"
+                f"# otherwise:\n"
+                f"{fallback_confirm}"
+            )
+
+            planned.append((
+                _gen_follower_sync_func(plan, read_command_str, fallback_func),
+                confirm_message,
+            ))
+
+        return planned
+
+    @classmethod
+    def _gen_sync_func(cls,
+                       options,
+                       src_endpoint,
+                       target_endpoint,
+                       ex_endpoint,
+                       src,
+                       target,
+                       src_replica_path,
+                       target_replica_path,
+                       src_local,
+                       target_local,
+                       subtree,
+                       sync_spec: SyncSpec,
+                       scan_pool: Optional[ScanPool] = None,
+    ):
+        """Generate the sync function for the rsync options and endpoints
+        with the transfer strategy of the transport policy.
+
+        Scans of the source are shared through the scan_pool with the
+        other syncs of the invocation.
+
+        """
+
+        if scan_pool is None:
+            scan_pool = ScanPool()
+
+        parallel = sync_spec.transport_pol.parallel
+
+        if sync_spec.transport_pol.incremental:
+
+            return cls._gen_incremental_sync_func(
+                options,
+                src_endpoint,
+                target_endpoint,
+                ex_endpoint,
+                src,
+                target,
+                src_replica_path,
+                target_replica_path,
+                src_local,
+                target_local,
+                subtree,
+                sync_spec,
+                scan_pool,
+            )
+
+        if parallel > 1:
+
+            return cls._gen_parallel_sync_func(
+                options,
+                src_endpoint,
+                target_endpoint,
+                ex_endpoint,
+                src,
+                src_replica_path,
+                sync_spec,
+                scan_pool,
+            )
+
         # generate the rsync command
         command = rsync.Command(
             src=src_endpoint,
@@ -299,18 +1466,416 @@ class RsyncProtocol(SyncProtocol):
         # return this closure which is the callable that actually
         # executes the sync process
 
-        if ex_endpoint == 'src':
+        output_mode = sync_spec.transport_pol.output
 
-            def _sync_func(local_cx, src_cx, target_cx):
+        def _sync_func(local_cx, src_cx, target_cx):
 
-                src_cx.run(command_str, pty=True)
+            ex_cx = src_cx if ex_endpoint == 'src' else target_cx
 
-        elif ex_endpoint == 'target':
+            output = OutputAggregator(output_mode)
+            result = SyncResult('rsync', dry=sync_spec.transport_pol.dry)
 
-            def _sync_func(local_cx, src_cx, target_cx):
-
-                target_cx.run(command_str, pty=True)
+            try:
+                with timed_phase(result.phases, 'transfer'):
+                    run_rsync(ex_cx, command_str, output)
 
+            except RefugueSyncError as err:
+                result.exit_code = err.exit_code
 
+            return finish_result(output, result)
 
         return _sync_func, command_str
+
+    @classmethod
+    def _scan_shard_weights(cls,
+                            src_cx: Context,
+                            src_path: Path,
+                            shard_method: str,
+    ) -> Mapping[str, int]:
+        """Get the top-level directories of the source replica and their
+        weights for sharding.
+
+        Uses GNU find and du on the source peer.
+
+        """
+
+        path = shlex.quote(str(src_path))
+
+        if shard_method == 'top':
+
+            result = src_cx.run(
+                f"find {path} -mindepth 1 -maxdepth 1 -type d -printf '%f\\0'",
+                hide=True,
+                pty=False,
+            )
+
+            weights = {name : 1
+                       for name in result.stdout.split('\0')
+                       if name != ''}
+
+        elif shard_method == 'size':
+
+            result = src_cx.run(
+                f"find {path} -mindepth 1 -maxdepth 1 -type d "
+                "-exec du -s -0 -B1 --apparent-size {} +",
+                hide=True,
+                pty=False,
+            )
+
+            weights = {}
+            for record in result.stdout.split('\0'):
+
+                if record.strip() == '':
+                    continue
+
+                size, dir_path = record.lstrip('\n').split('\t', 1)
+                weights[Path(dir_path).name] = int(size)
+
+        else:
+            raise ValueError(f"Unknown shard method: {shard_method}")
+
+        return weights
+
+    @classmethod
+    def _gen_parallel_sync_func(cls,
+                                options,
+                                src_endpoint,
+                                target_endpoint,
+                                ex_endpoint,
+                                src,
+                                src_replica_path,
+                                sync_spec: SyncSpec,
+                                scan_pool: ScanPool,
+    ):
+        """Generate a sync function which splits the sync into concurrent
+        rsync processes.
+
+        First a non-recursive pass syncs the top level of the replica
+        (files, directories and deletions) and then the top-level
+        directories are synced recursively in shards by a pool of
+        workers, the largest shards first.
+
+        Each shard has the same source and target roots as a normal sync
+        and is restricted with '--files-from' so that the working set
+        filters and deletions behave the same as for a single rsync.
+
+        """
+
+        transport = sync_spec.transport_pol
+
+        # the top level without recursing
+        root_options = dc.replace(
+            options,
+            flags=options.flags + ('no-recursive', 'dirs',),
+        )
+
+        # each shard reads the directories to sync from stdin
+        shard_options = dc.replace(
+            options,
+            flags=options.flags + ('recursive', 'from0',),
+            kv={**options.kv, 'files-from' : '-'},
+        )
+
+        root_command_str = rsync.Command(
+            src=src_endpoint,
+            dest=target_endpoint,
+            options=root_options,
+        ).render()
+
+        shard_command_str = rsync.Command(
+            src=src_endpoint,
+            dest=target_endpoint,
+            options=shard_options,
+        ).render()
+
+        n_shards = transport.parallel * SHARDS_PER_WORKER
+
+        def _sync_func(local_cx, src_cx, target_cx):
+
+            ex_cx = src_cx if ex_endpoint == 'src' else target_cx
+
+            output = OutputAggregator(transport.output)
+            result = SyncResult('rsync', dry=transport.dry)
+
+            # do the top-level first so that directories are created
+            # and any master connection is made before the workers
+            # start
+            output.message("Syncing top-level of replica:")
+            try:
+                with timed_phase(result.phases, 'root'):
+                    run_rsync(ex_cx, root_command_str, output)
+
+            # the shards can't be synced without their parents
+            except RefugueSyncError as err:
+                result.exit_code = err.exit_code
+                return finish_result(output, result)
+
+            with timed_phase(result.phases, 'scan'):
+                weights = scan_pool.get(
+                    ('shard_weights', src.peer.name, str(src_replica_path), transport.shard),
+                    lambda: cls._scan_shard_weights(src_cx,
+                                                    src_replica_path,
+                                                    transport.shard),
+                )
+
+            shards = partition_shards(weights, n_shards)
+
+            output.message(f"Syncing {len(weights)} top-level directories in "
+                  f"{len(shards)} shards with {transport.parallel} workers:")
+
+            with timed_phase(result.phases, 'shards'):
+
+                executor = ThreadPoolExecutor(max_workers=transport.parallel)
+                try:
+
+                    # the workers take shards off the queue as they finish
+                    futures = {}
+                    for _, names in shards:
+
+                        files_from = ''.join(f"{name}\0" for name in names)
+
+                        future = executor.submit(
+                            run_rsync,
+                            ex_cx,
+                            shard_command_str,
+                            output,
+                            in_stream=files_from,
+                        )
+
+                        futures[future] = names
+
+                    # the other shards are still synced when one fails
+                    for future in as_completed(futures):
+
+                        try:
+                            future.result()
+
+                        except RefugueSyncError as err:
+                            output.message(f"Failed shard: {', '.join(futures[future])}")
+
+                            if result.exit_code == 0:
+                                result.exit_code = err.exit_code
+
+                        else:
+                            output.message(f"Finished shard: {', '.join(futures[future])}")
+
+                finally:
+                    executor.shutdown(wait=True, cancel_futures=True)
+
+            # the stats of every process are summed
+            finish_result(output, result)
+
+            if transport.output == 'full':
+                output.message("Combined stats:")
+                output.message(format_rsync_stats(output.stats))
+
+            return result
+
+        confirm_message = (
+            f"{root_command_str}\n"
+            f"# then for each shard of top-level directories, "
+            f"{transport.parallel} at a time:\n"
+            f"{shard_command_str}"
+        )
+
+        return _sync_func, confirm_message
+
+    @classmethod
+    def _gen_incremental_sync_func(cls,
+                                   options,
+                                   src_endpoint,
+                                   target_endpoint,
+                                   ex_endpoint,
+                                   src,
+                                   target,
+                                   src_replica_path,
+                                   target_replica_path,
+                                   src_local,
+                                   target_local,
+                                   subtree,
+                                   sync_spec: SyncSpec,
+                                   scan_pool: ScanPool,
+    ):
+        """Generate a sync function which only transfers the paths which
+        changed in the source since the last successful sync.
+
+        The source is scanned into a manifest (incrementally when it is
+        local) and compared to the manifest recorded after the last
+        sync. Only the added and modified paths are given to rsync with
+        '--files-from' so it doesn't have to scan either replica, and
+        for 'clean' the removed paths are given as well and deleted with
+        '--delete-missing-args'.
+
+        This assumes the target is only changed by these syncs. Local
+        targets are checked for changes against their own recorded
+        manifest and any change (or a missing baseline) falls back to a
+        full sync which records new baselines.
+
+        """
+
+        sync = sync_spec.sync_pol
+        transport = sync_spec.transport_pol
+
+        full_command_str = rsync.Command(
+            src=src_endpoint,
+            dest=target_endpoint,
+            options=options,
+        ).render()
+
+        # without recursion '--delete' doesn't apply to anything but we
+        # don't want it deleting in the listed directories either, the
+        # delete timings imply it
+        flags = [flag for flag in options.flags if flag not in DELETE_FLAGS]
+        flags.append('from0')
+
+        if sync.clean:
+            flags.extend(['delete-missing-args', 'force'])
+        else:
+            # files removed since the scan
+            flags.append('ignore-missing-args')
+
+        incr_options = dc.replace(
+            options,
+            flags=tuple(flags),
+            kv={**options.kv, 'files-from' : '-'},
+        )
+
+        incr_command_str = rsync.Command(
+            src=src_endpoint,
+            dest=target_endpoint,
+            options=incr_options,
+        ).render()
+
+        baseline_path = baseline_dir(src, target, subtree)
+
+        # the source is scanned with the target's filters like rsync
+        # does
+        wset = target.wset
+
+        def _scan(cx, local, replica_path, manifest_path):
+
+            if local:
+                return scan_local_manifest(replica_path, manifest_path, wset=wset)
+            else:
+                return scan_context_manifest(cx, replica_path, manifest_path, wset=wset)
+
+        # the source is scanned once for all the targets with the same
+        # filters, each sync maps its own view of it
+        src_scan_path = source_scan_dir(src, wset, subtree)
+
+        def _scan_src(src_cx):
+
+            def _scan_once():
+                _scan(src_cx, src_local, src_replica_path, src_scan_path).close()
+                return src_scan_path
+
+            return Manifest(scan_pool.get(
+                ('manifest', src.peer.name, str(src_replica_path), wset_fingerprint(wset)),
+                _scan_once,
+            ))
+
+        target_scan_path = baseline_path / 'target.current'
+
+        def _sync_func(local_cx, src_cx, target_cx):
+
+            ex_cx = src_cx if ex_endpoint == 'src' else target_cx
+
+            output = OutputAggregator(transport.output)
+            result = SyncResult('rsync', dry=transport.dry)
+
+            manifests = []
+            try:
+
+                output.message("Scanning source replica for changes")
+                with timed_phase(result.phases, 'scan'):
+                    src_manifest = _scan_src(src_cx)
+                manifests.append(src_manifest)
+
+                src_baseline = Manifest.load(baseline_path / 'src')
+                target_baseline = Manifest.load(baseline_path / 'target')
+                manifests.extend(manifest for manifest in (src_baseline, target_baseline)
+                                 if manifest is not None)
+
+                full_reason = None
+                if src_baseline is None:
+                    full_reason = "there is no record of a previous sync"
+
+                elif target_local:
+
+                    with timed_phase(result.phases, 'scan'):
+                        target_manifest = _scan(target_cx, True, target_replica_path, target_scan_path)
+                    manifests.append(target_manifest)
+
+                    if (target_baseline is None or
+                        next(diff_paths(target_manifest, target_baseline), None) is not None):
+
+                        full_reason = "the target changed since the last sync"
+
+                if full_reason is not None:
+
+                    output.message(f"Running a full sync, {full_reason}:")
+                    with timed_phase(result.phases, 'transfer'):
+                        run_rsync(ex_cx, full_command_str, output)
+
+                else:
+
+                    paths = []
+                    removed_dir = None
+                    for kind, path, is_dir in diff_paths(src_manifest, src_baseline):
+
+                        if kind == 'removed':
+
+                            if not sync.clean:
+                                continue
+
+                            # deleting the directory deletes everything in it
+                            if removed_dir is not None and path.startswith(removed_dir + '/'):
+                                continue
+
+                            if is_dir:
+                                removed_dir = path
+
+                        paths.append(path)
+
+                    if len(paths) == 0:
+                        output.message("Nothing changed since the last sync")
+                        return finish_result(output, result)
+
+                    output.message(f"Syncing {len(paths)} changed paths:")
+                    with timed_phase(result.phases, 'transfer'):
+                        run_rsync(
+                            ex_cx,
+                            incr_command_str,
+                            output,
+                            in_stream=''.join(f"{path}\0" for path in paths),
+                        )
+
+                # only a successful sync becomes the new baseline
+                if not transport.dry:
+
+                    with timed_phase(result.phases, 'record'):
+
+                        record_baseline(src_manifest, baseline_path / 'src')
+
+                        if target_local:
+                            target_manifest = _scan(target_cx, True, target_replica_path, target_scan_path)
+                            manifests.append(target_manifest)
+                            record_baseline(target_manifest, baseline_path / 'target')
+
+            except RefugueSyncError as err:
+                result.exit_code = err.exit_code
+
+            finally:
+                for manifest in manifests:
+                    manifest.close()
+
+            return finish_result(output, result)
+
+        confirm_message = (
+            f"# the paths changed in the source since the last sync:\n"
+            f"{incr_command_str}\n"
+            f"# or if the last sync isn't known or the target changed:\n"
+            f"{full_command_str}"
+        )
+
+        return _sync_func, confirm_message
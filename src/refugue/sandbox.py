@@ -0,0 +1,316 @@
+"""A local stand-in for remote peers which injects latency and
+bandwidth limits.
+
+Commands for a sandboxed peer are run on the local machine with their
+own home directory under the sandbox root, but go through a wrapper
+which delays them like a connection to a remote host would. The
+wrapper is also given to rsync as its remote shell so that transfers
+to sandboxed peers take the remote code paths (remote endpoints,
+remote execution, the network's remote shell) on a single machine.
+
+To make a peer a sandbox give a 'sandbox' dictionary in its
+CONNECTIONS entry of the network config:
+
+    CONNECTIONS = {
+        'junco' : {
+            'host' : 'junco.example.org',
+            'user' : 'salotz',
+            'sandbox' : {
+                'root' : '/tmp/refugue-sandbox/junco',
+                # seconds
+                'rtt' : 0.08,
+                # bytes per second
+                'bandwidth' : 10_000_000,
+                # only reachable from the invoking host, not from
+                # other peers
+                'isolated' : False,
+            },
+        },
+    }
+
+"""
+
+import os
+import os.path as osp
+import sys
+import time
+import queue
+import shlex
+import threading
+import subprocess
+from typing import Optional
+
+from invoke import Context
+
+
+SANDBOX_HOME = 'home'
+"""Directory in the sandbox root which is the home of the peer."""
+
+HANDSHAKE_ROUND_TRIPS = 3
+"""Round trips a new SSH connection takes before it runs a command (TCP,
+key exchange, and authentication)."""
+
+PIPE_CHUNK_SIZE = 16 * 1024
+"""Size of the chunks data is passed through the link in."""
+
+SANDBOX_ENV_VAR = 'REFUGUE_SANDBOX'
+"""Environment variable with the root of the sandbox commands are run
+in, so that connections from one sandbox to another can be told apart
+from connections from the invoking host."""
+
+def sandbox_home(root) -> str:
+    """The home directory of the peer in a sandbox."""
+
+    return osp.join(osp.expanduser(osp.expandvars(root)), SANDBOX_HOME)
+
+def sandbox_env(root):
+    """The environment commands are run with in a sandbox."""
+
+    env = dict(os.environ)
+    env['HOME'] = sandbox_home(root)
+    env[SANDBOX_ENV_VAR] = root
+
+    return env
+
+def sandbox_command(sandbox_conn, round_trips) -> str:
+    """The command prefix which runs the rest of the command line in the
+    sandbox, like 'ssh' would on the remote host.
+
+    Parameters
+    ----------
+
+    sandbox_conn : SandboxConnection
+
+    round_trips : int
+        Number of round trips to wait for before the command runs.
+
+    """
+
+    return ' '.join([
+        shlex.quote(sys.executable),
+        '-m', 'refugue.sandbox',
+        shlex.quote(sandbox_conn.root),
+        str(sandbox_conn.rtt),
+        str(sandbox_conn.bandwidth if sandbox_conn.bandwidth is not None else 0),
+        str(round_trips),
+        '1' if sandbox_conn.isolated else '0',
+    ])
+
+class SandboxContext(Context):
+    """An execution context for a sandboxed peer, used in place of a
+    fabric.Connection.
+
+    The first command pays for a full handshake and later ones for a
+    single round trip like on an open SSH connection.
+
+    """
+
+    def __init__(self, sandbox_conn):
+
+        super().__init__()
+
+        # real attributes, not config values
+        self._set(
+            sandbox_conn = sandbox_conn,
+            _connected = False,
+            _lock = threading.Lock(),
+        )
+
+    def _round_trips(self):
+
+        with self._lock:
+
+            round_trips = 1 if self._connected else HANDSHAKE_ROUND_TRIPS
+            self._set(_connected=True)
+
+        return round_trips
+
+    def wrap_command(self, command: str) -> str:
+        """Wrap a command so it is run in the sandbox."""
+
+        return ' '.join([
+            sandbox_command(self.sandbox_conn, self._round_trips()),
+            shlex.quote(self.sandbox_conn.host),
+            shlex.quote(command),
+        ])
+
+    def run(self, command, **kwargs):
+
+        return super().run(self.wrap_command(command), **kwargs)
+
+    def put(self, local, remote=None):
+        """Copy a file (path or file-like object) into the sandbox,
+        relative paths are relative to the sandbox home."""
+
+        if remote is None:
+            remote = osp.basename(local)
+
+        path = osp.join(sandbox_home(self.sandbox_conn.root), remote)
+
+        if hasattr(local, 'read'):
+            data = local.read()
+        else:
+            with open(local, 'rb') as rfile:
+                data = rfile.read()
+
+        # a round trip to start the transfer and then the data
+        delay = self.sandbox_conn.rtt * self._round_trips()
+        if self.sandbox_conn.bandwidth:
+            delay += len(data) / self.sandbox_conn.bandwidth
+
+        time.sleep(delay)
+
+        with open(path, 'wb') as wfile:
+            wfile.write(data)
+
+    def close(self):
+        pass
+
+class _Link():
+    """One direction of a link with a latency and bandwidth limit.
+
+    Chunks are read as soon as they are available and written once they
+    have 'arrived', so that the latency applies to each chunk like it
+    would on a network instead of adding up.
+
+    """
+
+    def __init__(self, latency: float, bandwidth: Optional[int]):
+
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        self._chunks = queue.Queue()
+
+    def _read(self, rfile):
+
+        while True:
+
+            chunk = rfile.read1(PIPE_CHUNK_SIZE)
+
+            self._chunks.put((time.monotonic() + self.latency, chunk))
+
+            if len(chunk) == 0:
+                break
+
+    def _write(self, wfile):
+
+        # when the link is free to send the next chunk
+        free_at = 0.0
+
+        while True:
+
+            arrival, chunk = self._chunks.get()
+
+            if len(chunk) == 0:
+                break
+
+            free_at = max(free_at, time.monotonic())
+
+            if self.bandwidth:
+                free_at += len(chunk) / self.bandwidth
+
+            delay = max(arrival, free_at) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                wfile.write(chunk)
+                wfile.flush()
+            except BrokenPipeError:
+                break
+
+        try:
+            wfile.close()
+        except BrokenPipeError:
+            pass
+
+    def start(self, rfile, wfile):
+
+        threads = [
+            threading.Thread(target=self._read, args=(rfile,), daemon=True),
+            threading.Thread(target=self._write, args=(wfile,), daemon=True),
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        return threads
+
+def _parse_rsh_args(args):
+    """Get the host and command from the arguments a remote shell is
+    called with, e.g. '-l user host rsync --server ...'."""
+
+    idx = 0
+    while idx < len(args) and args[idx].startswith('-'):
+
+        # options with a value
+        if args[idx] in ('-l', '-o', '-p', '-i', '-F'):
+            idx += 2
+        else:
+            idx += 1
+
+    if idx >= len(args):
+        raise ValueError("No host given")
+
+    return args[idx], ' '.join(args[idx + 1:])
+
+def main(argv=None):
+    """Run a command in a sandbox like ssh would.
+
+    Usage: python -m refugue.sandbox ROOT RTT BANDWIDTH ROUND_TRIPS ISOLATED [SSH_OPTIONS] HOST COMMAND...
+
+    """
+
+    argv = sys.argv[1:] if argv is None else argv
+
+    root, rtt, bandwidth, round_trips, isolated = argv[:5]
+    rtt = float(rtt)
+    bandwidth = int(bandwidth) or None
+
+    host, command = _parse_rsh_args(argv[5:])
+
+    # run from another sandbox, i.e. another peer
+    if isolated == '1' and os.environ.get(SANDBOX_ENV_VAR, root) != root:
+
+        time.sleep(rtt)
+        print(f"ssh: connect to host {host} port 22: Connection refused", file=sys.stderr)
+
+        return 255
+
+    home = sandbox_home(root)
+    os.makedirs(home, exist_ok=True)
+
+    # connecting
+    time.sleep(rtt * int(round_trips))
+
+    proc = subprocess.Popen(
+        ['sh', '-c', command] if command != '' else ['sh'],
+        cwd=home,
+        env=sandbox_env(root),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+
+    # half a round trip each way
+    threads = (
+        _Link(rtt / 2, bandwidth).start(sys.stdin.buffer, proc.stdin) +
+        _Link(rtt / 2, bandwidth).start(proc.stdout, sys.stdout.buffer)
+    )
+
+    exit_code = proc.wait()
+
+    # everything written has to get through before exiting
+    threads[3].join()
+
+    return exit_code
+
+if __name__ == "__main__":
+
+    exit_code = main()
+
+    # the thread reading standard input can still be blocked on it,
+    # which the interpreter can't shut down cleanly with
+    # (standard output is closed by the link once it's through)
+    sys.stderr.flush()
+    os._exit(exit_code)
@@ -1,4 +1,7 @@
 import dataclasses as dc
+import time
+import threading
+from contextlib import contextmanager
 from typing import (
     Optional,
     Union,
@@ -6,9 +9,14 @@ from typing import (
     Callable,
     Mapping,
     Any,
+    Dict,
+    TYPE_CHECKING,
 )
 
-from invoke import Context
+from .profiling import span
+
+if TYPE_CHECKING:
+    from invoke import Context
 
 # TODO: leads to circular imports for typechecking. Are we leading to
 # header files or something!! Currently typechecking turned off
@@ -19,11 +27,34 @@ from invoke import Context
 
 
 __all__ = [
+    'RefugueSyncError',
+    'SyncResult',
+    'ScanPool',
 ]
 
 
+class RefugueSyncError(RuntimeError):
+    """A sync process failed."""
+
+    def __init__(self, message, exit_code=1):
+
+        super().__init__(message)
+
+        self.exit_code = exit_code
+
+
 ## Sync specs
 
+SHARD_METHODS = (
+    # top-level directories packed evenly by count into
+    # parallel * SHARDS_PER_WORKER shards
+    'top',
+
+    # top-level directories packed into the same number of shards of
+    # similar total size
+    'size',
+)
+
 @dc.dataclass
 class SyncPolicy():
     """A protocol-agnostic specification of a desired synchronization
@@ -51,12 +82,202 @@ class TransportPolicy():
     backup: Optional[str]
     create: Optional[str]
 
+    parallel: int = 1
+    """Number of concurrent transfer workers to split the sync over."""
+
+    shard: str = 'size'
+    """How to split the replica between parallel workers, see
+    SHARD_METHODS."""
+
+    incremental: bool = False
+    """Only transfer what changed in the source since the last sync
+    according to its manifest instead of comparing the whole replicas."""
+
+    output: str = 'full'
+    """How the output of the transfer is reported, see
+    output.OUTPUT_MODES."""
+
+    batch: bool = False
+    """When syncing to many identical targets compute the update once
+    and apply it to each, if the protocol supports it."""
+
 @dc.dataclass
 class SyncSpec():
 
     sync_pol: SyncPolicy
     transport_pol: TransportPolicy
 
+@dc.dataclass
+class SyncResult():
+    """The outcome of executing a sync.
+
+    The counters are named like the stats rsync reports with '--stats'
+    and are 0 when the protocol doesn't report them.
+
+    """
+
+    protocol: str
+
+    exit_code: int = 0
+    """Exit code of the transfer, 0 if it succeeded. For rsync this is
+    the exit code of the (first failed) rsync process."""
+
+    dry: bool = False
+
+    files: int = 0
+    """Number of files and directories scanned in the source."""
+
+    created_files: int = 0
+    deleted_files: int = 0
+    transferred_files: int = 0
+
+    total_size: int = 0
+    """Total size of the files in the source."""
+
+    transferred_size: int = 0
+    """Total size of the files which were transferred."""
+
+    literal_data: int = 0
+    """Bytes of file data which had to be sent."""
+
+    matched_data: int = 0
+    """Bytes of file data which were already in the target."""
+
+    bytes_sent: int = 0
+    bytes_received: int = 0
+
+    changes: Dict[str, int] = dc.field(default_factory=dict)
+    """Counts of the reported changes by kind, see output.EVENT_KINDS."""
+
+    copy_methods: Dict[str, int] = dc.field(default_factory=dict)
+    """Number of files copied by each mechanism, only for the native
+    protocol (see protocols.native.copy_file_data)."""
+
+    phases: Dict[str, float] = dc.field(default_factory=dict)
+    """Elapsed seconds of each phase of the sync."""
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_code == 0
+
+    @property
+    def elapsed(self) -> float:
+        """Total elapsed seconds of all the phases."""
+
+        return sum(self.phases.values())
+
+    @property
+    def speedup(self) -> Optional[float]:
+        """Total size over the bytes which went over the wire, like
+        rsync reports."""
+
+        wire_bytes = self.bytes_sent + self.bytes_received
+
+        if wire_bytes == 0:
+            return None
+
+        return self.total_size / wire_bytes
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """Transferred bytes of files per second."""
+
+        if self.elapsed == 0:
+            return None
+
+        return self.transferred_size / self.elapsed
+
+    def add_stats(self, stats: Dict[str, int]):
+        """Set the counters from a dictionary of stats (e.g. from
+        output.parse_rsync_stats), unknown keys are ignored."""
+
+        fields = set(field.name for field in dc.fields(self)
+                     if field.type is int or field.type == 'int')
+
+        for key, value in stats.items():
+            if key in fields and key != 'exit_code':
+                setattr(self, key, value)
+
+    def to_dict(self):
+
+        return {
+            **dc.asdict(self),
+            'elapsed' : self.elapsed,
+            'speedup' : self.speedup,
+            'throughput' : self.throughput,
+        }
+
+    def summary(self) -> str:
+        """A line describing the result."""
+
+        line = (f"{self.protocol}: {self.transferred_files} of {self.files} files "
+                f"transferred ({self.transferred_size:,} bytes), "
+                f"{self.deleted_files} deleted in {self.elapsed:.2f} s")
+
+        if self.speedup is not None:
+            line += f", speedup {self.speedup:.2f}"
+
+        if self.dry:
+            line += " (dry run)"
+
+        if not self.ok:
+            line += f", failed with exit code {self.exit_code}"
+
+        return line
+
+@contextmanager
+def timed_phase(phases: Dict[str, float], name: str):
+    """Add the elapsed time of a block to a phase, which is also traced
+    as a span."""
+
+    start = time.monotonic()
+    try:
+        with span(f"sync.{name}"):
+            yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + (time.monotonic() - start)
+
+@dc.dataclass
+class ScanPool():
+    """Results of scanning replicas keyed by what was scanned, shared by
+    all the syncs of an invocation.
+
+    When syncing a source to many targets at once the source only needs
+    to be scanned once, the first sync to ask for a scan does it and
+    the others wait for it.
+
+    """
+
+    results: dict = dc.field(default_factory=dict)
+    _locks: dict = dc.field(default_factory=dict, repr=False)
+    _lock: Any = dc.field(default_factory=threading.Lock, repr=False)
+
+    def get(self, key, scan: Callable[[], Any]):
+        """Get the result of a scan, running it if nobody has yet.
+
+        Parameters
+        ----------
+
+        key : hashable
+            Identifies what is scanned and how.
+
+        scan : callable
+            Called with no arguments to do the scan. If it raises the
+            error is raised to this caller only and the next one scans
+            again.
+
+        """
+
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+
+            if key not in self.results:
+                self.results[key] = scan()
+
+            return self.results[key]
+
 @dc.dataclass
 class SyncProtocol():
     """Abstract Base Class for SyncProtocols"""
@@ -69,13 +290,23 @@ class SyncProtocol():
 
         NotImplemented
 
+    @classmethod
+    def batch_key(cls,
+                  image, # : Image,
+                  sync_pair, # : SyncPair,
+    ):
+        """Key of the pairs which can be synced together with
+        gen_batch_sync_funcs, None if the pair can't be batched."""
+
+        return None
+
     @classmethod
     def gen_sync_func(cls,
-                      cx: Context,
+                      cx: 'Context',
                       src, # : Replica,
                       target, # : Replica,
                       sync_spec: SyncSpec,
-    ) -> Callable[[Context], None]:
+    ) -> Callable[['Context'], SyncResult]:
 
         if not cls.validate_sync_spec(sync_spec):
             raise ValueError(f"Invalid SyncSpec for this protocol: {self.__name__}")
@@ -1,4 +1,31 @@
-from invoke.vendor.six.moves import input
+import re
+import sys
+
+SHELL_VAR_RE = re.compile(r'\$(?:(\w+)|\{(\w+)\})')
+"""Matches simple shell variable references, i.e. '$VAR' and '${VAR}'."""
+
+def template_vars(template):
+    """Get the names of the shell variables referenced in a template
+    string."""
+
+    return tuple(dict.fromkeys(
+        simple or braced
+        for simple, braced in SHELL_VAR_RE.findall(template)
+    ))
+
+def expand_vars(template, env):
+    """Expand the shell variables in the template with the values in
+    env.
+
+    Like the shell (and unlike os.path.expandvars) variables which aren't
+    in env are expanded to the empty string.
+
+    """
+
+    return SHELL_VAR_RE.sub(
+        lambda match: env.get(match.group(1) or match.group(2), ''),
+        template,
+    )
 
 def confirm(question, assume_yes=True):
     """
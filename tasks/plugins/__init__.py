@@ -4,10 +4,12 @@
 
 from . import custom
 from .admin import admin_coll
+from .bench import bench_coll
 
 # specify which plugins to install, the custom one is included by
 # default to get users going
 PLUGIN_MODULES = [
     custom,
     admin_coll,
+    bench_coll,
 ]
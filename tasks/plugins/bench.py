@@ -0,0 +1,1151 @@
+"""Benchmarks for catching performance regressions in refugue."""
+
+import os
+import sys
+import json
+import time
+import platform
+import random
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+
+from invoke import task, Collection
+
+from ..sysconfig import BENCHMARK_STORAGE_URL
+
+
+## Import time
+
+IMPORT_TIME_MODULE = 'refugue.cli'
+"""The module imported by the command line tool at startup."""
+
+IMPORT_TIME_THRESHOLD_MS = 150.0
+"""Maximum acceptable cumulative import time for the CLI module."""
+
+LAZY_MODULES = (
+    'fabric',
+    'paramiko',
+    'cryptography',
+    'invoke',
+    'py_rsync',
+    'jinja2',
+    'toml',
+)
+"""Modules which should only be imported when they are actually used
+and never at startup."""
+
+def parse_importtime(stderr):
+    """Parse the output of 'python -X importtime' into a dictionary of
+    module name to (self, cumulative) time in microseconds."""
+
+    times = {}
+    for line in stderr.splitlines():
+
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+
+        # skip the header
+        try:
+            self_us = int(fields[0])
+            cumulative_us = int(fields[1])
+        except ValueError:
+            continue
+
+        times[fields[2].strip()] = (self_us, cumulative_us)
+
+    return times
+
+def measure_import_time(module, repeats=5):
+    """Import the module in fresh interpreters and get the module
+    import times from the fastest run."""
+
+    best = None
+    for _ in range(repeats):
+
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+
+        times = parse_importtime(proc.stderr)
+
+        if best is None or times[module][1] < best[module][1]:
+            best = times
+
+    return best
+
+@task
+def import_time(cx,
+                module=IMPORT_TIME_MODULE,
+                threshold=IMPORT_TIME_THRESHOLD_MS,
+                repeats=5,
+):
+    """Check the startup import time of the CLI hasn't regressed.
+
+    Fails if any of the heavy modules which should be imported lazily
+    are imported at startup or if the cumulative import time is over the
+    threshold (in milliseconds).
+
+    """
+
+    times = measure_import_time(module, repeats=int(repeats))
+
+    total_ms = times[module][1] / 1000
+
+    # the top level packages which were imported
+    eager = sorted(set(
+        name for name in LAZY_MODULES
+        if any(imported == name or imported.startswith(name + '.')
+               for imported in times)
+    ))
+
+    slowest = sorted(times.items(), key=lambda item: item[1][0], reverse=True)[:10]
+
+    print(f"Cumulative import time of {module}: {total_ms:.1f} ms "
+          f"(threshold {float(threshold):.1f} ms)")
+    print("Slowest modules (self time):")
+    for name, (self_us, cumulative_us) in slowest:
+        print(f"    {self_us / 1000:8.2f} ms  {name}")
+
+    failures = []
+    if len(eager) > 0:
+        failures.append(f"Modules imported eagerly at startup: {', '.join(eager)}")
+
+    if total_ms > float(threshold):
+        failures.append(f"Import time {total_ms:.1f} ms is over the threshold")
+
+    if len(failures) > 0:
+        print('\n'.join(failures))
+        sys.exit(1)
+
+
+## Filter rules
+
+FILTER_BENCH_PATHS = 20000
+"""Number of paths in the synthetic listing the filter rules are
+evaluated on."""
+
+FILTER_BENCH_PROJECTS = 200
+"""Number of projects in the synthetic working set."""
+
+def synthetic_working_set(n_projects, seed=0):
+    """Make includes and excludes like a hand-written working set which
+    selects some projects out of a tree, with the parent directory
+    includes written out by hand (and repeated) and repeated
+    excludes."""
+
+    rng = random.Random(seed)
+
+    includes = []
+    excludes = ['personal', 'incoming', 'outgoing', 'lab/*', 'lab/projects/*']
+    for idx in rng.sample(range(n_projects * 4), n_projects):
+
+        includes.extend([
+            'lab/',
+            'lab/projects/',
+            f'lab/projects/project{idx}/',
+            f'lab/projects/project{idx}/***',
+        ])
+
+        excludes.extend([
+            f'lab/projects/project{idx}/**.sqlite3',
+            '*__pycache__*',
+            '*.git',
+        ])
+
+    excludes.append('*')
+
+    return tuple(includes), tuple(excludes)
+
+def synthetic_paths(n_paths, n_projects, seed=0):
+    """Make a listing of paths with directories in a tree like the one
+    of synthetic_working_set."""
+
+    rng = random.Random(seed)
+
+    paths = []
+    while len(paths) < n_paths:
+
+        project = f"lab/projects/project{rng.randrange(n_projects * 4)}"
+        subdir = f"{project}/{rng.choice(['src', 'data', 'jobs', '__pycache__'])}"
+
+        paths.extend([
+            (project, True),
+            (subdir, True),
+            (f"{subdir}/file{rng.randrange(1000)}.{rng.choice(['py', 'txt', 'sqlite3'])}", False),
+        ])
+
+    return paths[:n_paths]
+
+def evaluate_rules(compiled_rules, paths):
+    """Evaluate compiled rules on every path like rsync does and count
+    the included paths and the number of patterns tested."""
+
+    n_included = 0
+    n_tests = 0
+    for path, is_dir in paths:
+
+        included = True
+        for regex, dir_only, include in compiled_rules:
+
+            if dir_only and not is_dir:
+                continue
+
+            n_tests += 1
+
+            if regex.fullmatch(path):
+                included = include
+                break
+
+        n_included += included
+
+    return n_included, n_tests
+
+def make_synthetic_tree(root, paths):
+
+    for path, is_dir in paths:
+
+        path = Path(root) / path
+
+        if is_dir:
+            path.mkdir(parents=True, exist_ok=True)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+
+def time_rsync(args):
+
+    start = time.perf_counter()
+    subprocess.run(['rsync'] + args, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+@task
+def filter_rules(cx,
+                 paths=FILTER_BENCH_PATHS,
+                 projects=FILTER_BENCH_PROJECTS,
+                 tree=False,
+):
+    """Compare evaluating a working set as written to evaluating its
+    compiled filter rules.
+
+    The rules are evaluated on a synthetic listing in Python. If 'tree'
+    is given and rsync is installed the listing is also made on disk and
+    rsync dry runs with the options and the filter file are timed.
+
+    """
+
+    from refugue.image import (
+        _compile_rules,
+        compile_filter_rules,
+        compile_rule_regexes,
+        render_filter_rules,
+    )
+
+    includes, excludes = synthetic_working_set(int(projects))
+    listing = synthetic_paths(int(paths), int(projects))
+
+    rules = compile_filter_rules(includes, excludes)
+
+    results = {}
+    for name, compiled in (('options', _compile_rules(includes, excludes)),
+                           ('compiled', compile_rule_regexes(rules))):
+
+        start = time.perf_counter()
+        n_included, n_tests = evaluate_rules(compiled, listing)
+        elapsed = time.perf_counter() - start
+
+        results[name] = (len(compiled), n_included, n_tests, elapsed)
+
+    option_args = ([f"--include={pattern}" for pattern in includes] +
+                   [f"--exclude={pattern}" for pattern in excludes])
+
+    print(f"Synthetic listing of {len(listing)} paths")
+    print(f"Command line for the options: {len(' '.join(option_args))} bytes")
+    print(f"{'':10}{'rules':>8}{'included':>10}{'tests':>12}{'seconds':>10}")
+    for name, (n_rules, n_included, n_tests, elapsed) in results.items():
+        print(f"{name:10}{n_rules:>8}{n_included:>10}{n_tests:>12}{elapsed:>10.3f}")
+
+    if results['options'][1] != results['compiled'][1]:
+        print("Compiled rules include a different number of paths than the options")
+
+    if not tree:
+        return
+
+    if shutil.which('rsync') is None:
+        print("rsync isn't installed, skipping the tree benchmark")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        src = Path(tmp_dir) / 'src'
+        make_synthetic_tree(src, listing)
+
+        filter_path = Path(tmp_dir) / 'filter.rules'
+        filter_path.write_text(render_filter_rules(rules))
+
+        common = ['--recursive', '--dry-run', f"{src}/", str(Path(tmp_dir) / 'dest')]
+
+        print(f"rsync with options: {time_rsync(option_args + common):.3f} s")
+        print(f"rsync with filter file: "
+              f"{time_rsync([f'--filter=merge {filter_path}'] + common):.3f} s")
+
+
+## Working set matcher
+
+MATCHER_BENCH_PATHS = 1000000
+"""Number of paths in the synthetic listing for the matcher
+benchmark."""
+
+MATCHER_BENCH_SAMPLE = 20000
+"""Number of paths to evaluate the rules one at a time on, since this
+is too slow for the whole listing."""
+
+def rsync_listing(root, filter_path):
+    """Get the paths rsync would transfer from a tree with a filter
+    file."""
+
+    proc = subprocess.run(
+        ['rsync', '--recursive', '--dry-run', '--out-format=%n',
+         f'--filter=merge {filter_path}',
+         f"{root}/", f"{root}.dest"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    return set(line.rstrip('/') for line in proc.stdout.splitlines()
+               if line.strip() not in ('', './'))
+
+def with_parent_dirs(paths):
+    """Add the parent directories missing from a listing of paths, which
+    a tree made from it by make_synthetic_tree has."""
+
+    listed = set(path for path, _ in paths)
+
+    paths = list(paths)
+    for path, _ in list(paths):
+
+        components = path.split('/')
+        for end in range(1, len(components)):
+
+            parent = '/'.join(components[:end])
+
+            if parent not in listed:
+                listed.add(parent)
+                paths.append((parent, True))
+
+    return paths
+
+@task
+def matcher(cx,
+            paths=MATCHER_BENCH_PATHS,
+            projects=FILTER_BENCH_PROJECTS,
+            verify=False,
+):
+    """Benchmark the working set matcher on a synthetic listing.
+
+    Compares testing the rules one at a time on a sample of the listing
+    to the matcher on all of it, for paths on their own and when
+    filtering a whole listing (which prunes excluded directories). For
+    the 10 million path benchmark use '--paths 10000000'.
+
+    If 'verify' is given and rsync is installed the decisions are also
+    checked against what rsync transfers from a fixture tree.
+
+    """
+
+    from refugue.image import (
+        compile_filter_rules,
+        compile_rule_regexes,
+        render_filter_rules,
+        WorkingSetMatcher,
+    )
+
+    includes, excludes = synthetic_working_set(int(projects))
+    rules = compile_filter_rules(includes, excludes)
+
+    start = time.perf_counter()
+    matcher = WorkingSetMatcher(rules)
+    build_time = time.perf_counter() - start
+
+    listing = synthetic_paths(int(paths), int(projects))
+    sample = listing[:MATCHER_BENCH_SAMPLE]
+
+    print(f"{len(rules)} rules, matcher built in {build_time:.3f} s")
+    print(f"Synthetic listing of {len(listing)} paths")
+
+    start = time.perf_counter()
+    evaluate_rules(compile_rule_regexes(rules), sample)
+    per_rule_rate = len(sample) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for path, is_dir in listing:
+        matcher.match(path, is_dir)
+    match_rate = len(listing) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    n_included = sum(1 for _ in matcher.filter_paths(listing))
+    filter_rate = len(listing) / (time.perf_counter() - start)
+
+    print(f"{'rule at a time:':20}{per_rule_rate:>14,.0f} paths/s (on {len(sample)} paths)")
+    print(f"{'matcher:':20}{match_rate:>14,.0f} paths/s")
+    print(f"{'filtered listing:':20}{filter_rate:>14,.0f} paths/s ({n_included} included)")
+
+    if not verify:
+        return
+
+    if shutil.which('rsync') is None:
+        print("rsync isn't installed, can't verify the matcher")
+        sys.exit(1)
+
+    fixture = synthetic_paths(MATCHER_BENCH_SAMPLE, int(projects), seed=1)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        root = Path(tmp_dir) / 'tree'
+        make_synthetic_tree(root, fixture)
+
+        filter_path = Path(tmp_dir) / 'filter.rules'
+        filter_path.write_text(render_filter_rules(rules))
+
+        expected = rsync_listing(root, filter_path)
+
+    fixture = with_parent_dirs(fixture)
+
+    included = set(path for path, _ in matcher.filter_paths(fixture))
+
+    if included != expected:
+        print(f"Matcher disagrees with rsync on {len(included ^ expected)} paths, e.g.:")
+        for path in sorted(included ^ expected)[:10]:
+            print(f"    {path} (rsync: {path in expected})")
+        sys.exit(1)
+
+    print(f"Matcher agrees with rsync on {len(set(path for path, _ in fixture))} fixture paths")
+
+
+## Transfers
+
+TRANSFER_BENCH_JIG = 'tests/jigs/bench'
+"""Jig with the local replicas the transfer benchmarks sync between."""
+
+TRANSFER_BENCH_BASELINE = f"{BENCHMARK_STORAGE_URL}/transfer.json"
+"""Where the results of the transfer benchmarks are saved and compared
+against."""
+
+TRANSFER_BENCH_TOLERANCE = 0.2
+"""Fraction a rate can drop (or the wall time grow) by compared to the
+baseline before it is reported as a regression."""
+
+TREE_SHAPES = (
+    # many tiny files in a flat-ish tree
+    'tiny',
+
+    # a few huge files
+    'huge',
+
+    # small files in deep hierarchies
+    'deep',
+
+    # a mix of small, medium, and large files
+    'mixed',
+
+    # large sparse files with little data in them
+    'sparse',
+)
+
+TRANSFER_BENCH_TRANSPORTS = (
+    ('rsync', 'rsync', {}, 'bench/target'),
+    ('rsync-parallel', 'rsync', {'parallel' : 4}, 'bench/target'),
+    ('rsync-incremental', 'rsync', {'incremental' : True}, 'bench/target'),
+    ('native', 'native', {}, 'bench/target'),
+    ('rsync-wan', 'rsync', {}, 'wan/target'),
+)
+"""Name, protocol, transport options and target replica of each way of
+transferring that is benchmarked. The 'wan' peer is a sandbox with a
+simulated WAN link (see refugue.sandbox)."""
+
+_BLOCK_SIZE = 1024 * 1024
+
+def _write_file(path, size, block):
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(path, 'wb') as wfile:
+        while size > 0:
+            wfile.write(block[:size])
+            size -= len(block)
+
+def make_transfer_tree(root, shape, scale=1.0, seed=0):
+    """Generate a synthetic tree of one of the TREE_SHAPES.
+
+    Sizes and counts are multiplied by the scale, at 1.0 each tree is
+    on the order of 10,000 files or 256 MB.
+
+    """
+
+    rng = random.Random(seed)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+
+    # random data so compression and matching can't cheat
+    block = rng.randbytes(_BLOCK_SIZE)
+
+    def count(n):
+        return max(1, int(n * scale))
+
+    if shape == 'tiny':
+
+        for idx in range(count(10000)):
+            _write_file(root / f"dir{idx % 100}" / f"file{idx}.txt",
+                        rng.randrange(1024), block)
+
+    elif shape == 'huge':
+
+        for idx in range(4):
+            _write_file(root / f"huge{idx}.bin", count(64 * _BLOCK_SIZE), block)
+
+    elif shape == 'deep':
+
+        for idx in range(count(2000)):
+
+            depth = rng.randrange(1, 32)
+            dir_path = Path(*[f"d{idx % 20}"] + [f"level{level}" for level in range(depth)])
+
+            _write_file(root / dir_path / f"file{idx}.txt", rng.randrange(4096), block)
+
+    elif shape == 'mixed':
+
+        for idx in range(count(2000)):
+            _write_file(root / 'small' / f"dir{idx % 50}" / f"file{idx}.txt",
+                        rng.randrange(8192), block)
+
+        for idx in range(count(50)):
+            _write_file(root / 'medium' / f"file{idx}.dat", _BLOCK_SIZE, block)
+
+        for idx in range(2):
+            _write_file(root / 'large' / f"file{idx}.bin", count(16 * _BLOCK_SIZE), block)
+
+    elif shape == 'sparse':
+
+        for idx in range(8):
+
+            path = root / f"sparse{idx}.img"
+
+            with open(path, 'wb') as wfile:
+
+                wfile.truncate(count(64 * _BLOCK_SIZE))
+
+                # a few blocks of data spread through it
+                for offset in range(0, count(64 * _BLOCK_SIZE), 16 * _BLOCK_SIZE):
+                    wfile.seek(offset)
+                    wfile.write(block[:4096])
+
+    else:
+        raise ValueError(f"Unknown tree shape: {shape}")
+
+def run_transfer_case(jig_dir, spec_name, protocol, transport_options,
+                      target='bench/target'):
+    """Sync the benchmark source replica to the target end-to-end and
+    measure it. Meant to run in its own process so the peak RSS is only
+    of this case.
+
+    Returns
+    -------
+
+    metrics : dict
+
+    """
+
+    import resource
+
+    from invoke import Context
+
+    from refugue.defaults import SYNC_SPECS
+    from refugue.network import Network
+    from refugue.image import Image
+    from refugue.sync import (
+        SyncPolicy,
+        TransportPolicy,
+        SyncSpec,
+    )
+    from refugue.cli import (
+        load_configs,
+        resolve_sync_protocol,
+    )
+
+    network_config_d, image_config_d = load_configs(
+        Path(jig_dir) / 'network.config.py',
+        Path(jig_dir) / 'images' / 'default.image.config.py',
+        use_cache=False,
+    )
+
+    image = Image.from_config(image_config_d, Network.from_config(network_config_d))
+
+    sync_options = dict(dict((name, options) for name, _, options in SYNC_SPECS)[spec_name])
+
+    sync_spec = SyncSpec(
+        sync_pol = SyncPolicy(**sync_options),
+        transport_pol = TransportPolicy(
+            compression = None,
+            encryption = None,
+            dry = False,
+            backup = None,
+            create = True,
+            output = 'quiet',
+            **transport_options,
+        ),
+    )
+
+    local_cx = Context()
+
+    sync_pair = image.pair(local_cx, sync_spec, None, 'bench/src', target)
+
+    sync_protocol = resolve_sync_protocol(protocol, image, sync_pair)
+
+    # keep the report of the sync itself out of the benchmark output
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+
+        start = time.perf_counter()
+
+        sync_func, _ = sync_pair.sync(local_cx, sync_protocol)
+        result = sync_func(
+            local_cx,
+            image.network.resolve_peer_context(local_cx, sync_pair.src.peer),
+            image.network.resolve_peer_context(local_cx, sync_pair.target.peer),
+        )
+
+        wall = time.perf_counter() - start
+
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    # in KB on linux
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    files = result.transferred_files if result.transferred_files > 0 else result.files
+
+    return {
+        'exit_code' : result.exit_code,
+        'wall' : wall,
+        'phases' : result.phases,
+        'files' : files,
+        'bytes' : result.transferred_size,
+        'files_per_s' : files / wall if wall > 0 else 0.0,
+        'mb_per_s' : result.transferred_size / 1e6 / wall if wall > 0 else 0.0,
+        'peak_rss_mb' : peak_rss / 1024,
+    }
+
+def _run_isolated(func, *args):
+    """Run a function in a fresh interpreter and get its result."""
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # the new interpreter imports the function from the tasks package
+    # with the same sys.path, which invoke doesn't leave it on
+    project_dir = str(Path(__file__).resolve().parents[2])
+    if project_dir not in sys.path:
+        sys.path.insert(0, project_dir)
+
+    with ProcessPoolExecutor(max_workers=1,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+def compare_transfer_results(results, baseline, tolerance=TRANSFER_BENCH_TOLERANCE):
+    """Compare the results of cases to a baseline.
+
+    Returns
+    -------
+
+    report : list of str
+        A line for each case in both.
+
+    regressions : list of str
+        The cases which are slower by more than the tolerance.
+
+    """
+
+    report = []
+    regressions = []
+    for key, metrics in results.items():
+
+        if key not in baseline:
+            continue
+
+        base = baseline[key]
+
+        changes = []
+        slower = False
+        for metric, higher_is_better in (('files_per_s', True),
+                                         ('mb_per_s', True),
+                                         ('wall', False),
+                                         ('peak_rss_mb', False)):
+
+            if base[metric] == 0:
+                continue
+
+            ratio = metrics[metric] / base[metric]
+            changes.append(f"{metric} {ratio:.2f}x")
+
+            if metric in ('files_per_s', 'mb_per_s', 'wall'):
+                if higher_is_better and ratio < 1 - tolerance:
+                    slower = True
+                elif not higher_is_better and ratio > 1 + tolerance:
+                    slower = True
+
+        report.append(f"{key:50} {', '.join(changes)}{'  REGRESSION' if slower else ''}")
+
+        if slower:
+            regressions.append(key)
+
+    return report, regressions
+
+@task
+def transfer(cx,
+             shapes=','.join(TREE_SHAPES),
+             specs='safe,update,colonize',
+             transports=','.join(name for name, _, _, _ in TRANSFER_BENCH_TRANSPORTS),
+             scale=0.1,
+             save=False,
+             compare=True,
+             baseline=TRANSFER_BENCH_BASELINE,
+             tolerance=TRANSFER_BENCH_TOLERANCE,
+):
+    """Benchmark syncing synthetic trees end-to-end between the local
+    replicas of the benchmark jig.
+
+    For each tree shape, sync spec (from refugue.defaults.SYNC_SPECS)
+    and transport a cold sync to an empty target and a warm resync with
+    nothing to do are run, each in a fresh process. The files/s, MB/s,
+    peak RSS and wall time of each phase are reported and compared to
+    the baseline if there is one. Give 'save' to write the results as
+    the new baseline. Fails if any case failed or regressed by more
+    than the tolerance.
+
+    Use '--specs all' for every sync spec, and a larger '--scale' for
+    more stable numbers.
+
+    """
+
+    from refugue import __version__
+    from refugue.defaults import SYNC_SPECS
+
+    shapes = shapes.split(',')
+    transports = transports.split(',')
+
+    if specs == 'all':
+        specs = [name for name, _, _ in SYNC_SPECS]
+    else:
+        specs = specs.split(',')
+
+    transport_specs = {name : (protocol, options, target)
+                       for name, protocol, options, target in TRANSFER_BENCH_TRANSPORTS}
+
+    if shutil.which('rsync') is None:
+        print("rsync isn't installed, only benchmarking the native protocol")
+        transports = [name for name in transports
+                      if transport_specs[name][0] != 'rsync']
+
+    results = {}
+    failures = []
+    with tempfile.TemporaryDirectory() as bench_dir:
+
+        # the jig expands the replica paths from these and the cache
+        # is isolated so there are no baselines from other runs
+        os.environ['REFUGUE_BENCH_DIR'] = bench_dir
+        os.environ['REFUGUE_CACHE_DIR'] = str(Path(bench_dir) / 'cache')
+
+        src = Path(bench_dir) / 'src'
+
+        print(f"{'case':50}{'files/s':>12}{'MB/s':>10}{'RSS MB':>9}{'wall s':>9}  phases")
+        for shape in shapes:
+
+            shutil.rmtree(src, ignore_errors=True)
+            make_transfer_tree(src, shape, scale=float(scale))
+
+            for spec_name in specs:
+                for transport_name in transports:
+
+                    protocol, options, target_replica = transport_specs[transport_name]
+
+                    # every case starts from an empty target
+                    for target in (Path(bench_dir) / 'target',
+                                   Path(bench_dir) / 'wan' / 'home' / 'target'):
+                        shutil.rmtree(target, ignore_errors=True)
+                        target.mkdir(parents=True)
+
+                    shutil.rmtree(Path(bench_dir) / 'cache', ignore_errors=True)
+
+                    for run in ('cold', 'warm'):
+
+                        key = f"{shape}/{spec_name}/{transport_name}/{run}"
+
+                        try:
+                            metrics = _run_isolated(run_transfer_case,
+                                                    TRANSFER_BENCH_JIG,
+                                                    spec_name,
+                                                    protocol,
+                                                    options,
+                                                    target_replica)
+                        except ValueError as err:
+                            # not all specs are supported by every protocol
+                            print(f"{key:50} skipped: {err}")
+                            break
+
+                        if metrics['exit_code'] != 0:
+                            failures.append(f"{key} exited with {metrics['exit_code']}")
+
+                        results[key] = metrics
+
+                        phases = ', '.join(f"{name} {elapsed:.3f}"
+                                           for name, elapsed in metrics['phases'].items())
+
+                        print(f"{key:50}{metrics['files_per_s']:>12,.0f}"
+                              f"{metrics['mb_per_s']:>10.1f}{metrics['peak_rss_mb']:>9.1f}"
+                              f"{metrics['wall']:>9.3f}  {phases}")
+
+    regressions = []
+    if compare and Path(baseline).exists():
+
+        with open(baseline) as rfile:
+            baseline_d = json.load(rfile)
+
+        print(f"\nCompared to the baseline from refugue {baseline_d['meta']['version']}:")
+
+        report, regressions = compare_transfer_results(results,
+                                                       baseline_d['cases'],
+                                                       tolerance=float(tolerance))
+        print('\n'.join(report))
+
+    if save:
+
+        Path(baseline).parent.mkdir(parents=True, exist_ok=True)
+
+        with open(baseline, 'w') as wfile:
+            json.dump(
+                {
+                    'meta' : {
+                        'version' : __version__,
+                        'python' : sys.version.split()[0],
+                        'platform' : platform.platform(),
+                        'scale' : float(scale),
+                    },
+                    'cases' : results,
+                },
+                wfile,
+                indent=2,
+            )
+
+        print(f"Saved baseline to: {baseline}")
+
+    failures.extend(f"{key} regressed" for key in regressions)
+
+    if len(failures) > 0:
+        print('\n'.join(failures))
+        sys.exit(1)
+
+
+## Configuration scalability
+
+CONFIG_BENCH_PEERS = (100, 200, 400, 800)
+"""Numbers of peers in the synthetic networks, the images have
+CONFIG_BENCH_REPLICAS_PER_PEER replicas for each."""
+
+CONFIG_BENCH_REPLICAS_PER_PEER = 10
+
+CONFIG_BENCH_PROJECTS = (250, 500, 1000, 2000)
+"""Numbers of projects in the synthetic working sets, each has a few
+include and exclude patterns (see synthetic_working_set)."""
+
+CONFIG_BENCH_CALLS = 2000
+"""Number of calls to time for the operations which are done once per
+lookup rather than once per config."""
+
+CONFIG_BENCH_BOUNDS = (
+    # operation, maximum growth exponent
+    ('read_network_config', 1.3),
+    ('read_network_config (cached)', 1.3),
+    ('read_image_config', 1.3),
+    ('read_image_config (cached)', 1.3),
+    ('Network.from_config', 1.3),
+    ('Image.from_config', 1.3),
+    ('Image.get_replica', 0.3),
+    ('resolve_pair_options', 0.3),
+    ('_compile_rsync_options', 0.3),
+    ('compile_filter_rules', 1.3),
+)
+"""The time of each operation may grow at most like the size of the
+config to this power: ~1 for linear, ~0 for constant time per call."""
+
+def synthetic_network_config(n_peers):
+    """Source of a generated network config with a host for each peer
+    (and a few drives), some with aliases and connections."""
+
+    hosts = [f"host{idx}" for idx in range(n_peers)]
+    drives = [f"drive{idx}" for idx in range(max(1, n_peers // 10))]
+
+    peer_aliases = {f"alias{idx}" : hosts[idx] for idx in range(0, n_peers, 3)}
+    connections = {host : {'host' : f"{host}.example.org", 'user' : 'refugue'}
+                   for host in hosts}
+
+    return '\n'.join([
+        f"HOSTS = {hosts!r}",
+        f"DRIVES = {drives!r}",
+        f"PEER_ALIASES = {peer_aliases!r}",
+        "HOST_NODE_ALIASES = {}",
+        "PEER_TYPES = {'hosts' : HOSTS, 'drives' : DRIVES}",
+        "PEERS = DRIVES + HOSTS",
+        "PEER_MOUNT_PREFIX_TYPES = {('drive', 'host') : '/media/$USER', ('host', 'hw') : None}",
+        f"CONNECTIONS = {connections!r}",
+        '',
+    ])
+
+def synthetic_image_config(n_peers, n_projects):
+    """Source of a generated image config with replicas on every peer
+    of a synthetic network, all sharing large lists of patterns, and
+    options for a pairing of each replica."""
+
+    replicas = [f"host{peer}/tree{idx}"
+                for peer in range(n_peers)
+                for idx in range(CONFIG_BENCH_REPLICAS_PER_PEER)]
+
+    includes, excludes = synthetic_working_set(n_projects)
+
+    pair_options = "{'sync' : {'clean' : True}, 'transport' : {'compression' : 'auto'}}"
+
+    lines = [
+        f"INCLUDES = {list(includes)!r}",
+        f"EXCLUDES = {list(excludes)!r}",
+        f"REPLICAS = {replicas!r}",
+        "REPLICA_PREFIXES = {",
+        *(f"    {replica!r} : '$HOME/{replica}'," for replica in replicas),
+        "}",
+        "REPLICA_INCLUDES = {",
+        *(f"    {replica!r} : INCLUDES," for replica in replicas),
+        "}",
+        "REPLICA_EXCLUDES = {",
+        *(f"    {replica!r} : EXCLUDES," for replica in replicas),
+        "}",
+        "DEFAULT_PAIR_OPTIONS = {'sync' : {'clean' : True}, 'transport' : {'backup' : 'rename'}}",
+        "PAIR_OPTIONS = {",
+        *(f"    ({src!r}, {target!r}, '<-->') : {pair_options},"
+          for src, target in zip(replicas, replicas[1:])),
+        "}",
+        '',
+    ]
+
+    return '\n'.join(lines)
+
+def best_time(func, repeats=5, calls=1):
+    """Get the fastest time of calling a function (per call)."""
+
+    best = None
+    for _ in range(repeats):
+
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        elapsed = (time.perf_counter() - start) / calls
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def growth_exponent(sizes, times):
+    """The exponent k of the power law t ~ n^k fit to the smallest and
+    largest sizes."""
+
+    import math
+
+    if times[0] <= 0 or times[-1] <= 0:
+        return 0.0
+
+    return math.log(times[-1] / times[0]) / math.log(sizes[-1] / sizes[0])
+
+def measure_config_operations(tmp_dir, n_peers, n_projects, repeats=5):
+    """Time each of the config operations on synthetic configs of a
+    size.
+
+    Returns
+    -------
+
+    times : dict of str : float
+        Seconds for each operation in CONFIG_BENCH_BOUNDS.
+
+    """
+
+    import random as _random
+
+    from refugue.cache import invalidate_cache
+    from refugue.network import Network
+    from refugue.image import Image, compile_filter_rules
+    from refugue.sync import (
+        SyncPolicy,
+        TransportPolicy,
+        SyncSpec,
+    )
+    from refugue.protocols.rsync import RsyncProtocol
+    from refugue.cli import (
+        read_network_config,
+        read_image_config,
+        resolve_pair_options,
+    )
+
+    network_path = Path(tmp_dir) / f"network{n_peers}.config.py"
+    image_path = Path(tmp_dir) / f"image{n_peers}-{n_projects}.config.py"
+
+    network_path.write_text(synthetic_network_config(n_peers))
+    image_path.write_text(synthetic_image_config(n_peers, n_projects))
+
+    times = {}
+
+    times['read_network_config'] = best_time(
+        lambda: read_network_config(network_path, use_cache=False), repeats)
+    times['read_image_config'] = best_time(
+        lambda: read_image_config(image_path, use_cache=False), repeats)
+
+    # fill the cache first
+    invalidate_cache('network_configs')
+    invalidate_cache('image_configs')
+    network_config_d = read_network_config(network_path)
+    image_config_d = read_image_config(image_path)
+
+    times['read_network_config (cached)'] = best_time(
+        lambda: read_network_config(network_path), repeats)
+    times['read_image_config (cached)'] = best_time(
+        lambda: read_image_config(image_path), repeats)
+
+    times['Network.from_config'] = best_time(
+        lambda: Network.from_config(network_config_d), repeats)
+
+    network = Network.from_config(network_config_d)
+
+    times['Image.from_config'] = best_time(
+        lambda: Image.from_config(image_config_d, network), repeats)
+
+    image = Image.from_config(image_config_d, network)
+
+    # lookups of random replicas, some by a peer alias
+    rng = _random.Random(0)
+    replica_names = [rng.choice(image_config_d['REPLICAS'])
+                     for _ in range(CONFIG_BENCH_CALLS)]
+    replica_names = [name.replace('host0/', 'alias0/') for name in replica_names]
+
+    names = iter(replica_names * (repeats + 1))
+    times['Image.get_replica'] = best_time(
+        lambda: image.get_replica(next(names)), repeats, calls=CONFIG_BENCH_CALLS)
+
+    pairs = iter(list(zip(replica_names, replica_names[1:] + replica_names[:1])) * (repeats + 1))
+    times['resolve_pair_options'] = best_time(
+        lambda: resolve_pair_options(image_config_d, *next(pairs)),
+        repeats, calls=CONFIG_BENCH_CALLS)
+
+    sync_spec = SyncSpec(
+        sync_pol = SyncPolicy(inject=False, clobber=False, clean=True, prune=False),
+        transport_pol = TransportPolicy(compression='auto', encryption=None,
+                                        dry=True, backup='rename', create=True),
+    )
+
+    src = image.get_replica(replica_names[0])
+    target = image.get_replica(replica_names[1])
+
+    times['_compile_rsync_options'] = best_time(
+        lambda: RsyncProtocol._compile_rsync_options(sync_spec, src, target),
+        repeats, calls=CONFIG_BENCH_CALLS)
+
+    # the filter rules are cached for each working set
+    def _compile_filter():
+        compile_filter_rules.cache_clear()
+        compile_filter_rules(target.wset.includes, target.wset.excludes)
+
+    times['compile_filter_rules'] = best_time(_compile_filter, repeats)
+
+    return times
+
+@task
+def config(cx,
+           peers=','.join(str(n) for n in CONFIG_BENCH_PEERS),
+           projects=','.join(str(n) for n in CONFIG_BENCH_PROJECTS),
+           repeats=5,
+):
+    """Benchmark loading and using large generated network and image
+    configs and check the operations scale as expected.
+
+    Each size step grows the number of peers (and replicas) and the
+    number of patterns in the working sets together. Fails if the time
+    of any operation grows faster than its bound in
+    CONFIG_BENCH_BOUNDS, e.g. quadratically instead of linearly.
+
+    """
+
+    peers = [int(n) for n in peers.split(',')]
+    projects = [int(n) for n in projects.split(',')]
+
+    if len(peers) != len(projects):
+        print("Give the same number of peer and project sizes")
+        sys.exit(1)
+
+    sizes = list(zip(peers, projects))
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        # don't touch the user's cache
+        os.environ['REFUGUE_CACHE_DIR'] = str(Path(tmp_dir) / 'cache')
+
+        for n_peers, n_projects in sizes:
+
+            print(f"Measuring {n_peers} peers, "
+                  f"{n_peers * CONFIG_BENCH_REPLICAS_PER_PEER} replicas, "
+                  f"{n_projects} projects")
+
+            results.append(measure_config_operations(tmp_dir, n_peers, n_projects,
+                                                     repeats=int(repeats)))
+
+    header = ''.join(f"{n_peers:>12}" for n_peers, _ in sizes)
+    print(f"\n{'operation (ms) / peers':32}{header}{'exponent':>10}{'bound':>7}")
+
+    failures = []
+    for operation, bound in CONFIG_BENCH_BOUNDS:
+
+        times = [result[operation] for result in results]
+
+        # the filter rules only depend on the number of patterns
+        scale = projects if operation == 'compile_filter_rules' else peers
+
+        exponent = growth_exponent(scale, times)
+
+        print(f"{operation:32}" +
+              ''.join(f"{elapsed * 1000:>12.4f}" for elapsed in times) +
+              f"{exponent:>10.2f}{bound:>7.1f}")
+
+        if exponent > bound:
+            failures.append(f"{operation} grows like n^{exponent:.2f}, over the bound of {bound}")
+
+    if len(failures) > 0:
+        print('\n'.join(failures))
+        sys.exit(1)
+
+
+bench_coll = Collection('bench')
+
+tasks = [
+    import_time,
+    filter_rules,
+    matcher,
+    transfer,
+    config,
+]
+
+for task in tasks:
+    bench_coll.add_task(task)
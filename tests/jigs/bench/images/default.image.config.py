@@ -0,0 +1,51 @@
+IMAGE_NAME = "bench"
+
+# the benchmarks generate the source tree and sync it to the target in
+# a scratch directory given by the environment
+REPLICAS = [
+    'bench/src',
+    'bench/target',
+    'wan/target',
+]
+
+REPLICA_PREFIXES = {
+    'bench/src' : '$REFUGUE_BENCH_DIR/src',
+    'bench/target' : '$REFUGUE_BENCH_DIR/target',
+
+    # in the home of the sandbox
+    'wan/target' : '$HOME/target',
+}
+
+REPLICA_EXCLUDES = {
+    'bench/src' : [],
+    'bench/target' : [],
+    'wan/target' : [],
+}
+
+REPLICA_INCLUDES = {
+    'bench/src' : [],
+    'bench/target' : [],
+    'wan/target' : [],
+}
+
+
+## Pairings
+
+# the benchmarks give the sync spec of each case explicitly
+
+DEFAULT_PAIR_OPTIONS = {
+    'sync' : {
+         'inject' : False,
+         'clobber' : False,
+         'clean' : True,
+         'prune' : False,
+    },
+
+    'transport' : {
+        'backup' : None,
+        'compression' : None,
+        'encryption' : None,
+    },
+}
+
+PAIR_OPTIONS = {}
@@ -0,0 +1,43 @@
+### Configuration
+
+# a host which is always the local one and a stand-in for a remote
+# host over a WAN link, which is sandboxed locally
+
+import platform
+
+DRIVES = []
+
+HOSTS = [
+    'bench',
+    'wan',
+]
+
+HOST_NODE_ALIASES = {
+    'bench' : [platform.node()],
+}
+
+PEER_ALIASES = {}
+
+PEER_TYPES = {
+    'hosts' : HOSTS,
+    'drives' : DRIVES,
+}
+
+PEERS = DRIVES + HOSTS
+
+PEER_MOUNT_PREFIX_TYPES = {
+    ('host', 'hw') : None,
+}
+
+CONNECTIONS = {
+    'wan' : {
+        'host' : 'wan.example.org',
+        'user' : 'bench',
+        'sandbox' : {
+            'root' : '$REFUGUE_BENCH_DIR/wan',
+            'rtt' : 0.05,
+            # 100 Mbit/s
+            'bandwidth' : 12_500_000,
+        },
+    },
+}
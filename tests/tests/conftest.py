@@ -0,0 +1,50 @@
+"""Shared setup of the test suites."""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+
+# the benchmarks reuse the helpers of the 'bench' tasks, which aren't
+# part of the installed package
+if str(PROJECT_DIR) not in sys.path:
+    sys.path.insert(0, str(PROJECT_DIR))
+
+TIMING_TESTS_ENV = 'REFUGUE_TIMING_TESTS'
+"""Environment variable which enables the assertions on wall clock
+times, which are too noisy on shared machines to run by default."""
+
+
+def timing_tests_enabled():
+
+    return os.environ.get(TIMING_TESTS_ENV, '') not in ('', '0')
+
+
+def pytest_configure(config):
+
+    config.addinivalue_line(
+        'markers',
+        f"timing: asserts wall clock times, only run when {TIMING_TESTS_ENV}=1",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+
+    if timing_tests_enabled():
+        return
+
+    skip = pytest.mark.skip(reason=f"timing tests need {TIMING_TESTS_ENV}=1")
+    for item in items:
+        if 'timing' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def check_timing():
+    """Whether to also assert on the times of a test which otherwise
+    only checks the results."""
+
+    return timing_tests_enabled()
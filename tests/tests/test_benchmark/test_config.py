@@ -0,0 +1,49 @@
+"""Benchmark of how the config operations scale with the number of
+peers and projects.
+
+A small version of the 'bench.config' task, the sizes are far apart so
+that the growth exponents aren't dominated by the timing noise.
+
+"""
+
+import pytest
+
+from tasks.plugins.bench import (
+    CONFIG_BENCH_BOUNDS,
+    growth_exponent,
+    measure_config_operations,
+)
+
+CONFIG_TEST_SIZES = ((25, 60), (400, 960))
+"""The (peers, projects) sizes of the synthetic configs."""
+
+CONFIG_TEST_REPEATS = 5
+
+
+@pytest.fixture(scope='module')
+def config_times(tmp_path_factory):
+
+    monkeypatch = pytest.MonkeyPatch()
+
+    tmp_dir = tmp_path_factory.mktemp('config_bench')
+    monkeypatch.setenv('REFUGUE_CACHE_DIR', str(tmp_dir / 'cache'))
+
+    try:
+        yield [measure_config_operations(str(tmp_dir), n_peers, n_projects,
+                                         repeats=CONFIG_TEST_REPEATS)
+               for n_peers, n_projects in CONFIG_TEST_SIZES]
+    finally:
+        monkeypatch.undo()
+
+
+@pytest.mark.parametrize('operation, bound', CONFIG_BENCH_BOUNDS)
+def test_growth_exponent(config_times, operation, bound):
+
+    if operation == 'compile_filter_rules':
+        sizes = [n_projects for _, n_projects in CONFIG_TEST_SIZES]
+    else:
+        sizes = [n_peers for n_peers, _ in CONFIG_TEST_SIZES]
+
+    exponent = growth_exponent(sizes, [times[operation] for times in config_times])
+
+    assert exponent <= bound
@@ -0,0 +1,43 @@
+"""Benchmark of the startup import time of the command line tool, see
+the 'bench.import_time' task for a report of the slowest modules."""
+
+import subprocess
+import sys
+
+import pytest
+
+from tasks.plugins.bench import (
+    IMPORT_TIME_MODULE,
+    IMPORT_TIME_THRESHOLD_MS,
+    LAZY_MODULES,
+    measure_import_time,
+)
+
+
+def test_heavy_modules_are_imported_lazily():
+
+    # in a fresh interpreter since the tests import everything
+    proc = subprocess.run(
+        [sys.executable, '-c',
+         f"import sys, {IMPORT_TIME_MODULE}; "
+         "print('\\n'.join(sys.modules))"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    imported = set(name.split('.')[0] for name in proc.stdout.splitlines())
+
+    assert 'fabric' not in imported
+    assert 'paramiko' not in imported
+    assert sorted(imported.intersection(LAZY_MODULES)) == []
+
+
+@pytest.mark.timing
+def test_import_time():
+
+    times = measure_import_time(IMPORT_TIME_MODULE)
+
+    total_ms = times[IMPORT_TIME_MODULE][1] / 1000
+
+    assert total_ms <= IMPORT_TIME_THRESHOLD_MS
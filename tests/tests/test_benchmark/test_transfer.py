@@ -0,0 +1,113 @@
+"""Benchmarks of syncing synthetic trees end-to-end between the local
+replicas of the benchmark jig.
+
+A small version of the 'bench.transfer' task, which has the full
+matrix of sync specs and saves the baselines.
+
+"""
+
+import json
+import shutil
+from pathlib import Path
+
+import pytest
+
+from tasks.plugins.bench import (
+    TRANSFER_BENCH_BASELINE,
+    TRANSFER_BENCH_JIG,
+    TRANSFER_BENCH_TOLERANCE,
+    TRANSFER_BENCH_TRANSPORTS,
+    TREE_SHAPES,
+    _run_isolated,
+    compare_transfer_results,
+    make_transfer_tree,
+    run_transfer_case,
+)
+
+PROJECT_DIR = Path(__file__).resolve().parents[3]
+
+TRANSFER_TEST_SCALE = 0.05
+"""Scale of the trees, small enough for every case to run in a second
+or so."""
+
+TRANSFER_TEST_SPEC = 'safe'
+"""The sync spec every case is run with."""
+
+WARM_SLACK = 0.1
+"""Seconds a resync with nothing to do may take over the cold sync,
+for the fixed costs which dominate on tiny trees."""
+
+
+def load_baseline():
+    """Get the baseline cases of the 'bench.transfer' task if one was
+    saved at the same scale."""
+
+    path = PROJECT_DIR / TRANSFER_BENCH_BASELINE
+
+    if not path.exists():
+        return {}
+
+    with open(path) as rfile:
+        baseline_d = json.load(rfile)
+
+    if baseline_d['meta'].get('scale') != TRANSFER_TEST_SCALE:
+        return {}
+
+    return baseline_d['cases']
+
+
+@pytest.fixture
+def bench_dir(tmp_path, monkeypatch):
+
+    # the jig expands the replica paths from these and the cache is
+    # isolated so there are no baselines from other runs
+    monkeypatch.setenv('REFUGUE_BENCH_DIR', str(tmp_path))
+    monkeypatch.setenv('REFUGUE_CACHE_DIR', str(tmp_path / 'cache'))
+
+    for target in (tmp_path / 'target', tmp_path / 'wan' / 'home' / 'target'):
+        target.mkdir(parents=True)
+
+    return tmp_path
+
+
+@pytest.mark.parametrize('transport', TRANSFER_BENCH_TRANSPORTS,
+                         ids=[name for name, _, _, _ in TRANSFER_BENCH_TRANSPORTS])
+@pytest.mark.parametrize('shape', TREE_SHAPES)
+def test_transfer(bench_dir, check_timing, shape, transport):
+
+    name, protocol, options, target = transport
+
+    if protocol == 'rsync' and shutil.which('rsync') is None:
+        pytest.skip("rsync isn't installed")
+
+    make_transfer_tree(bench_dir / 'src', shape, scale=TRANSFER_TEST_SCALE)
+
+    results = {}
+    for run in ('cold', 'warm'):
+
+        # each in a fresh process so the peak RSS is only of this case
+        results[f"{shape}/{TRANSFER_TEST_SPEC}/{name}/{run}"] = _run_isolated(
+            run_transfer_case,
+            str(PROJECT_DIR / TRANSFER_BENCH_JIG),
+            TRANSFER_TEST_SPEC,
+            protocol,
+            options,
+            target,
+        )
+
+    cold, warm = results.values()
+
+    assert cold['exit_code'] == 0
+    assert warm['exit_code'] == 0
+
+    assert cold['files'] > 0
+    assert warm['bytes'] == 0
+
+    if not check_timing:
+        return
+
+    assert warm['wall'] <= cold['wall'] * (1 + TRANSFER_BENCH_TOLERANCE) + WARM_SLACK
+
+    _, regressions = compare_transfer_results(results, load_baseline())
+
+    assert regressions == []
@@ -0,0 +1,72 @@
+"""Unit tests for the on-disk cache."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from refugue.cache import (
+    atomic_write,
+    make_tmp_dir,
+    read_cache,
+    replace_dir,
+    write_cache,
+)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+
+    monkeypatch.setenv('REFUGUE_CACHE_DIR', str(tmp_path / 'cache'))
+
+    return tmp_path / 'cache'
+
+
+def test_write_and_read(cache_dir):
+
+    write_cache('things', 'a/key', {'x' : 1})
+
+    assert read_cache('things', 'a/key') == {'x' : 1}
+    assert read_cache('things', 'other') is None
+    assert read_cache('things', 'a/key', ttl=-1) is None
+
+
+def test_concurrent_writes_of_a_key(cache_dir):
+
+    # threads of one process must not share a temporary file
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda value: write_cache('things', 'key', [value] * 1000),
+                          range(200)))
+
+    value = read_cache('things', 'key')
+
+    assert len(set(value)) == 1
+    assert list((cache_dir / 'things').iterdir()) == [cache_dir / 'things' / 'key.json']
+
+
+def test_failed_write_changes_nothing(tmp_path):
+
+    path = tmp_path / 'file'
+    path.write_text('old')
+
+    with pytest.raises(RuntimeError):
+        with atomic_write(path) as wf:
+            wf.write('new')
+            raise RuntimeError()
+
+    assert path.read_text() == 'old'
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_replace_dir(tmp_path):
+
+    path = tmp_path / 'dir'
+
+    for text in ('first', 'second'):
+
+        tmp_dir = make_tmp_dir(path)
+        (tmp_dir / 'file').write_text(text)
+
+        replace_dir(tmp_dir, path)
+
+        assert (path / 'file').read_text() == text
+        assert list(tmp_path.iterdir()) == [path]
@@ -0,0 +1,112 @@
+"""Unit tests for compiling working sets to rsync filter rules."""
+
+import pytest
+
+from refugue.image import (
+    compile_filter_rules,
+    is_catch_all,
+    normalize_pattern,
+    parent_patterns,
+    render_filter_rules,
+)
+
+
+@pytest.mark.parametrize('pattern', ['*', '**', '***'])
+def test_unanchored_wildcards_are_catch_alls(pattern):
+
+    assert is_catch_all(pattern)
+
+
+@pytest.mark.parametrize('pattern', ['/*', '/**', '/***', '*/', 'a/*', '*.txt'])
+def test_other_patterns_are_not_catch_alls(pattern):
+
+    assert not is_catch_all(pattern)
+
+
+def test_normalize_pattern():
+
+    assert normalize_pattern('  ./a//b/ ') == 'a/b/'
+    assert normalize_pattern('././a') == 'a'
+    assert normalize_pattern('/') is None
+    assert normalize_pattern('') is None
+
+
+def test_parent_patterns():
+
+    assert parent_patterns('a/b/*.txt') == ['a/', 'a/b/']
+    assert parent_patterns('/a/b/') == ['/a/']
+    assert parent_patterns('a/b/***') == ['a/']
+    assert parent_patterns('a/**/c/d') == ['a/']
+    assert parent_patterns('*.txt') == []
+
+
+def test_nothing_excluded_has_no_rules():
+
+    assert compile_filter_rules((), ()) == ()
+    assert compile_filter_rules(('a/', 'b/'), ()) == ()
+
+
+def test_includes_come_before_excludes_with_parents():
+
+    assert compile_filter_rules(('a/b/*.txt',), ('*',)) == (
+        (True, 'a/'),
+        (True, 'a/b/'),
+        (True, 'a/b/*.txt'),
+        (False, '*'),
+    )
+
+
+def test_duplicates_are_dropped():
+
+    assert compile_filter_rules(('a/', './a/', 'a//'), ('b', 'b')) == (
+        (True, 'a/'),
+        (False, 'b'),
+    )
+
+
+def test_rules_after_catch_all_are_dropped():
+
+    assert compile_filter_rules((), ('*.o', '*', 'x')) == (
+        (False, '*.o'),
+        (False, '*'),
+    )
+
+
+def test_unanchored_catch_all_include_includes_everything():
+
+    assert compile_filter_rules(('*',), ('secret/',)) == ()
+
+
+@pytest.mark.parametrize('pattern', ['/*', '/**', '/***'])
+def test_anchored_include_keeps_later_excludes(pattern):
+
+    # an anchored pattern only matches at the top, nested paths must
+    # still be excluded
+    assert compile_filter_rules((pattern,), ('secret/',)) == (
+        (True, pattern),
+        (False, 'secret/'),
+    )
+
+
+def test_anchored_exclude_keeps_later_excludes():
+
+    assert compile_filter_rules((), ('/*', 'secret/')) == (
+        (False, '/*'),
+        (False, 'secret/'),
+    )
+
+
+def test_ellipsis_includes_or_excludes_everything():
+
+    assert compile_filter_rules(Ellipsis, ('x',)) == ((False, 'x'),)
+    assert compile_filter_rules(('x',), Ellipsis) == (
+        (True, 'x'),
+        (False, '*'),
+    )
+
+
+def test_render_filter_rules():
+
+    rules = compile_filter_rules(('a/b',), ('*',))
+
+    assert render_filter_rules(rules) == "+ a/\n+ a/b\n- *\n"
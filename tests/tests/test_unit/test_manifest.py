@@ -0,0 +1,118 @@
+"""Unit tests for the manifests of replicas."""
+
+import os
+
+import pytest
+
+from refugue.manifest import (
+    diff_paths,
+    parse_find_mtime,
+    scan_local_manifest,
+    ManifestWriter,
+    Manifest,
+)
+
+
+@pytest.mark.parametrize('mtime, mtime_ns', [
+    ('1700000000.1234567890', 1700000000_123456789),
+    ('1700000000.5', 1700000000_500000000),
+    ('1700000000', 1700000000_000000000),
+    ('-1.25', -1_250000000),
+])
+def test_parse_find_mtime(mtime, mtime_ns):
+
+    assert parse_find_mtime(mtime) == mtime_ns
+
+
+def write_manifest(path, entries):
+    """Write a manifest from (path, size, mtime_ns, mode) entries which
+    are in manifest order, without subtree ends."""
+
+    writer = ManifestWriter(path)
+
+    for entry_path, size, mtime_ns, mode in entries:
+        writer.add(entry_path, size, mtime_ns, 0, mode)
+
+    writer.finish()
+
+    return Manifest(path)
+
+
+FILE = 0o100644
+DIR = 0o040755
+
+
+def test_diff(tmp_path):
+
+    old = write_manifest(tmp_path / 'old', [
+        (b'a', 0, 0, DIR),
+        (b'a/changed', 1, 1, FILE),
+        (b'a/removed', 1, 1, FILE),
+        (b'a/same', 1, 1, FILE),
+        (b'a/touched', 1, 1, FILE),
+        (b'a-b', 1, 1, FILE),
+        (b'type', 1, 1, FILE),
+    ])
+
+    new = write_manifest(tmp_path / 'new', [
+        (b'a', 0, 5, DIR),
+        (b'a/added', 1, 1, FILE),
+        (b'a/changed', 2, 1, FILE),
+        (b'a/same', 1, 1, FILE),
+        (b'a/touched', 1, 2, FILE),
+        (b'a-b', 1, 1, FILE),
+        (b'type', 0, 1, DIR),
+    ])
+
+    try:
+        diff = [(kind, path) for kind, path, _, _ in new.diff(old)]
+
+        # directories aren't modified by their mtime changing
+        assert diff == [
+            ('added', b'a/added'),
+            ('modified', b'a/changed'),
+            ('removed', b'a/removed'),
+            ('modified', b'a/touched'),
+            ('modified', b'type'),
+        ]
+
+        assert list(diff_paths(new, old, prefix='a')) == [
+            ('added', 'added', False),
+            ('modified', 'changed', False),
+            ('removed', 'removed', False),
+            ('modified', 'touched', False),
+        ]
+
+        assert list(new.diff(new)) == []
+
+    finally:
+        old.close()
+        new.close()
+
+
+def test_diff_of_scans(tmp_path):
+
+    root = tmp_path / 'replica'
+    (root / 'dir' / 'sub').mkdir(parents=True)
+    (root / 'dir' / 'sub' / 'file').write_text('a')
+    (root / 'dir' / 'gone').write_text('a')
+    (root / 'top').write_text('a')
+
+    old = scan_local_manifest(root, tmp_path / 'old')
+
+    (root / 'dir' / 'gone').unlink()
+    (root / 'dir' / 'sub' / 'new').write_text('a')
+    (root / 'top').write_text('ab')
+
+    new = scan_local_manifest(root, tmp_path / 'new')
+
+    try:
+        assert sorted(diff_paths(new, old)) == [
+            ('added', 'dir/sub/new', False),
+            ('modified', 'top', False),
+            ('removed', 'dir/gone', False),
+        ]
+
+    finally:
+        old.close()
+        new.close()
@@ -0,0 +1,236 @@
+"""Unit tests for matching paths against compiled filter rules."""
+
+import shutil
+
+import pytest
+
+from refugue.image import (
+    compile_filter_rules,
+    compile_rule_regexes,
+    render_filter_rules,
+    WorkingSetMatcher,
+)
+
+
+@pytest.mark.parametrize('path, is_dir, included', [
+    # literal subtree and its parents
+    ('lab', True, True),
+    ('lab/projects', True, True),
+    ('lab/projects/keep', True, True),
+    ('lab/projects/keep/src/main.py', False, True),
+
+    # excluded inside an included subtree
+    ('lab/projects/keep/db.sqlite3', False, False),
+    ('lab/projects/keep/__pycache__', True, False),
+
+    # dir only rule doesn't apply to files
+    ('lab/projects/keep/build', True, False),
+    ('lab/projects/keep/build', False, True),
+
+    # everything else
+    ('lab/projects/other', True, False),
+    ('notes.txt', False, False),
+])
+def test_match(path, is_dir, included):
+
+    rules = (
+        (False, '*.sqlite3'),
+        (False, '__pycache__'),
+        (False, 'build/'),
+        (True, 'lab/'),
+        (True, 'lab/projects/'),
+        (True, 'lab/projects/keep/***'),
+        (False, '*'),
+    )
+
+    assert WorkingSetMatcher(rules).match(path, is_dir) == included
+
+
+def test_no_rules_include_everything():
+
+    matcher = WorkingSetMatcher(())
+
+    assert matcher.match('a/b/c')
+    assert matcher.match('a', is_dir=True)
+
+
+def test_anchored_rules_only_match_from_the_top():
+
+    matcher = WorkingSetMatcher(((False, '/tmp'), (False, '/cache/*')))
+
+    assert not matcher.match('tmp', is_dir=True)
+    assert matcher.match('a/tmp', is_dir=True)
+    assert not matcher.match('cache/x')
+    assert matcher.match('a/cache/x')
+
+
+def test_unanchored_paths_match_trailing_components():
+
+    matcher = WorkingSetMatcher(((False, 'b/c'),))
+
+    assert not matcher.match('b/c')
+    assert not matcher.match('a/b/c')
+    assert matcher.match('a/xb/c')
+    assert matcher.match('a/b/c/d')
+
+
+def test_wildcards():
+
+    matcher = WorkingSetMatcher((
+        (False, 'data/*.tmp'),
+        (False, 'logs/**/old'),
+        (False, 'x?z'),
+    ))
+
+    assert not matcher.match('data/a.tmp')
+    assert matcher.match('data/sub/a.tmp')
+    assert not matcher.match('logs/a/b/old')
+    assert matcher.match('logs/a/b/older')
+    assert not matcher.match('q/xyz')
+    assert matcher.match('q/xyyz')
+
+
+def test_first_matching_rule_wins():
+
+    matcher = WorkingSetMatcher(((True, 'keep.log'), (False, '*.log')))
+
+    assert matcher.match('a/keep.log')
+    assert not matcher.match('a/other.log')
+
+
+def test_agrees_with_rules_one_at_a_time():
+
+    rules = compile_filter_rules(
+        ('lab/projects/p1/***', 'lab/projects/p2/src/', 'lab/projects/p2/src/*.py'),
+        ('*__pycache__*', '**.sqlite3', 'lab/*', '*'),
+    )
+
+    compiled = compile_rule_regexes(rules)
+    matcher = WorkingSetMatcher(rules)
+
+    for path in ('lab', 'lab/projects', 'lab/projects/p1', 'lab/projects/p1/a.py',
+                 'lab/projects/p1/__pycache__', 'lab/projects/p1/x/db.sqlite3',
+                 'lab/projects/p2', 'lab/projects/p2/src', 'lab/projects/p2/src/a.py',
+                 'lab/projects/p2/src/a.txt', 'lab/other', 'other'):
+
+        for is_dir in (True, False):
+
+            expected = True
+            for regex, dir_only, include in compiled:
+
+                if dir_only and not is_dir:
+                    continue
+
+                if regex.fullmatch(path):
+                    expected = include
+                    break
+
+            assert matcher.match(path, is_dir) == expected, (path, is_dir)
+
+
+def test_filter_paths_prunes_excluded_dirs():
+
+    matcher = WorkingSetMatcher(((False, 'skip/'),))
+
+    listing = [
+        ('a', True),
+        ('a/skip', True),
+        ('a/skip/file', False),
+        ('a/keep', False),
+        ('skip', False),
+    ]
+
+    assert list(matcher.filter_paths(listing)) == [
+        ('a', True),
+        ('a/keep', False),
+        ('skip', False),
+    ]
+
+
+FIXTURE_PATHS = 5000
+"""Number of paths in the synthetic fixture tree."""
+
+FIXTURE_PROJECTS = 50
+
+FIXTURE_TREE = [
+    ('lab/projects/keep/src/main.py', False),
+    ('lab/projects/keep/src/__pycache__/main.pyc', False),
+    ('lab/projects/keep/build/out.o', False),
+    ('lab/projects/keep/db.sqlite3', False),
+    ('lab/projects/keep/notes/build', False),
+    ('lab/projects/other/main.py', False),
+    ('lab/tmp/scratch.txt', False),
+    ('tmp/scratch.txt', False),
+    ('cache/a/b/old', False),
+    ('cache/a/b/older', False),
+    ('top.log', False),
+    ('keep.log', False),
+]
+"""A small tree exercising each kind of rule in FIXTURE_RULES."""
+
+FIXTURE_RULES = (
+    (True, 'keep.log'),
+    (False, '*.log'),
+    (False, '/tmp'),
+    (False, '__pycache__/'),
+    (False, 'build/'),
+    (False, '**.sqlite3'),
+    (False, 'cache/**/old'),
+    (True, 'lab/'),
+    (True, 'lab/projects/'),
+    (True, 'lab/projects/keep/***'),
+    (False, 'lab/*'),
+)
+
+
+def matched_and_rsync_listings(tmp_path, rules, listing):
+    """Get the paths the matcher includes from a listing and the ones
+    rsync transfers from a tree made from it."""
+
+    from tasks.plugins.bench import (
+        make_synthetic_tree,
+        rsync_listing,
+        with_parent_dirs,
+    )
+
+    root = tmp_path / 'tree'
+    make_synthetic_tree(root, listing)
+
+    filter_path = tmp_path / 'filter.rules'
+    filter_path.write_text(render_filter_rules(rules))
+
+    included = set(path for path, _ in
+                   WorkingSetMatcher(rules).filter_paths(with_parent_dirs(listing)))
+
+    return included, rsync_listing(root, filter_path)
+
+
+requires_rsync = pytest.mark.skipif(shutil.which('rsync') is None,
+                                    reason="rsync isn't installed")
+
+
+@requires_rsync
+def test_agrees_with_rsync_on_fixture_tree(tmp_path):
+
+    included, expected = matched_and_rsync_listings(tmp_path, FIXTURE_RULES, FIXTURE_TREE)
+
+    assert included == expected
+
+
+@requires_rsync
+def test_agrees_with_rsync_on_synthetic_tree(tmp_path):
+
+    from tasks.plugins.bench import (
+        synthetic_paths,
+        synthetic_working_set,
+    )
+
+    rules = compile_filter_rules(*synthetic_working_set(FIXTURE_PROJECTS))
+
+    included, expected = matched_and_rsync_listings(
+        tmp_path,
+        rules,
+        synthetic_paths(FIXTURE_PATHS, FIXTURE_PROJECTS, seed=1),
+    )
+
+    assert included == expected
@@ -0,0 +1,47 @@
+"""Unit tests for the filesystem operations of the native protocol."""
+
+from refugue.protocols.native import (
+    backup_path,
+    remove_path,
+)
+
+BACKUP_SUFFIX = '.refugue-backup'
+
+
+def test_directory_backups_are_replaced(tmp_path):
+
+    path = tmp_path / 'dir'
+
+    for text in ('first', 'second'):
+
+        path.mkdir()
+        (path / 'file').write_text(text)
+
+        remove_path(str(path), backup=BACKUP_SUFFIX)
+
+    backup = tmp_path / f"dir{BACKUP_SUFFIX}"
+
+    assert not path.exists()
+    assert (backup / 'file').read_text() == 'second'
+
+
+def test_backups_replace_other_kinds(tmp_path):
+
+    path = tmp_path / 'entry'
+    backup = tmp_path / f"entry{BACKUP_SUFFIX}"
+
+    # a file backed up over a directory
+    backup.mkdir()
+    path.write_text('file')
+
+    backup_path(str(path), BACKUP_SUFFIX)
+
+    assert backup.read_text() == 'file'
+
+    # and a directory over a file
+    path.mkdir()
+
+    backup_path(str(path), BACKUP_SUFFIX)
+
+    assert backup.is_dir()
+    assert not path.exists()
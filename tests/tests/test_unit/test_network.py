@@ -0,0 +1,254 @@
+"""Unit tests for probing peers and the routes to them."""
+
+import time
+
+import pytest
+
+from refugue import network
+from refugue.network import (
+    parse_rsync_version,
+    race_routes,
+    Network,
+)
+
+
+@pytest.fixture
+def fake_routes(monkeypatch):
+    """Make connect_rtt answer for each route (by its host) after a
+    delay with the given result."""
+
+    answers = {}
+
+    def _connect_rtt(route, timeout=None):
+
+        delay, result = answers[route.host]
+        time.sleep(delay)
+
+        return result
+
+    monkeypatch.setattr(network, 'connect_rtt', _connect_rtt)
+
+    return answers
+
+
+def routes(*hosts):
+    return [network.SSHConnection(host=host, user='user') for host in hosts]
+
+
+def test_race_routes_lowest_rtt_wins(fake_routes):
+
+    # the slower route answers first, e.g. since resolving its
+    # endpoint was quicker
+    fake_routes.update({
+        'slow' : (0.0, (True, 0.2, 'ssh slow:22')),
+        'fast' : (0.05, (True, 0.01, 'ssh fast:22')),
+    })
+
+    assert race_routes(routes('slow', 'fast'), timeout=0.5) == (1, 0.01)
+
+
+def test_race_routes_doesnt_wait_past_timeout(fake_routes):
+
+    fake_routes.update({
+        'fast' : (0.0, (True, 0.01, 'ssh fast:22')),
+        'hung' : (1.0, (True, 0.001, 'ssh hung:22')),
+    })
+
+    start = time.monotonic()
+    assert race_routes(routes('fast', 'hung'), timeout=0.2) == (0, 0.01)
+
+    assert time.monotonic() - start < 0.5
+
+
+def test_race_routes_skips_unreachable(fake_routes):
+
+    fake_routes.update({
+        'down' : (0.0, (False, None, 'timed out')),
+        'up' : (0.05, (True, 0.05, 'ssh up:22')),
+    })
+
+    assert race_routes(routes('down', 'up'), timeout=0.5) == (1, 0.05)
+
+
+def test_race_routes_unmeasured_last(fake_routes):
+
+    fake_routes.update({
+        'down' : (0.0, (False, None, 'timed out')),
+        'jump1' : (0.0, (True, None, 'jump host answered')),
+        'jump0' : (0.05, (True, None, 'jump host answered')),
+    })
+
+    # the first of the routes which can't be measured
+    assert race_routes(routes('down', 'jump0', 'jump1'), timeout=0.5) == (1, None)
+
+
+def test_race_routes_none_reachable(fake_routes):
+
+    fake_routes.update({
+        'a' : (0.0, (False, None, 'timed out')),
+        'b' : (0.0, (False, None, 'connection refused')),
+    })
+
+    assert race_routes(routes('a', 'b')) == (None, None)
+
+
+def test_empty_routes_are_rejected():
+
+    network = Network.from_config({
+        'HOSTS' : ['junco'],
+        'DRIVES' : [],
+        'PEERS' : ['junco'],
+        'PEER_ALIASES' : {},
+        'HOST_NODE_ALIASES' : {},
+        'PEER_TYPES' : {'hosts' : ['junco'], 'drives' : []},
+        'CONNECTIONS' : {'junco' : {'user' : 'user', 'routes' : []}},
+    })
+
+    with pytest.raises(ValueError, match='junco'):
+        network.resolve_peer_route(network.peer_index['junco'])
+
+
+def test_peer_types_by_name():
+
+    config = {
+        'HOSTS' : ['junco'],
+        'DRIVES' : ['usb'],
+        'PEERS' : ['junco', 'usb'],
+        'PEER_ALIASES' : {},
+        'HOST_NODE_ALIASES' : {},
+        'PEER_TYPES' : {'hosts' : ['junco'], 'drives' : ['usb']},
+        'CONNECTIONS' : {},
+    }
+
+    network = Network.from_config(config)
+
+    assert network.resolve_peer_type('junco') == 'host'
+    assert network.resolve_peer_type('usb') == 'drive'
+    assert network.resolve_peer_type('other') is None
+
+    # the indexes are of the network's config, not shared between
+    # networks
+    config['HOSTS'].append('other')
+
+    assert Network.from_config(config).resolve_peer_type('other') == 'host'
+    assert network.resolve_peer_type('other') is None
+
+
+def test_peers_can_be_pickled():
+
+    import pickle
+
+    peer = network.PeerHost(name='junco', aliases=('j',), node_aliases=())
+
+    assert pickle.loads(pickle.dumps(peer)) == peer
+
+
+RSYNC_3_2_VERSION = """\
+rsync  version 3.2.7  protocol version 31
+Copyright (C) 1996-2022 by Andrew Tridgell, Wayne Davison, and others.
+Web site: https://rsync.samba.org/
+Capabilities:
+    64-bit files, 64-bit inums, 64-bit timestamps, 64-bit long ints,
+    socketpairs, symlinks, symtimes, hardlinks, hardlink-specials,
+    hardlink-symlinks, IPv6, atimes, batchfiles, inplace, append, ACLs,
+    xattrs, optional secluded-args, iconv, prealloc, stop-at, no crtimes
+Optimizations:
+    SIMD-roll, no asm-roll, openssl-crypto, no asm-MD5
+Checksum list:
+    xxh128 xxh3 xxh64 (xxhash) md5 md4 sha1 none
+Compress list:
+    zstd lz4 zlibx zlib none
+Daemon auth list:
+    sha512 sha256 sha1 md5 md4
+
+rsync comes with ABSOLUTELY NO WARRANTY.  This is free software, and you
+are welcome to redistribute it under certain conditions.  See the GNU
+General Public Licence for details.
+"""
+
+RSYNC_3_1_VERSION = """\
+rsync  version 3.1.3  protocol version 31
+Copyright (C) 1996-2018 by Andrew Tridgell, Wayne Davison, and others.
+Web site: http://rsync.samba.org/
+Capabilities:
+    64-bit files, 64-bit inums, 64-bit timestamps, 64-bit long ints,
+    socketpairs, hardlinks, symlinks, IPv6, batchfiles, inplace,
+    append, ACLs, xattrs, iconv, symtimes, prealloc
+"""
+
+
+def test_parse_rsync_version():
+
+    caps = parse_rsync_version(RSYNC_3_2_VERSION)
+
+    assert caps['version'] == [3, 2, 7]
+    assert caps['protocol'] == 31
+    assert 'hardlinks' in caps['capabilities']
+    assert 'optional secluded-args' in caps['capabilities']
+    assert caps['checksum_choices'] == ['xxh128', 'xxh3', 'xxh64', 'md5', 'md4', 'sha1']
+    assert caps['compress_choices'] == ['zstd', 'lz4', 'zlibx', 'zlib']
+
+
+def test_parse_rsync_version_without_lists():
+
+    caps = parse_rsync_version(RSYNC_3_1_VERSION)
+
+    assert caps['version'] == [3, 1, 3]
+    assert 'inplace' in caps['capabilities']
+    assert caps['checksum_choices'] == []
+    assert caps['compress_choices'] == []
+
+
+def test_parse_rsync_version_not_rsync():
+
+    caps = parse_rsync_version("bash: rsync: command not found")
+
+    assert caps['version'] is None
+    assert caps['protocol'] is None
+    assert caps['capabilities'] == []
+
+
+def sandbox_network(tmp_path, isolated):
+    """Two sandboxed hosts, which can't connect to each other if
+    isolated."""
+
+    return Network.from_config({
+        'HOSTS' : ['junco', 'robin'],
+        'DRIVES' : [],
+        'PEERS' : ['junco', 'robin'],
+        'PEER_ALIASES' : {},
+        'HOST_NODE_ALIASES' : {},
+        'PEER_TYPES' : {'hosts' : ['junco', 'robin'], 'drives' : []},
+        'CONNECTIONS' : {
+            name : {'user' : 'user',
+                    'sandbox' : {'root' : str(tmp_path / name), 'isolated' : isolated}}
+            for name in ('junco', 'robin')
+        },
+    })
+
+
+def test_failed_peer_links_are_probed_again(tmp_path, monkeypatch):
+
+    import io
+    from invoke import Context
+
+    monkeypatch.setenv('REFUGUE_CACHE_DIR', str(tmp_path / 'cache'))
+
+    # the sandboxes run their commands with invoke, which reads it
+    monkeypatch.setattr('sys.stdin', io.StringIO())
+
+    isolated = sandbox_network(tmp_path, isolated=True)
+    junco, robin = isolated.peer_index['junco'], isolated.peer_index['robin']
+
+    link = isolated.probe_peer_link(Context(), junco, robin)
+
+    assert not link.reachable
+    assert link.reason.endswith('Connection refused')
+
+    # the same peers can connect once they aren't isolated
+    connected = sandbox_network(tmp_path, isolated=False)
+
+    assert connected.probe_peer_link(Context(), junco, robin).reachable
+
+    # and that is kept
+    assert isolated.probe_peer_link(Context(), junco, robin).reachable
@@ -0,0 +1,103 @@
+"""Unit tests for parsing rsync's output."""
+
+import pytest
+
+from refugue.output import (
+    parse_itemize_line,
+    parse_rsync_stats,
+)
+
+
+@pytest.mark.parametrize('line, kind, path, is_dir', [
+    ('>f+++++++++ 10 10 a/b.txt', 'created', 'a/b.txt', False),
+    ('>f.st...... 10 4 a/b.txt', 'updated', 'a/b.txt', False),
+    ('cd+++++++++ 0 0 a/', 'created', 'a', True),
+    ('.d..t...... 0 0 a/', 'attrs', 'a', True),
+    ('.f...p..... 10 0 a/b.txt', 'attrs', 'a/b.txt', False),
+    ('*deleting   0 0 foo.txt', 'deleted', 'foo.txt', False),
+    ('*deleting   0 0 dir/', 'deleted', 'dir', True),
+    ('*deleting   0 0 d', 'deleted', 'd', False),
+])
+def test_parse_itemize_line(line, kind, path, is_dir):
+
+    event = parse_itemize_line(line)
+
+    assert event.kind == kind
+    assert event.path == path
+    assert event.is_dir == is_dir
+
+
+def test_parse_itemize_line_sizes():
+
+    event = parse_itemize_line('>f+++++++++ 1,024 512 big.bin')
+
+    assert event.size == 1024
+    assert event.transferred == 512
+
+
+def test_parse_itemize_line_symlink_target_is_dropped():
+
+    event = parse_itemize_line('cL+++++++++ 0 0 link -> target')
+
+    assert event.kind == 'created'
+    assert event.path == 'link'
+
+
+@pytest.mark.parametrize('line', [
+    '',
+    'sending incremental file list',
+    'Number of files: 3',
+])
+def test_parse_itemize_line_other_lines(line):
+
+    assert parse_itemize_line(line) is None
+
+
+RSYNC_STATS_OUTPUT = """
+Number of files: 1,234 (reg: 1,200, dir: 34)
+Number of created files: 12 (reg: 10, dir: 2)
+Number of deleted files: 3
+Number of regular files transferred: 56
+Total file size: 1.50G bytes
+Total transferred file size: 2,048 bytes
+Literal data: 2,048 bytes
+Matched data: 0 bytes
+File list size: 0
+Total bytes sent: 12.34K
+Total bytes received: 789
+
+sent 12,340 bytes  received 789 bytes  26,258.00 bytes/sec
+total size is 1,500,000,000  speedup is 114,250.87
+"""
+
+
+def test_parse_rsync_stats():
+
+    assert parse_rsync_stats(RSYNC_STATS_OUTPUT) == {
+        'files' : 1234,
+        'created_files' : 12,
+        'deleted_files' : 3,
+        'transferred_files' : 56,
+        'total_size' : 1_500_000_000,
+        'transferred_size' : 2048,
+        'literal_data' : 2048,
+        'matched_data' : 0,
+        'file_list_size' : 0,
+        'bytes_sent' : 12340,
+        'bytes_received' : 789,
+    }
+
+
+def test_parse_rsync_stats_partial():
+
+    assert parse_rsync_stats("Number of deleted files: 0\nUnknown label: 5\n") == {
+        'deleted_files' : 0,
+    }
+
+
+def test_sizes_without_units_are_exact():
+
+    event = parse_itemize_line('>f+++++++++ 1,234,567 1,234,567 big.bin')
+
+    assert event.size == 1234567
+    assert parse_rsync_stats("Literal data: 1,234,567 bytes") == {'literal_data' : 1234567}
@@ -0,0 +1,49 @@
+"""Unit tests for piping rsync between two peers through the invoking
+host, with local shell commands standing in for rsync."""
+
+import shlex
+
+from invoke import Context
+
+from refugue.protocols.rsync import (
+    PIPE_RSH,
+    pipe_rsync,
+)
+
+# answers the first line it gets, like an 'rsync --server' which exits
+# when the protocol is done
+SERVER_COMMAND = shlex.quote("sed 's/l/L/g;q'")
+
+
+def run_piped(command_str, in_stream=None):
+
+    lines = []
+    exit_code = pipe_rsync(Context(), Context(), command_str, lines.append,
+                           in_stream=in_stream)
+
+    return exit_code, lines
+
+
+def test_data_is_piped_to_the_remote_command():
+
+    exit_code, lines = run_piped(f"echo hello | {PIPE_RSH} host {SERVER_COMMAND}")
+
+    assert exit_code == 0
+    assert lines == ['heLLo']
+
+
+def test_standard_input_is_passed_before_the_pipe():
+
+    exit_code, lines = run_piped(f"cat | {PIPE_RSH} host {SERVER_COMMAND}",
+                                 in_stream='hello\n')
+
+    assert exit_code == 0
+    assert lines == ['heLLo']
+
+
+def test_failing_before_connecting():
+
+    exit_code, lines = run_piped("echo 'rsync error: bad option' >&2; exit 1")
+
+    assert exit_code == 1
+    assert lines == ['rsync error: bad option']
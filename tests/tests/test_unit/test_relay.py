@@ -0,0 +1,41 @@
+"""Unit tests for planning the relay of syncs between targets."""
+
+import pytest
+
+from refugue.image import relay_tree
+
+
+def test_star_when_only_the_root_has_edges():
+
+    assert relay_tree(4, lambda parent, child: 1 if parent == 0 else None) == [None, 0, 0, 0]
+
+
+def test_cheaper_edges_are_relayed():
+
+    # 0 is a slow remote source, 1 and 2 are local drives which are
+    # cheap to sync between
+    costs = {
+        (0, 1) : 10, (0, 2) : 10, (0, 3) : 10,
+        (1, 2) : 1, (2, 1) : 1,
+        (1, 3) : 5, (2, 3) : 2,
+    }
+
+    parents = relay_tree(4, lambda parent, child: costs.get((parent, child)))
+
+    assert parents == [None, 0, 1, 2]
+
+
+def test_ties_attach_closer_to_the_root():
+
+    assert relay_tree(3, lambda parent, child: 1) == [None, 0, 0]
+
+
+def test_single_node():
+
+    assert relay_tree(1, lambda parent, child: 1) == [None]
+
+
+def test_root_needs_an_edge_to_every_node():
+
+    with pytest.raises(ValueError):
+        relay_tree(3, lambda parent, child: None if child == 2 else 1)
@@ -0,0 +1,110 @@
+"""Unit tests for keeping the metadata refugue stores in replicas out of
+syncs."""
+
+import shutil
+import subprocess
+
+import pytest
+
+from refugue.image import (
+    compile_filter_rules,
+    render_sync_filter,
+    WorkingSet,
+)
+from refugue.manifest import (
+    scan_local_manifest,
+    REPLICA_MANIFEST_DIR,
+    Manifest,
+)
+from refugue.protocols.native import NativeSyncer
+from refugue.sync import (
+    SyncPolicy,
+    TransportPolicy,
+)
+
+
+def make_replica(root, files):
+    """Make a replica with some files and its manifest stored in it."""
+
+    for rel_path, text in files.items():
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+
+    scan_local_manifest(root, root / REPLICA_MANIFEST_DIR).close()
+
+
+@pytest.fixture
+def replicas(tmp_path):
+
+    src = tmp_path / 'src'
+    target = tmp_path / 'target'
+
+    make_replica(src, {'a.txt' : 'new', 'dir/b.txt' : 'b'})
+    make_replica(target, {'a.txt' : 'old', 'gone.txt' : 'x'})
+
+    # the source's manifest must not end up in the target
+    (src / '.refugue' / 'only-in-src').write_text('src')
+
+    return src, target
+
+
+def assert_metadata_kept(src, target):
+
+    assert (target / 'dir' / 'b.txt').read_text() == 'b'
+    assert not (target / 'gone.txt').exists()
+
+    assert not (target / '.refugue' / 'only-in-src').exists()
+
+    manifest = Manifest(target / REPLICA_MANIFEST_DIR)
+    try:
+        assert manifest.meta['root'] == str(target)
+        assert manifest.find('gone.txt') is not None
+    finally:
+        manifest.close()
+
+
+def test_sync_filter_starts_with_metadata_rules():
+
+    filter_text = render_sync_filter(compile_filter_rules(('a/',), ('*',)))
+
+    assert filter_text == "P /.refugue/\n- /.refugue/\n+ a/\n- *\n"
+    assert render_sync_filter(()) == "P /.refugue/\n- /.refugue/\n"
+
+
+@pytest.mark.parametrize('prune', [False, True])
+def test_native_sync_keeps_metadata(replicas, prune):
+
+    src, target = replicas
+
+    syncer = NativeSyncer(
+        src_root=str(src),
+        target_root=str(target),
+        wset=WorkingSet(includes=(), excludes=()),
+        sync_pol=SyncPolicy(inject=False, clobber=True, clean=True, prune=prune),
+        transport_pol=TransportPolicy(compression=None, encryption=None, dry=False,
+                                      backup=None, create=True),
+        verbose=False,
+    )
+    syncer.sync()
+
+    assert_metadata_kept(src, target)
+
+
+@pytest.mark.skipif(shutil.which('rsync') is None, reason="rsync isn't installed")
+@pytest.mark.parametrize('prune', [False, True])
+def test_rsync_keeps_metadata(replicas, tmp_path, prune):
+
+    src, target = replicas
+
+    filter_path = tmp_path / 'filter.rules'
+    filter_path.write_text(render_sync_filter(()))
+
+    subprocess.run(
+        ['rsync', '--recursive', '--times', '--delete']
+        + (['--delete-excluded'] if prune else [])
+        + [f'--filter=merge {filter_path}', f"{src}/", str(target)],
+        check=True,
+    )
+
+    assert_metadata_kept(src, target)
@@ -0,0 +1,34 @@
+"""Unit tests for splitting a replica between parallel transfers."""
+
+from refugue.protocols.rsync import partition_shards
+
+
+def test_heaviest_first_and_balanced():
+
+    weights = {'a' : 10, 'b' : 7, 'c' : 5, 'd' : 3, 'e' : 2}
+
+    shards = partition_shards(weights, 2)
+
+    assert shards == [(14, ('b', 'c', 'e')), (13, ('a', 'd'))]
+
+
+def test_every_name_in_one_shard():
+
+    weights = {f"dir{idx}" : idx % 7 + 1 for idx in range(100)}
+
+    shards = partition_shards(weights, 8)
+
+    names = [name for _, shard_names in shards for name in shard_names]
+
+    assert sorted(names) == sorted(weights)
+    assert sum(total for total, _ in shards) == sum(weights.values())
+
+    totals = [total for total, _ in shards]
+    assert totals == sorted(totals, reverse=True)
+    assert max(totals) - min(totals) <= max(weights.values())
+
+
+def test_empty_shards_are_dropped():
+
+    assert partition_shards({'a' : 1, 'b' : 1}, 4) == [(1, ('a',)), (1, ('b',))]
+    assert partition_shards({}, 4) == []